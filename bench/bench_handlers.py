@@ -0,0 +1,180 @@
+# Offline handler benchmark: builds the Application from main.build_application
+# with a stub Bot API, drives synthetic updates through process_update and
+# reports throughput, handler latency and Bot API calls per update.
+#
+#   python bench/bench_handlers.py --updates 2000 --latency-ms 20
+import argparse
+import asyncio
+import atexit
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# the bot reads its config at import time: isolate storage and lift outbound limits
+_tmp = tempfile.mkdtemp(prefix="reaper-bench-")
+atexit.register(shutil.rmtree, _tmp, True)
+os.environ.setdefault("DB_PATH", os.path.join(_tmp, "bench.db"))
+for _name in ("OUTBOX_GLOBAL_RATE", "OUTBOX_GROUP_PER_MINUTE", "OUTBOX_PRIVATE_RATE", "OUTBOX_CHAT_BURST", "OUTBOX_MAX_CHATTER", "FLOOD_MESSAGES"):
+	os.environ.setdefault(_name, "1000000000")
+os.environ.setdefault("ROULETTE_COOLDOWN", "0")
+
+import logging
+
+from telegram import Update
+
+import main
+from fakebot import BOT_USER, FakeBotRequest, chat_for, fake_user
+
+logging.getLogger().setLevel(logging.WARNING)
+
+class Traffic:
+	def __init__(self, chats: int, users: int, seed: int):
+		self.rng = random.Random(seed)
+		self.chats = [-1001000000000 - i for i in range(chats)]
+		self.users = [100000 + i for i in range(users)]
+		self.update_id = 0
+
+	def _message(self, chat_id: int, user_id: int, text: str, reply_to: int = None, entities=None) -> dict:
+		self.update_id += 1
+		msg = {
+			"message_id": self.update_id,
+			"date": int(time.time()),
+			"chat": chat_for(chat_id),
+			"from": fake_user(user_id),
+			"text": text,
+		}
+		if entities:
+			msg["entities"] = entities
+		elif text.startswith("/"):
+			msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+		if reply_to is not None:
+			msg["reply_to_message"] = {
+				"message_id": self.update_id + 10 ** 9,
+				"date": int(time.time()),
+				"chat": chat_for(chat_id),
+				"from": BOT_USER if reply_to == BOT_USER["id"] else fake_user(reply_to),
+				"text": "...",
+			}
+		return msg
+
+	def on_message(self) -> dict:
+		chat_id = self.rng.choice(self.chats)
+		user_id = self.rng.choice(self.users)
+		roll = self.rng.random()
+		if roll < 0.05:
+			mention = "@" + BOT_USER["username"]
+			msg = self._message(chat_id, user_id, f"hey {mention}", entities=[{"type": "mention", "offset": 4, "length": len(mention)}])
+		elif roll < 0.10:
+			msg = self._message(chat_id, user_id, "you again", reply_to=BOT_USER["id"])
+		elif roll < 0.30:
+			msg = self._message(chat_id, user_id, "lol", reply_to=self.rng.choice(self.users))
+		else:
+			msg = self._message(chat_id, user_id, "just chatting about nothing in particular")
+		return {"update_id": self.update_id, "message": msg}
+
+	def command(self, text: str, admin: bool = False, reply: bool = False) -> dict:
+		chat_id = self.rng.choice(self.chats)
+		user_id = main.OWNER_ID if admin else self.rng.choice(self.users)
+		reply_to = self.rng.choice(self.users) if reply else None
+		return {"update_id": self.update_id + 1, "message": self._message(chat_id, user_id, text, reply_to=reply_to)}
+
+	def warn_cmd(self) -> dict:
+		return self.command("/warn", admin=True, reply=True)
+
+	def mute_cmd(self) -> dict:
+		return self.command("/mute 60", admin=True, reply=True)
+
+	def roulette_cmd(self) -> dict:
+		return self.command("/roulette", reply=self.rng.random() < 0.5)
+
+	def commands_button_handler(self) -> dict:
+		self.update_id += 1
+		chat_id = self.rng.choice(self.chats)
+		return {
+			"update_id": self.update_id,
+			"callback_query": {
+				"id": str(self.update_id),
+				"from": fake_user(self.rng.choice(self.users)),
+				"chat_instance": str(chat_id),
+				"data": self.rng.choice(["roast", "vanilla", "roulette", "duel", "profile"]),
+				"message": {
+					"message_id": self.update_id,
+					"date": int(time.time()),
+					"chat": chat_for(chat_id),
+					"from": BOT_USER,
+					"text": "menu",
+				},
+			},
+		}
+
+SCENARIOS = ["on_message", "warn_cmd", "mute_cmd", "roulette_cmd", "commands_button_handler"]
+
+def percentile(values: List[float], q: float) -> float:
+	ordered = sorted(values)
+	return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+async def run_scenario(app, fake: FakeBotRequest, make: Callable[[], dict], count: int) -> Dict:
+	updates = [Update.de_json(make(), app.bot) for _ in range(count)]
+	fake.reset()
+	latencies = []
+	started = time.perf_counter()
+	for update in updates:
+		t0 = time.perf_counter()
+		await app.process_update(update)
+		latencies.append(time.perf_counter() - t0)
+	elapsed = time.perf_counter() - started
+	# replies are queued in the outbox; wait for them so their API calls are counted
+	await main.outbox.join()
+	calls = sum(fake.calls.values())
+	return {
+		"updates": count,
+		"updates_per_sec": count / elapsed if elapsed else float("inf"),
+		"p50_ms": percentile(latencies, 0.50) * 1000,
+		"p99_ms": percentile(latencies, 0.99) * 1000,
+		"api_calls_per_update": calls / count,
+		"api_calls": dict(fake.calls.most_common()),
+	}
+
+async def run(args) -> Dict[str, Dict]:
+	fake = FakeBotRequest(latency=args.latency_ms / 1000)
+	app = main.build_application("123456:BENCH", request=fake, get_updates_request=FakeBotRequest())
+	traffic = Traffic(args.chats, args.users, args.seed)
+	results = {}
+	async with app:
+		await app.post_init(app)
+		for name in args.only or SCENARIOS:
+			# warm up caches (bot rights, chat state) before measuring
+			await run_scenario(app, fake, getattr(traffic, name), min(args.updates, 50))
+			results[name] = await run_scenario(app, fake, getattr(traffic, name), args.updates)
+		await app.post_stop(app)
+	return results
+
+def main_cli():
+	parser = argparse.ArgumentParser(description="Offline benchmark of the bot handlers against a stub Bot API")
+	parser.add_argument("--updates", type=int, default=2000, help="updates per scenario")
+	parser.add_argument("--latency-ms", type=float, default=0.0, help="artificial Bot API latency")
+	parser.add_argument("--chats", type=int, default=50)
+	parser.add_argument("--users", type=int, default=500)
+	parser.add_argument("--seed", type=int, default=1)
+	parser.add_argument("--only", nargs="*", choices=SCENARIOS)
+	parser.add_argument("--json", action="store_true", help="print results as JSON")
+	args = parser.parse_args()
+	results = asyncio.run(run(args))
+	if args.json:
+		print(json.dumps(results, indent=2))
+		return
+	print(f"{'handler':<26}{'upd/s':>10}{'p50 ms':>10}{'p99 ms':>10}{'api/upd':>10}  calls")
+	for name, r in results.items():
+		calls = ", ".join(f"{m}={n}" for m, n in r["api_calls"].items())
+		print(f"{name:<26}{r['updates_per_sec']:>10.0f}{r['p50_ms']:>10.3f}{r['p99_ms']:>10.3f}{r['api_calls_per_update']:>10.2f}  {calls}")
+
+if __name__ == "__main__":
+	main_cli()
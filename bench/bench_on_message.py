@@ -0,0 +1,88 @@
+# Per-message cost of on_message: calls the handler directly (no dispatcher)
+# for each kind of incoming message and reports time and Bot API calls per
+# message. Plain group chatter is the case that has to stay cheap.
+#
+#   python bench/bench_on_message.py --messages 200000
+import argparse
+import asyncio
+import logging
+import time
+import tracemalloc
+
+# bench_handlers isolates storage and lifts outbound limits on import, so it
+# has to come before main
+from bench_handlers import Traffic
+from fakebot import BOT_USER, FakeBotRequest, chat_for, fake_user
+
+from telegram import Update
+from telegram.ext import CallbackContext
+
+import main
+
+logging.getLogger().setLevel(logging.WARNING)
+
+def make_cases(traffic: Traffic):
+	chat_id = traffic.chats[0]
+	user_id = traffic.users[0]
+	other = traffic.users[1]
+	mention = "@" + BOT_USER["username"]
+	return {
+		"plain group message": traffic._message(chat_id, user_id, "just chatting about nothing in particular"),
+		"reply to another user": traffic._message(chat_id, user_id, "lol", reply_to=other),
+		"mention of another user": traffic._message(chat_id, user_id, "hey @someone_else", entities=[{"type": "mention", "offset": 4, "length": 13}]),
+		"mention of the bot": traffic._message(chat_id, user_id, f"hey {mention}", entities=[{"type": "mention", "offset": 4, "length": len(mention)}]),
+		"reply to the bot": traffic._message(chat_id, user_id, "you again", reply_to=BOT_USER["id"]),
+		"private message": {
+			"message_id": 1,
+			"date": int(time.time()),
+			"chat": chat_for(user_id),
+			"from": fake_user(user_id),
+			"text": "hello",
+		},
+	}
+
+async def measure(app, fake: FakeBotRequest, message: dict, count: int):
+	update = Update.de_json({"update_id": 1, "message": message}, app.bot)
+	context = CallbackContext.from_update(update, app)
+	handler = main.on_message
+	await handler(update, context)  # warm up: loads chat state
+	await main.outbox.join()
+	fake.reset()
+	started = time.perf_counter()
+	for _ in range(count):
+		await handler(update, context)
+	elapsed = time.perf_counter() - started
+	await main.outbox.join()
+	api_calls = sum(fake.calls.values()) / count
+	# allocations that survive a call (queued replies excluded once drained)
+	tracemalloc.start()
+	before = tracemalloc.get_traced_memory()[0]
+	for _ in range(1000):
+		await handler(update, context)
+	await main.outbox.join()
+	retained = (tracemalloc.get_traced_memory()[0] - before) / 1000
+	tracemalloc.stop()
+	return elapsed / count * 1e9, api_calls, retained
+
+async def run(args):
+	fake = FakeBotRequest()
+	app = main.build_application("123456:BENCH", request=fake, get_updates_request=FakeBotRequest())
+	results = {}
+	async with app:
+		await app.post_init(app)
+		for name, message in make_cases(Traffic(1, 2, 1)).items():
+			results[name] = await measure(app, fake, message, args.messages)
+		await app.post_stop(app)
+	return results
+
+def main_cli():
+	parser = argparse.ArgumentParser(description="Per-message cost of on_message")
+	parser.add_argument("--messages", type=int, default=100000)
+	args = parser.parse_args()
+	results = asyncio.run(run(args))
+	print(f"{'message':<26}{'ns/msg':>10}{'api/msg':>10}{'B kept/msg':>12}")
+	for name, (ns, api, retained) in results.items():
+		print(f"{name:<26}{ns:>10.0f}{api:>10.2f}{retained:>12.1f}")
+
+if __name__ == "__main__":
+	main_cli()
@@ -0,0 +1,97 @@
+# Stub Bot API for offline benchmarks: answers the methods the bot uses from
+# memory, counts calls per method and can add an artificial latency.
+import asyncio
+import json
+import time
+from collections import Counter
+from typing import Optional, Tuple
+
+from telegram.request import BaseRequest, RequestData
+
+BOT_USER = {"id": 1000000001, "is_bot": True, "first_name": "VanillaReaper", "username": "vanilla_reaper_bot"}
+
+def fake_user(user_id: int) -> dict:
+	return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"}
+
+def chat_for(chat_id: int) -> dict:
+	if chat_id > 0:
+		return {"id": chat_id, "type": "private", "first_name": f"user{chat_id}"}
+	return {"id": chat_id, "type": "supergroup", "title": f"chat{chat_id}"}
+
+def bot_admin_member() -> dict:
+	return {
+		"status": "administrator",
+		"user": BOT_USER,
+		"can_be_edited": False,
+		"is_anonymous": False,
+		"can_manage_chat": True,
+		"can_delete_messages": True,
+		"can_manage_video_chats": False,
+		"can_restrict_members": True,
+		"can_promote_members": False,
+		"can_change_info": False,
+		"can_invite_users": True,
+		"can_post_stories": False,
+		"can_edit_stories": False,
+		"can_delete_stories": False,
+	}
+
+class FakeBotAPI:
+	# answers Bot API methods by name; shared by the in-process request stub
+	# and the HTTP stand-in server
+	def __init__(self):
+		self.message_id = 0
+
+	def answer(self, method: str, params: dict):
+		if method == "getMe":
+			return BOT_USER
+		if method == "getChatMember":
+			user_id = int(params["user_id"])
+			if user_id == BOT_USER["id"]:
+				return bot_admin_member()
+			return {"status": "member", "user": fake_user(user_id)}
+		if method == "getChatAdministrators":
+			return [bot_admin_member()]
+		if method == "sendMessage":
+			self.message_id += 1
+			chat_id = int(params["chat_id"])
+			return {
+				"message_id": self.message_id,
+				"date": int(time.time()),
+				"chat": chat_for(chat_id),
+				"from": BOT_USER,
+				"text": params.get("text", ""),
+			}
+		if method == "getUpdates":
+			return []
+		# restrictChatMember, banChatMember, unbanChatMember, answerCallbackQuery,
+		# setMyCommands, deleteWebhook, ...
+		return True
+
+class FakeBotRequest(BaseRequest):
+	def __init__(self, latency: float = 0.0, api: Optional[FakeBotAPI] = None):
+		self.latency = latency
+		self.api = api or FakeBotAPI()
+		self.calls: Counter = Counter()
+
+	def reset(self):
+		self.calls.clear()
+
+	@property
+	def read_timeout(self) -> Optional[float]:
+		return None
+
+	async def initialize(self):
+		pass
+
+	async def shutdown(self):
+		pass
+
+	async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None, read_timeout=None, write_timeout=None, connect_timeout=None, pool_timeout=None) -> Tuple[int, bytes]:
+		api_method = url.rsplit("/", 1)[-1]
+		self.calls[api_method] += 1
+		if self.latency:
+			await asyncio.sleep(self.latency)
+		params = request_data.parameters if request_data else {}
+		result = self.api.answer(api_method, params)
+		return 200, json.dumps({"ok": True, "result": result}).encode()
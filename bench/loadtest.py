@@ -0,0 +1,308 @@
+# End-to-end load test. A local stand-in for the Bot API serves synthetic
+# updates through getUpdates and answers every other method from
+# fakebot.FakeBotAPI, with optional latency and injected 429s. The real bot
+# runs as `python main.py` against it (BOT_API_URL), so polling, the HTTP
+# client pool, the outbox and the handlers are all in the loop. Reports
+# updates/s taken and answered, reply latency and how full the bot's HTTP
+# connection pool got (from its /metrics).
+#
+#   python bench/loadtest.py --rate 500 --duration 30
+#   python bench/loadtest.py --rate 0 --latency-ms 80 --error-rate 0.01 --pool-size 32
+import argparse
+import asyncio
+import atexit
+import json
+import os
+import random
+import shutil
+import signal
+import sys
+import tempfile
+import time
+import urllib.request
+from collections import Counter, deque
+from typing import Deque, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import logging
+
+from bench_handlers import Traffic, percentile
+from fakebot import FakeBotAPI
+
+import main
+
+logging.getLogger().setLevel(logging.WARNING)
+
+TOKEN = "123456:LOADTEST"
+API_METHODS = [
+	"getMe", "getUpdates", "deleteWebhook", "setWebhook", "setMyCommands", "getMyCommands",
+	"sendMessage", "editMessageText", "deleteMessage", "answerCallbackQuery",
+	"getChatMember", "getChatAdministrators", "restrictChatMember", "banChatMember", "unbanChatMember",
+	"close", "logOut",
+]
+# the same limits bench_handlers lifts; kept with --keep-limits
+LIFTED_LIMITS = ("OUTBOX_GLOBAL_RATE", "OUTBOX_GROUP_PER_MINUTE", "OUTBOX_PRIVATE_RATE", "OUTBOX_CHAT_BURST", "OUTBOX_MAX_CHATTER", "FLOOD_MESSAGES")
+
+class LoadModel:
+	# what getUpdates hands out: mostly chatter, some commands
+	MIX = (("on_message", 0.85), ("roulette_cmd", 0.10), ("warn_cmd", 0.05))
+
+	def __init__(self, chats: int, users: int, seed: int):
+		self.traffic = Traffic(chats, users, seed)
+		self.rng = random.Random(seed)
+		self.update_id = 0
+
+	def next(self) -> dict:
+		roll = self.rng.random()
+		for name, share in self.MIX:
+			roll -= share
+			if roll < 0:
+				break
+		update = getattr(self.traffic, name)()
+		self.update_id += 1
+		update["update_id"] = self.update_id
+		return update
+
+class FakeBotServer:
+	# The Bot API over HTTP on top of main.MiniHTTPServer. getUpdates releases
+	# updates at `rate` per second (0: a full batch on every call) and treats
+	# the offset as the bot's acknowledgement; sendMessage replies are matched
+	# to the update they answer through reply_parameters.
+
+	def __init__(self, model: LoadModel, rate: float, latency: float, error_rate: float, retry_after: int, seed: int):
+		self.model = model
+		self.rate = rate
+		self.latency = latency
+		self.error_rate = error_rate
+		self.retry_after = retry_after
+		self.rng = random.Random(seed)
+		self.api = FakeBotAPI()
+		self.http = main.MiniHTTPServer()
+		self.calls: Counter = Counter()
+		self.injected_429 = 0
+		self.producing = False
+		self.closing = False
+		self.started: Optional[float] = None
+		self.stopped: Optional[float] = None
+		self.offered = 0
+		self.acked = 0
+		self.replies = 0
+		self.last_reply: Optional[float] = None
+		self.reply_latency: List[float] = []
+		self._served: Dict[Tuple[int, int], float] = {}  # (chat_id, message_id) -> time handed out
+		self._sent: Deque[dict] = deque()  # handed out, not yet acknowledged
+		self._budget = 0.0
+		self._budget_at = 0.0
+		self.first_poll = asyncio.Event()
+		for method in API_METHODS:
+			self.http.route("POST", f"/bot{TOKEN}/{method}", self._handler(method))
+
+	async def start(self, port: int):
+		await self.http.start("127.0.0.1", port)
+
+	async def stop(self):
+		# release pending long polls before closing their connections
+		self.closing = True
+		await asyncio.sleep(0.05)
+		await self.http.stop()
+
+	def begin(self):
+		self.producing = True
+		self.started = self._budget_at = time.monotonic()
+
+	def end(self):
+		self.producing = False
+		self.stopped = time.monotonic()
+
+	def _handler(self, method: str):
+		async def handle(headers: Dict[str, str], body: bytes) -> Tuple[int, str, bytes]:
+			params = dict(parse_qsl(body.decode())) if body else {}
+			self.calls[method] += 1
+			if method == "getUpdates":
+				result = await self._get_updates(params)
+			else:
+				if self.latency:
+					await asyncio.sleep(self.latency)
+				# only under load: a 429 on getMe would just abort the bot's startup
+				if self.producing and self.error_rate and self.rng.random() < self.error_rate:
+					self.injected_429 += 1
+					return 429, "application/json", json.dumps({
+						"ok": False,
+						"error_code": 429,
+						"description": f"Too Many Requests: retry after {self.retry_after}",
+						"parameters": {"retry_after": self.retry_after},
+					}).encode()
+				if method == "sendMessage":
+					self._match_reply(params)
+				result = self.api.answer(method, params)
+			return 200, "application/json", json.dumps({"ok": True, "result": result}).encode()
+		return handle
+
+	def _match_reply(self, params: dict):
+		self.replies += 1
+		self.last_reply = time.monotonic()
+		quoted = params.get("reply_parameters")
+		if not quoted:
+			return
+		served = self._served.pop((int(params["chat_id"]), json.loads(quoted)["message_id"]), None)
+		if served is not None:
+			self.reply_latency.append(self.last_reply - served)
+
+	async def _get_updates(self, params: dict) -> List[dict]:
+		self.first_poll.set()
+		offset = int(params.get("offset") or 0)
+		while self._sent and self._sent[0]["update_id"] < offset:
+			self._sent.popleft()
+			self.acked += 1
+		limit = int(params.get("limit") or 100)
+		timeout = float(params.get("timeout") or 0)
+		deadline = time.monotonic() + timeout
+		while True:
+			count = self._available(limit)
+			if count or self.closing or time.monotonic() >= deadline:
+				break
+			await asyncio.sleep(min(0.01, max(0.0, deadline - time.monotonic())))
+		now = time.monotonic()
+		batch = [self.model.next() for _ in range(count)]
+		for update in batch:
+			message = update.get("message")
+			if message:
+				self._served[(message["chat"]["id"], message["message_id"])] = now
+		self._sent.extend(batch)
+		self.offered += count
+		return batch
+
+	def _available(self, limit: int) -> int:
+		if not self.producing:
+			return 0
+		if self.rate <= 0:
+			return limit
+		now = time.monotonic()
+		self._budget = min(self._budget + (now - self._budget_at) * self.rate, max(limit, self.rate))
+		self._budget_at = now
+		count = min(limit, int(self._budget))
+		self._budget -= count
+		return count
+
+def bot_env(args, tmp: str) -> Dict[str, str]:
+	env = dict(os.environ)
+	if args.keep_limits:
+		for name in LIFTED_LIMITS:
+			env.pop(name, None)
+	env.update({
+		"BOT_TOKEN": TOKEN,
+		"BOT_MODE": "polling",
+		"BOT_API_URL": f"http://127.0.0.1:{args.port}/bot",
+		"DB_PATH": os.path.join(tmp, "loadtest.db"),
+		"AUDIT_DIR": os.path.join(tmp, "audit"),
+		"METRICS_PORT": str(args.metrics_port),
+		"HTTP_POOL_SIZE": str(args.pool_size),
+		"HTTP_POOL_TIMEOUT": str(args.pool_timeout),
+		"WORKERS": str(args.workers),
+	})
+	return env
+
+def scrape_metrics(port: int) -> Dict[str, float]:
+	# flat "name{labels}" -> value from the bot's Prometheus endpoint; with
+	# WORKERS > 0 this is worker 0 only
+	try:
+		with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5) as resp:
+			text = resp.read().decode()
+	except OSError as e:
+		print(f"could not read the bot's metrics: {e}", file=sys.stderr)
+		return {}
+	values = {}
+	for line in text.splitlines():
+		if line and not line.startswith("#"):
+			name, _, value = line.rpartition(" ")
+			values[name] = float(value)
+	return values
+
+async def run(args) -> Dict:
+	tmp = tempfile.mkdtemp(prefix="reaper-load-")
+	atexit.register(shutil.rmtree, tmp, True)
+	server = FakeBotServer(LoadModel(args.chats, args.users, args.seed), args.rate, args.latency_ms / 1000, args.error_rate, args.retry_after, args.seed)
+	await server.start(args.port)
+	log = open(os.path.join(tmp, "bot.log"), "wb") if not args.bot_log else open(args.bot_log, "wb")
+	bot = await asyncio.create_subprocess_exec(sys.executable, os.path.join(ROOT, "main.py"), env=bot_env(args, tmp), stdout=log, stderr=log)
+	try:
+		await asyncio.wait_for(server.first_poll.wait(), args.startup_timeout)
+		server.begin()
+		await asyncio.sleep(args.duration)
+		server.end()
+		# let the bot take and answer what it already has
+		drain_deadline = time.monotonic() + args.drain
+		while time.monotonic() < drain_deadline and (server._sent or (server.last_reply and time.monotonic() - server.last_reply < 1)):
+			await asyncio.sleep(0.1)
+		bot_metrics = await asyncio.to_thread(scrape_metrics, args.metrics_port)
+	finally:
+		if bot.returncode is None:
+			bot.send_signal(signal.SIGINT)
+			try:
+				await asyncio.wait_for(bot.wait(), 30)
+			except asyncio.TimeoutError:
+				bot.kill()
+		log.close()
+		await server.stop()
+	window = server.stopped - server.started
+	answered = (server.last_reply or server.stopped) - server.started
+	latency = server.reply_latency or [0.0]
+	return {
+		"offered": server.offered,
+		"offered_per_sec": server.offered / window,
+		"taken": server.acked,
+		"taken_per_sec": server.acked / window,
+		"replies": server.replies,
+		"replies_per_sec": server.replies / answered if answered > 0 else 0.0,
+		"unacknowledged": len(server._sent),
+		"reply_p50_ms": percentile(latency, 0.50) * 1000,
+		"reply_p90_ms": percentile(latency, 0.90) * 1000,
+		"reply_p99_ms": percentile(latency, 0.99) * 1000,
+		"reply_max_ms": max(latency) * 1000,
+		"api_calls": dict(server.calls.most_common()),
+		"injected_429": server.injected_429,
+		"pool_size": bot_metrics.get("reaper_bot_api_pool_size", 0),
+		"pool_peak_in_flight": bot_metrics.get("reaper_bot_api_in_flight_peak", 0),
+		"pool_timeouts": sum(v for k, v in bot_metrics.items() if k.startswith("reaper_bot_api_calls_total") and 'outcome="pool_timeout"' in k),
+		"bot_api_errors": sum(v for k, v in bot_metrics.items() if k.startswith("reaper_bot_api_calls_total") and 'outcome="error"' in k),
+		"handler_errors": sum(v for k, v in bot_metrics.items() if k.startswith("reaper_handler_errors_total")),
+	}
+
+def main_cli():
+	parser = argparse.ArgumentParser(description="End-to-end load test of main.py against a local fake Bot API")
+	parser.add_argument("--rate", type=float, default=200, help="updates per second handed out by getUpdates, 0 = as fast as the bot polls")
+	parser.add_argument("--duration", type=float, default=20, help="seconds of traffic")
+	parser.add_argument("--drain", type=float, default=15, help="seconds to wait for the backlog after traffic stops")
+	parser.add_argument("--latency-ms", type=float, default=0.0, help="added to every Bot API call except getUpdates")
+	parser.add_argument("--error-rate", type=float, default=0.0, help="share of calls answered with 429")
+	parser.add_argument("--retry-after", type=int, default=1, help="retry_after of injected 429s")
+	parser.add_argument("--pool-size", type=int, default=main.HTTP_POOL_SIZE, help="HTTP_POOL_SIZE of the bot")
+	parser.add_argument("--pool-timeout", type=float, default=main.HTTP_POOL_TIMEOUT, help="HTTP_POOL_TIMEOUT of the bot")
+	parser.add_argument("--workers", type=int, default=0, help="WORKERS of the bot")
+	parser.add_argument("--keep-limits", action="store_true", help="keep the bot's own outbox and anti-flood limits")
+	parser.add_argument("--chats", type=int, default=50)
+	parser.add_argument("--users", type=int, default=500)
+	parser.add_argument("--seed", type=int, default=1)
+	parser.add_argument("--port", type=int, default=8081, help="port of the fake Bot API")
+	parser.add_argument("--metrics-port", type=int, default=9109, help="METRICS_PORT of the bot")
+	parser.add_argument("--startup-timeout", type=float, default=30)
+	parser.add_argument("--bot-log", help="keep the bot's output in this file")
+	parser.add_argument("--json", action="store_true", help="print results as JSON")
+	args = parser.parse_args()
+	r = asyncio.run(run(args))
+	if args.json:
+		print(json.dumps(r, indent=2))
+		return
+	print(f"offered      {r['offered']:>8} updates  {r['offered_per_sec']:>8.0f}/s")
+	print(f"taken        {r['taken']:>8} updates  {r['taken_per_sec']:>8.0f}/s  ({r['unacknowledged']} never acknowledged)")
+	print(f"replies      {r['replies']:>8}          {r['replies_per_sec']:>8.0f}/s")
+	print(f"reply ms     p50 {r['reply_p50_ms']:.1f}  p90 {r['reply_p90_ms']:.1f}  p99 {r['reply_p99_ms']:.1f}  max {r['reply_max_ms']:.1f}")
+	print(f"http pool    {r['pool_size']:.0f} connections, at peak {r['pool_peak_in_flight']:.0f} calls holding or waiting for one, {r['pool_timeouts']:.0f} pool timeouts")
+	print(f"errors       {r['injected_429']} injected 429s, {r['bot_api_errors']:.0f} failed Bot API calls, {r['handler_errors']:.0f} handler errors")
+	print("api calls    " + ", ".join(f"{m}={n}" for m, n in r["api_calls"].items()))
+
+if __name__ == "__main__":
+	main_cli()
@@ -1,31 +1,57 @@
 
 import asyncio
+import bisect
+import functools
+import hashlib
+import heapq
+import hmac
+import html
+import json
 import logging
+import mmap
+import multiprocessing
 import os
+import queue
 import random
+import re
+import signal
+import sqlite3
+import struct
+import sys
+import time
+import traceback
+import httpx
 try:
 	from dotenv import load_dotenv
 	load_dotenv()
 	DOTENV_LOADED = True
 except Exception:
 	DOTENV_LOADED = False
-from datetime import datetime, timedelta
-from typing import Dict, Set, Optional
+from array import array
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Deque, Dict, List, Set, Optional, Tuple
 
-from telegram import (Update, ChatPermissions, ChatMember, BotCommand, InlineKeyboardButton, InlineKeyboardMarkup)
+from telegram import (Update, User, Chat, ChatPermissions, ChatMember, BotCommand, InlineKeyboardButton, InlineKeyboardMarkup, MessageEntity)
+from telegram.error import RetryAfter, TimedOut
+from telegram.request import BaseRequest, HTTPXRequest
 from telegram.ext import (
 	Application,
+	BaseUpdateProcessor,
 	CommandHandler,
 	ContextTypes,
 	MessageHandler,
 	ChatMemberHandler,
 	CallbackQueryHandler,
+	TypeHandler,
 	filters,
 )
 
 # --- Logging ---
+LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
 logging.basicConfig(
-	format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+	format=LOG_FORMAT,
 	level=logging.INFO,
 )
 logger = logging.getLogger(__name__)
@@ -33,14 +59,136 @@ logger = logging.getLogger(__name__)
 # --- Config / In-memory storage ---
 OWNER_ID = 1871352653
 
-# runtime data containers
-admins: Dict[int, Set[int]] = {}  # chat_id -> set(admin user_ids)
-warns: Dict[int, Dict[int, int]] = {}  # chat_id -> {user_id: warns_count}
-mutes: Dict[int, Dict[int, float]] = {}  # chat_id -> {user_id: mute_end_timestamp}
-banned: Dict[int, Set[int]] = {}  # chat_id -> set(banned_ids)
-recent_activity: Dict[int, Set[int]] = {}  # chat_id -> set(user_ids recently active)
-victim_of_day: Dict[int, Optional[int]] = {}  # chat_id -> user_id
-last_message_time: Dict[int, float] = {}  # chat_id -> timestamp
+# runtime chat data lives in one ChatState per chat (read-through cache over
+# `storage`, loaded lazily per chat), see chat_state()
+
+# bot identity, filled once in post_init
+BOT_ID: Optional[int] = None
+BOT_USERNAME: Optional[str] = None
+BOT_MENTION_RE: Optional["re.Pattern[str]"] = None  # matches @username case-insensitively
+# bot's own ChatMember per chat; kept fresh by my_chat_member updates, TTL as fallback
+BOT_RIGHTS_TTL = int(os.getenv("BOT_RIGHTS_TTL", "600"))
+# Telegram's own chat admins; kept fresh by chat_member updates, re-read every CHAT_ADMINS_TTL
+CHAT_ADMINS_TTL = int(os.getenv("CHAT_ADMINS_TTL", "600"))
+CHAT_ADMINS_RETRY = 60  # after a failed get_chat_administrators
+bot_rights: Dict[int, Tuple[float, ChatMember]] = {}  # chat_id -> (monotonic fetch time, bot member)
+
+# update intake: "polling" (default) or "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+# public base URL Telegram should POST to; leave empty to only listen (local testing)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+# updates waiting in Application.update_queue beyond this are refused with 503 (Telegram retries)
+WEBHOOK_MAX_PENDING = int(os.getenv("WEBHOOK_MAX_PENDING", "1000"))
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+# Bot API endpoint (instead of https://api.telegram.org/bot, e.g. a local Bot API
+# server or bench/loadtest.py) and the HTTP client pool for regular calls: at most
+# HTTP_POOL_SIZE connections, a call waits HTTP_POOL_TIMEOUT seconds for a free one
+BOT_API_URL = os.getenv("BOT_API_URL", "")
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "256"))
+HTTP_POOL_TIMEOUT = float(os.getenv("HTTP_POOL_TIMEOUT", "1"))
+
+# Prometheus text metrics on http://METRICS_LISTEN:METRICS_PORT/metrics; 0 disables metrics
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+
+# outbound messages: Telegram allows ~30 msg/s overall and ~20 msg/min per group
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", "30"))
+OUTBOX_GROUP_PER_MINUTE = float(os.getenv("OUTBOX_GROUP_PER_MINUTE", "20"))
+OUTBOX_PRIVATE_RATE = float(os.getenv("OUTBOX_PRIVATE_RATE", "1"))
+OUTBOX_CHAT_BURST = int(os.getenv("OUTBOX_CHAT_BURST", "5"))
+OUTBOX_CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", "16"))
+# chatter beyond this many queued messages is dropped instead of queued
+OUTBOX_MAX_CHATTER = int(os.getenv("OUTBOX_MAX_CHATTER", "1000"))
+
+# default silence (seconds) after which the bot pokes a chat; /silence overrides per chat
+SILENCE_THRESHOLD = int(os.getenv("SILENCE_THRESHOLD", "300"))
+
+# activity tracking: who counts as "recently active" and how many users per chat we keep
+ACTIVITY_WINDOW = int(os.getenv("ACTIVITY_WINDOW", "86400"))
+ACTIVITY_CAP = int(os.getenv("ACTIVITY_CAP", "5000"))
+# chats without updates for CHAT_IDLE_TTL seconds are dropped from memory (0 = keep them)
+CHAT_IDLE_TTL = int(os.getenv("CHAT_IDLE_TTL", "86400"))
+CHAT_EVICT_INTERVAL = 300
+# users remembered per chat for resolving @username and ID arguments without the API
+USER_INDEX_CAP = int(os.getenv("USER_INDEX_CAP", "5000"))
+
+# anti-flood: more than FLOOD_MESSAGES messages within FLOOD_SECONDS mutes the
+# sender for FLOOD_MUTE seconds (0 disables); at most FLOOD_CAP senders tracked per chat
+FLOOD_MESSAGES = int(os.getenv("FLOOD_MESSAGES", "10"))
+FLOOD_SECONDS = float(os.getenv("FLOOD_SECONDS", "5"))
+FLOOD_MUTE = int(os.getenv("FLOOD_MUTE", "300"))
+FLOOD_CAP = int(os.getenv("FLOOD_CAP", "5000"))
+
+# updates from different chats run concurrently, at most UPDATE_CONCURRENCY
+# at a time (1 = strictly one after another); a chat's own updates never overlap
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "32"))
+
+# sharding: WORKERS > 0 runs one update receiver plus WORKERS processes, each
+# owning the chats whose id maps to it; SHARD_QUEUE_SIZE updates may wait per worker
+WORKERS = int(os.getenv("WORKERS", "0"))
+SHARD_QUEUE_SIZE = int(os.getenv("SHARD_QUEUE_SIZE", "1000"))
+SHARD_STOP_TIMEOUT = float(os.getenv("SHARD_STOP_TIMEOUT", "30"))
+# set in worker processes; a single process owns every chat
+SHARD_INDEX = 0
+SHARD_COUNT = 1
+SHARD_QUEUES: List = []
+
+# roulette: default outcome weights ("name=weight ..."), seconds between spins of one user
+ROULETTE_WEIGHTS = os.getenv("ROULETTE_WEIGHTS", "")
+ROULETTE_COOLDOWN = float(os.getenv("ROULETTE_COOLDOWN", "30"))
+
+# warns: seconds one warn counts (0 = forever), default escalation ("count=action ...")
+WARN_TTL = int(os.getenv("WARN_TTL", str(7 * 24 * 3600)))
+WARN_POLICY = os.getenv("WARN_POLICY", "3=ban")
+
+# bulk moderation: parallel Bot API calls per command, targets per command, joins remembered per chat
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", "8"))
+BULK_MAX_TARGETS = int(os.getenv("BULK_MAX_TARGETS", "200"))
+RECENT_JOINS_CAP = int(os.getenv("RECENT_JOINS_CAP", "1000"))
+
+# phrase packs: PHRASES_DIR/<pack>/<category>.txt, compiled into PHRASES_CACHE;
+# sources are re-checked for changes at most every PHRASES_RELOAD_INTERVAL seconds
+PHRASES_DIR = os.getenv("PHRASES_DIR", "phrases")
+PHRASES_PACK = os.getenv("PHRASES_PACK", "default")
+PHRASES_RELOAD_INTERVAL = float(os.getenv("PHRASES_RELOAD_INTERVAL", "5"))
+
+# SQLite database for moderation state (admins, warns, mutes, bans, victims)
+DB_PATH = os.getenv("DB_PATH", "data/reaper.db")
+PHRASES_CACHE = os.getenv("PHRASES_CACHE", os.path.join(os.path.dirname(DB_PATH) or ".", "phrases"))
+# write-behind: dirty rows are flushed every STORAGE_FLUSH_INTERVAL seconds
+# or as soon as STORAGE_FLUSH_MAX rows are pending
+STORAGE_FLUSH_INTERVAL = float(os.getenv("STORAGE_FLUSH_INTERVAL", "2.0"))
+STORAGE_FLUSH_MAX = int(os.getenv("STORAGE_FLUSH_MAX", "500"))
+# the scheduler wakes this many seconds after the earliest deadline so that
+# expiries landing close together are unrestricted in one batch
+UNMUTE_BATCH_WINDOW = float(os.getenv("UNMUTE_BATCH_WINDOW", "0.5"))
+# moderation journal: JSON lines in AUDIT_DIR, a new file every AUDIT_MAX_BYTES, AUDIT_KEEP files kept
+AUDIT_DIR = os.getenv("AUDIT_DIR", os.path.join(os.path.dirname(DB_PATH) or ".", "audit"))
+AUDIT_MAX_BYTES = int(os.getenv("AUDIT_MAX_BYTES", str(10 * 1024 * 1024)))
+AUDIT_KEEP = int(os.getenv("AUDIT_KEEP", "20"))
+AUDIT_FLUSH_INTERVAL = float(os.getenv("AUDIT_FLUSH_INTERVAL", "1.0"))
+# unhandled errors: grouped by fingerprint; a new group is reported to the owner at once
+# (ERROR_ALERT_BURST alerts, then one per ERROR_ALERT_INTERVAL seconds), repeats go into
+# a digest every ERROR_DIGEST_INTERVAL seconds (0 = no digest); ERROR_GROUPS_CAP groups kept
+ERROR_DIGEST_INTERVAL = int(os.getenv("ERROR_DIGEST_INTERVAL", "3600"))
+ERROR_ALERT_BURST = int(os.getenv("ERROR_ALERT_BURST", "5"))
+ERROR_ALERT_INTERVAL = float(os.getenv("ERROR_ALERT_INTERVAL", "60"))
+ERROR_GROUPS_CAP = int(os.getenv("ERROR_GROUPS_CAP", "500"))
+# tracing: share of updates traced (0 = off, 1 = all); spans go as JSON lines to TRACE_FILE
+# (renamed to .1 past TRACE_MAX_BYTES) and/or OTLP/HTTP JSON to TRACE_OTLP_URL
+TRACE_SAMPLE = float(os.getenv("TRACE_SAMPLE", "0"))
+TRACE_FILE = os.getenv("TRACE_FILE", os.path.join(os.path.dirname(DB_PATH) or ".", "traces.jsonl"))
+TRACE_MAX_BYTES = int(os.getenv("TRACE_MAX_BYTES", str(50 * 1024 * 1024)))
+TRACE_OTLP_URL = os.getenv("TRACE_OTLP_URL", "")
+TRACE_FLUSH_INTERVAL = 1.0
+TRACE_BUFFER_MAX = 10000  # finished spans waiting for export; past that new ones are dropped
+# on shutdown: seconds to finish unmutes in flight and deliver queued messages
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "10"))
 
 # --- Phrase banks (unique phrases) ---
 GREETINGS = [
@@ -167,33 +315,1453 @@ AGGRO = [
 	"Шумите. Я люблю вылавливать жертв молчания.",
 ]
 
-# --- Helpers ---
-def ensure_chat_structs(chat_id: int):
-	admins.setdefault(chat_id, set())
-	warns.setdefault(chat_id, {})
-	mutes.setdefault(chat_id, {})
-	banned.setdefault(chat_id, set())
-	recent_activity.setdefault(chat_id, set())
-	victim_of_day.setdefault(chat_id, None)
-	last_message_time.setdefault(chat_id, datetime.utcnow().timestamp())
+# auto-reply pool, merged once instead of on every reply
+CHATTER_PHRASES = VANILLA + AGGRO
+
+# --- Phrase packs ---
+BUILTIN_PHRASES = {
+	"greetings": GREETINGS,
+	"farewells": FAREWELLS,
+	"roasts": ROASTS,
+	"vanilla": VANILLA,
+	"aggro": AGGRO,
+	"chatter": CHATTER_PHRASES,
+}
+PHRASES_MAGIC = b"RPH1"
+PACK_NAME_RE = re.compile(r"[\w-]{1,32}")
+
+def compile_phrases(src: str, dst: str) -> int:
+	# one phrase per line, blank lines and '#' comments skipped. Output:
+	# magic, uint32 count, uint32 offsets[count + 1], then the UTF-8 texts
+	texts = []
+	with open(src, encoding="utf-8") as f:
+		for line in f:
+			line = line.strip()
+			if line and not line.startswith("#"):
+				texts.append(line.encode())
+	offsets = [0]
+	for text in texts:
+		offsets.append(offsets[-1] + len(text))
+	os.makedirs(os.path.dirname(dst), exist_ok=True)
+	tmp = dst + ".tmp"
+	with open(tmp, "wb") as f:
+		f.write(PHRASES_MAGIC + struct.pack("<I", len(texts)))
+		f.write(struct.pack(f"<{len(offsets)}I", *offsets))
+		f.writelines(texts)
+	os.replace(tmp, dst)
+	return len(texts)
+
+class CompiledPhrases:
+	# a compiled phrase file, memory-mapped; only drawn phrases are decoded
+	__slots__ = ("count", "_mm", "_base")
+
+	def __init__(self, path: str):
+		with open(path, "rb") as f:
+			self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		if self._mm[:4] != PHRASES_MAGIC:
+			self._mm.close()
+			raise ValueError(f"{path} is not a compiled phrase file")
+		(self.count,) = struct.unpack_from("<I", self._mm, 4)
+		self._base = 8 + 4 * (self.count + 1)
+
+	def __len__(self) -> int:
+		return self.count
+
+	def __getitem__(self, i: int) -> str:
+		start, end = struct.unpack_from("<II", self._mm, 8 + 4 * i)
+		return self._mm[self._base + start:self._base + end].decode()
+
+	def close(self):
+		self._mm.close()
+
+class ChainedPhrases:
+	# several sources seen as one sequence, without copying
+	__slots__ = ("parts",)
+
+	def __init__(self, *parts):
+		self.parts = parts
+
+	def __len__(self) -> int:
+		return sum(len(part) for part in self.parts)
+
+	def __getitem__(self, i: int) -> str:
+		for part in self.parts:
+			if i < len(part):
+				return part[i]
+			i -= len(part)
+		raise IndexError(i)
+
+class ShuffleBag:
+	# Fisher-Yates done lazily: `_swaps` records only the positions that were
+	# touched, so a draw is O(1) and memory grows with draws, not with the
+	# pack. Every phrase comes up once per round, and the last phrase of a
+	# round is held out of the next one so it never repeats back to back.
+	__slots__ = ("pack", "size", "left", "last", "_swaps")
+
+	def __init__(self, pack: str, size: int):
+		self.pack = pack
+		self.size = size
+		self.left = 0
+		self.last = -1
+		self._swaps: Dict[int, int] = {}
+
+	def draw(self) -> int:
+		if self.left == 0:
+			self._refill()
+		j = random.randrange(self.left)
+		self.left -= 1
+		value = self._swaps.get(j, j)
+		self._swaps[j] = self._swaps.pop(self.left, self.left)
+		self.last = value
+		return value
+
+	def _refill(self):
+		self._swaps = {}
+		self.left = self.size
+		if self.size > 1 and 0 <= self.last < self.size:
+			# swap the previous phrase into the slot just past the round
+			self.left -= 1
+			if self.last != self.left:
+				self._swaps[self.last] = self.left
+
+class PhraseBook:
+	# A pack is a directory PHRASES_DIR/<pack> with one text file per
+	# category (greetings.txt, roasts.txt, ...). Each file is compiled once
+	# into PHRASES_CACHE and memory-mapped, so opening a pack costs the same
+	# for ten phrases or fifty thousand. A source that changed on disk is
+	# recompiled on the first draw after PHRASES_RELOAD_INTERVAL. Categories
+	# a pack lacks come from the built-in lists; "default" is the built-in pack.
+
+	def __init__(self, root: str, cache: str, interval: float):
+		self.root = root
+		self.cache = cache
+		self.interval = interval
+		# (pack, category) -> (checked at, source mtime, compiled file)
+		self._files: Dict[Tuple[str, str], Tuple[float, Optional[float], Optional[CompiledPhrases]]] = {}
+		self._bags: Dict[Tuple[int, str], ShuffleBag] = {}
+
+	def packs(self) -> List[str]:
+		try:
+			names = sorted(e.name for e in os.scandir(self.root) if e.is_dir() and PACK_NAME_RE.fullmatch(e.name))
+		except OSError:
+			names = []
+		return ["default"] + [name for name in names if name != "default"]
+
+	def has_pack(self, name: str) -> bool:
+		return name == "default" or (PACK_NAME_RE.fullmatch(name) is not None and os.path.isdir(os.path.join(self.root, name)))
+
+	def phrases(self, pack: str, category: str):
+		if pack != "default":
+			compiled = self._load(pack, category)
+			if compiled:
+				return compiled
+			if category == "chatter":
+				return ChainedPhrases(self.phrases(pack, "vanilla"), self.phrases(pack, "aggro"))
+		return BUILTIN_PHRASES[category]
+
+	def draw(self, chat_id: int, category: str) -> str:
+		pack = chat_state(chat_id).phrase_pack or PHRASES_PACK
+		source = self.phrases(pack, category)
+		key = (chat_id, category)
+		bag = self._bags.get(key)
+		if bag is None or bag.pack != pack or bag.size != len(source):
+			bag = self._bags[key] = ShuffleBag(pack, len(source))
+		return source[bag.draw()]
+
+	def forget(self, chat_id: int):
+		for category in BUILTIN_PHRASES:
+			self._bags.pop((chat_id, category), None)
+
+	def _load(self, pack: str, category: str) -> Optional[CompiledPhrases]:
+		key = (pack, category)
+		now = time.monotonic()
+		entry = self._files.get(key)
+		if entry is not None and now - entry[0] < self.interval:
+			return entry[2]
+		src = os.path.join(self.root, pack, category + ".txt")
+		try:
+			mtime = os.stat(src).st_mtime
+		except OSError:
+			mtime = None
+		compiled = entry[2] if entry is not None else None
+		if entry is None or entry[1] != mtime:
+			if compiled is not None:
+				compiled.close()
+				compiled = None
+			if mtime is not None:
+				try:
+					compiled = self._compiled(src, os.path.join(self.cache, pack, category + ".phr"), mtime)
+				except Exception:
+					logger.exception("Не удалось загрузить фразы %s/%s", pack, category)
+		if compiled is not None and not len(compiled):
+			compiled = None
+		self._files[key] = (now, mtime, compiled)
+		return compiled
+
+	def _compiled(self, src: str, dst: str, mtime: float) -> CompiledPhrases:
+		try:
+			fresh = os.stat(dst).st_mtime >= mtime
+		except OSError:
+			fresh = False
+		if not fresh:
+			count = compile_phrases(src, dst)
+			logger.info("Compiled %s: %d phrases", src, count)
+		return CompiledPhrases(dst)
+
+phrase_book = PhraseBook(PHRASES_DIR, PHRASES_CACHE, PHRASES_RELOAD_INTERVAL)
+
+# --- Activity tracking ---
+class ActivityWindow:
+	# Users seen within the last `window` seconds, at most `cap` of them.
+	# `_seen` is ordered oldest-first so expiry and LRU eviction pop from the
+	# front; `_users`/`_pos` mirror the keys as an array for O(1) sampling.
+	# `_head_ts` is a lower bound of the oldest timestamp, so touch() only
+	# walks the front when something can actually have expired.
+	__slots__ = ("window", "cap", "_seen", "_users", "_pos", "_head_ts")
+
+	def __init__(self, window: int = ACTIVITY_WINDOW, cap: int = ACTIVITY_CAP):
+		self.window = window
+		self.cap = cap
+		self._seen: "OrderedDict[int, float]" = OrderedDict()
+		self._users: List[int] = []
+		self._pos: Dict[int, int] = {}
+		self._head_ts = 0.0
+
+	def __len__(self) -> int:
+		return len(self._users)
+
+	def __contains__(self, user_id: int) -> bool:
+		return user_id in self._seen
+
+	def nbytes(self) -> int:
+		# the three containers plus an int key and a float per user, roughly
+		return sys.getsizeof(self._seen) + sys.getsizeof(self._users) + sys.getsizeof(self._pos) + 80 * len(self._users)
+
+	def touch(self, user_id: int, now: float):
+		if user_id in self._seen:
+			self._seen.move_to_end(user_id)
+			self._seen[user_id] = now
+		else:
+			self._seen[user_id] = now
+			self._pos[user_id] = len(self._users)
+			self._users.append(user_id)
+			if len(self._users) > self.cap:
+				self._drop(self._seen.popitem(last=False)[0])
+		if now - self.window > self._head_ts:
+			self.prune(now)
+
+	def prune(self, now: float):
+		deadline = now - self.window
+		while self._seen:
+			user_id, ts = next(iter(self._seen.items()))
+			if ts >= deadline:
+				self._head_ts = ts
+				return
+			del self._seen[user_id]
+			self._drop(user_id)
+		self._head_ts = now
+
+	def sample(self, now: float) -> Optional[int]:
+		self.prune(now)
+		return random.choice(self._users) if self._users else None
+
+	def _drop(self, user_id: int):
+		# swap-remove from the sampling array
+		i = self._pos.pop(user_id)
+		last = self._users.pop()
+		if last != user_id:
+			self._users[i] = last
+			self._pos[last] = i
+
+# --- User index ---
+class KnownUser:
+	__slots__ = ("id", "username", "first_name", "last_name", "seen")
+
+	def __init__(self, user: User, seen: float):
+		self.id = user.id
+		self.username = user.username
+		self.first_name = user.first_name
+		self.last_name = user.last_name
+		self.seen = seen
+
+	def as_user(self) -> User:
+		return User(self.id, self.first_name, False, last_name=self.last_name, username=self.username)
+
+class UserIndex:
+	# Who the bot has seen in each chat, filled from ordinary traffic so that
+	# commands can resolve @username and ID arguments without get_chat_member.
+	# Per chat: an OrderedDict id -> KnownUser in last-seen order (LRU,
+	# capped at `cap`) and a lowercase username -> id map kept in step.
+
+	def __init__(self, cap: int):
+		self.cap = cap
+		self._users: Dict[int, "OrderedDict[int, KnownUser]"] = {}
+		self._names: Dict[int, Dict[str, int]] = {}
+
+	def __len__(self) -> int:
+		return sum(len(users) for users in self._users.values())
+
+	def see(self, chat_id: int, user: User, now: float):
+		users = self._users.get(chat_id)
+		if users is None:
+			users = self._users[chat_id] = OrderedDict()
+			self._names[chat_id] = {}
+		known = users.get(user.id)
+		if known is not None and known.username == user.username and known.first_name == user.first_name and known.last_name == user.last_name:
+			# the common case: just bump
+			known.seen = now
+			users.move_to_end(user.id)
+			return
+		if known is not None:
+			self._drop_name(chat_id, known)
+		users[user.id] = KnownUser(user, now)
+		users.move_to_end(user.id)
+		if user.username:
+			self._names[chat_id][user.username.lower()] = user.id
+		if len(users) > self.cap:
+			_, evicted = users.popitem(last=False)
+			self._drop_name(chat_id, evicted)
+
+	def forget(self, chat_id: int, user_id: Optional[int] = None):
+		if user_id is None:
+			self._users.pop(chat_id, None)
+			self._names.pop(chat_id, None)
+			return
+		known = self._users.get(chat_id, {}).pop(user_id, None)
+		if known is not None:
+			self._drop_name(chat_id, known)
+
+	def lookup(self, chat_id: int, ref: str) -> Optional[User]:
+		# ref: numeric ID or username, with or without '@'
+		user_id = parse_user_id(ref)
+		if user_id is None:
+			user_id = self._names.get(chat_id, {}).get(ref.lstrip("@").lower())
+		known = self._users.get(chat_id, {}).get(user_id) if user_id is not None else None
+		return known.as_user() if known is not None else None
+
+	async def resolve(self, chat_id: int, refs: List[str], bot) -> List[Optional[User]]:
+		# local first; numeric IDs that are not known go to the API, all at once.
+		# Usernames cannot be looked up through the Bot API, so a miss stays None
+		found = [self.lookup(chat_id, ref) for ref in refs]
+		missing = [i for i, user in enumerate(found) if user is None and parse_user_id(refs[i]) is not None]
+		if missing:
+			members = await asyncio.gather(*(bot.get_chat_member(chat_id, parse_user_id(refs[i])) for i in missing), return_exceptions=True)
+			for i, member in zip(missing, members):
+				if isinstance(member, Exception):
+					logger.debug("get_chat_member %s in %s failed: %s", refs[i], chat_id, member)
+					continue
+				found[i] = member.user
+				self.see(chat_id, member.user, time.time())
+		return found
+
+	def _drop_name(self, chat_id: int, known: KnownUser):
+		names = self._names.get(chat_id)
+		if known.username and names is not None and names.get(known.username.lower()) == known.id:
+			del names[known.username.lower()]
+
+def parse_user_id(ref: str) -> Optional[int]:
+	try:
+		return int(ref)
+	except ValueError:
+		return None
+
+user_index = UserIndex(USER_INDEX_CAP)
+
+# --- Persistent storage ---
+class Storage:
+	# SQLite (WAL) behind the in-memory dicts. Handlers only touch the dicts and
+	# queue row changes here; a background task coalesces them and commits in
+	# batches from a worker thread, so no command waits on disk.
+	SCHEMA = """
+	CREATE TABLE IF NOT EXISTS admins (chat_id INTEGER, user_id INTEGER, PRIMARY KEY (chat_id, user_id)) WITHOUT ROWID;
+	CREATE TABLE IF NOT EXISTS warn_stamps (chat_id INTEGER, user_id INTEGER, stamps TEXT, PRIMARY KEY (chat_id, user_id)) WITHOUT ROWID;
+	CREATE TABLE IF NOT EXISTS warn_policy (chat_id INTEGER PRIMARY KEY, policy TEXT);
+	CREATE TABLE IF NOT EXISTS mutes (chat_id INTEGER, user_id INTEGER, until REAL, PRIMARY KEY (chat_id, user_id)) WITHOUT ROWID;
+	CREATE TABLE IF NOT EXISTS banned (chat_id INTEGER, user_id INTEGER, PRIMARY KEY (chat_id, user_id)) WITHOUT ROWID;
+	CREATE TABLE IF NOT EXISTS victims (chat_id INTEGER PRIMARY KEY, user_id INTEGER);
+	CREATE TABLE IF NOT EXISTS silence (chat_id INTEGER PRIMARY KEY, seconds INTEGER);
+	CREATE TABLE IF NOT EXISTS phrases (chat_id INTEGER PRIMARY KEY, pack TEXT);
+	CREATE TABLE IF NOT EXISTS roulette (chat_id INTEGER PRIMARY KEY, weights TEXT);
+	CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT);
+	"""
+	UPSERT = {
+		"admins": "INSERT OR IGNORE INTO admins (chat_id, user_id) VALUES (?, ?)",
+		"warn_stamps": "INSERT OR REPLACE INTO warn_stamps (chat_id, user_id, stamps) VALUES (?, ?, ?)",
+		"warn_policy": "INSERT OR REPLACE INTO warn_policy (chat_id, policy) VALUES (?, ?)",
+		"mutes": "INSERT OR REPLACE INTO mutes (chat_id, user_id, until) VALUES (?, ?, ?)",
+		"banned": "INSERT OR IGNORE INTO banned (chat_id, user_id) VALUES (?, ?)",
+		"victims": "INSERT OR REPLACE INTO victims (chat_id, user_id) VALUES (?, ?)",
+		"silence": "INSERT OR REPLACE INTO silence (chat_id, seconds) VALUES (?, ?)",
+		"phrases": "INSERT OR REPLACE INTO phrases (chat_id, pack) VALUES (?, ?)",
+		"roulette": "INSERT OR REPLACE INTO roulette (chat_id, weights) VALUES (?, ?)",
+		"settings": "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+	}
+	DELETE = {
+		"admins": "DELETE FROM admins WHERE chat_id = ? AND user_id = ?",
+		"warn_stamps": "DELETE FROM warn_stamps WHERE chat_id = ? AND user_id = ?",
+		"warn_policy": "DELETE FROM warn_policy WHERE chat_id = ?",
+		"mutes": "DELETE FROM mutes WHERE chat_id = ? AND user_id = ?",
+		"banned": "DELETE FROM banned WHERE chat_id = ? AND user_id = ?",
+		"victims": "DELETE FROM victims WHERE chat_id = ?",
+		"silence": "DELETE FROM silence WHERE chat_id = ?",
+		"phrases": "DELETE FROM phrases WHERE chat_id = ?",
+		"roulette": "DELETE FROM roulette WHERE chat_id = ?",
+		"settings": "DELETE FROM settings WHERE key = ?",
+	}
+	# tables keyed by a single column
+	SINGLE_KEY = ("victims", "silence", "phrases", "roulette", "warn_policy", "settings")
+
+	def __init__(self, path: str):
+		self.path = path
+		self._reader: Optional[sqlite3.Connection] = None
+		self._writer: Optional[sqlite3.Connection] = None
+		# (table, key...) -> full row for upsert, or None for delete; last write wins
+		self._pending: Dict[tuple, Optional[tuple]] = {}
+		self._flush_lock = asyncio.Lock()
+		self._wakeup = asyncio.Event()
+		self._task: Optional[asyncio.Task] = None
+
+	def _connect(self) -> sqlite3.Connection:
+		conn = sqlite3.connect(self.path, check_same_thread=False)
+		conn.execute("PRAGMA journal_mode=WAL")
+		conn.execute("PRAGMA synchronous=NORMAL")
+		return conn
+
+	def open(self):
+		if self._reader is not None:
+			return
+		os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+		# loop thread reads, the flush thread writes; WAL lets them run side by side
+		self._writer = self._connect()
+		self._writer.executescript(self.SCHEMA)
+		self._migrate()
+		self._reader = self._connect()
+
+	def _migrate(self):
+		# warns used to be a bare count per user: carry them over as warns issued now
+		try:
+			with self._writer:
+				rows = self._writer.execute("SELECT chat_id, user_id, count FROM warns").fetchall()
+				now = str(int(time.time()))
+				self._writer.executemany(
+					"INSERT OR IGNORE INTO warn_stamps (chat_id, user_id, stamps) VALUES (?, ?, ?)",
+					[(chat_id, user_id, ",".join([now] * count)) for chat_id, user_id, count in rows if count > 0],
+				)
+				self._writer.execute("DROP TABLE warns")
+		except sqlite3.OperationalError:
+			return  # no legacy table
+		logger.info("Перенесены варны старого формата: %d записей", len(rows))
+
+	def query(self, sql: str, params: tuple = ()) -> List[tuple]:
+		self.open()
+		return self._reader.execute(sql, params).fetchall()
+
+	def put(self, table: str, *row):
+		# row starts with the primary key columns, see UPSERT
+		key = row[:1] if table in self.SINGLE_KEY else row[:2]
+		self._pending[(table,) + key] = row
+		self._kick()
+
+	def delete(self, table: str, *key):
+		self._pending[(table,) + key] = None
+		self._kick()
+
+	def get_setting(self, key: str) -> Optional[str]:
+		pending = self._pending.get(("settings", key), False)
+		if pending is not False:
+			return pending[1] if pending else None
+		rows = self.query("SELECT value FROM settings WHERE key = ?", (key,))
+		return rows[0][0] if rows else None
+
+	def set_setting(self, key: str, value: str):
+		self.put("settings", key, value)
+
+	def pending(self) -> int:
+		return len(self._pending)
+
+	def pending_chats(self) -> Set[int]:
+		# chats with rows still waiting for a flush
+		return {key[1] for key in self._pending if key[0] != "settings"}
+
+	def _kick(self):
+		if len(self._pending) >= STORAGE_FLUSH_MAX:
+			self._wakeup.set()
+
+	def _write(self, batch: Dict[tuple, Optional[tuple]]):
+		self.open()
+		with self._writer:
+			for key, row in batch.items():
+				table = key[0]
+				if row is None:
+					self._writer.execute(self.DELETE[table], key[1:])
+				else:
+					self._writer.execute(self.UPSERT[table], row)
+
+	async def flush(self):
+		async with self._flush_lock:
+			if not self._pending:
+				return
+			batch, self._pending = self._pending, {}
+			try:
+				await asyncio.to_thread(self._write, batch)
+			except Exception:
+				logger.exception("Не удалось сохранить %d записей, повторим позже", len(batch))
+				# keep newer writes that arrived while we were flushing
+				batch.update(self._pending)
+				self._pending = batch
+
+	def start(self):
+		self.open()
+		self._task = asyncio.create_task(self._run())
+
+	async def stop(self):
+		if self._task:
+			self._task.cancel()
+			try:
+				await self._task
+			except asyncio.CancelledError:
+				pass
+			self._task = None
+		await self.flush()
+
+	async def _run(self):
+		while True:
+			try:
+				await asyncio.wait_for(self._wakeup.wait(), STORAGE_FLUSH_INTERVAL)
+			except asyncio.TimeoutError:
+				pass
+			self._wakeup.clear()
+			await self.flush()
+
+storage = Storage(DB_PATH)
+
+# --- Moderation journal ---
+class AuditJournal:
+	# Every moderation action as one JSON line in AUDIT_DIR/modlog-<shard>-<seq>.jsonl.
+	# record() only appends to a list; a background task hands batches to a
+	# thread that appends them to the current file, starts a new file past
+	# AUDIT_MAX_BYTES (keeping the newest AUDIT_KEEP per shard), and adds
+	# (chat, target, actor, ts) -> (file, offset) rows to a small SQLite
+	# index next to the files. /modlog looks up offsets there and reads only
+	# the lines it shows.
+	INDEX_SCHEMA = """
+	CREATE TABLE IF NOT EXISTS entries (chat_id INTEGER, target INTEGER, actor INTEGER, ts REAL, file TEXT, offset INTEGER);
+	CREATE INDEX IF NOT EXISTS entries_chat ON entries (chat_id, ts);
+	CREATE INDEX IF NOT EXISTS entries_target ON entries (chat_id, target, ts);
+	CREATE INDEX IF NOT EXISTS entries_actor ON entries (chat_id, actor, ts);
+	"""
+
+	def __init__(self, directory: str, max_bytes: int, keep: int):
+		self.directory = directory
+		self.max_bytes = max_bytes
+		self.keep = keep
+		self._buffer: List[dict] = []
+		self._unindexed: List[tuple] = []  # index rows of lines already in a file
+		self._seq = 0
+		self._index: Optional[sqlite3.Connection] = None
+		self._flush_lock = asyncio.Lock()
+		self._wakeup = asyncio.Event()
+		self._task: Optional[asyncio.Task] = None
+
+	def record(self, chat_id: int, action: str, actor: Optional[int], target: Optional[int], **detail):
+		entry = {"ts": round(time.time(), 3), "chat": chat_id, "action": action, "actor": actor, "target": target}
+		entry.update(detail)
+		self._buffer.append(entry)
+		if len(self._buffer) >= STORAGE_FLUSH_MAX:
+			self._wakeup.set()
+
+	def pending(self) -> int:
+		return len(self._buffer)
+
+	def open(self):
+		if self._index is not None:
+			return
+		os.makedirs(self.directory, exist_ok=True)
+		self._index = sqlite3.connect(os.path.join(self.directory, "index.db"), check_same_thread=False)
+		self._index.execute("PRAGMA journal_mode=WAL")
+		self._index.executescript(self.INDEX_SCHEMA)
+		own = self._own_files()
+		self._seq = own[-1][0] if own else 0
+
+	def start(self):
+		self.open()
+		self._task = asyncio.create_task(self._run())
+
+	async def stop(self):
+		if self._task:
+			self._task.cancel()
+			try:
+				await self._task
+			except asyncio.CancelledError:
+				pass
+			self._task = None
+		await self.flush()
+
+	async def flush(self):
+		async with self._flush_lock:
+			if not self._buffer and not self._unindexed:
+				return
+			batch, self._buffer = self._buffer, []
+			try:
+				await asyncio.to_thread(self._write, batch)
+			except Exception:
+				logger.exception("Не удалось записать журнал модерации (%d записей), повторим позже", len(batch) + len(self._unindexed))
+				# what did not reach the file goes back in front of newer records
+				batch.extend(self._buffer)
+				self._buffer = batch
+
+	async def query(self, chat_id: int, user_id: Optional[int] = None, limit: int = 10) -> List[dict]:
+		# newest first; the user may be the target or the one who acted
+		await self.flush()
+		return await asyncio.to_thread(self._read, chat_id, user_id, limit)
+
+	async def _run(self):
+		while True:
+			try:
+				await asyncio.wait_for(self._wakeup.wait(), AUDIT_FLUSH_INTERVAL)
+			except asyncio.TimeoutError:
+				pass
+			self._wakeup.clear()
+			await self.flush()
+
+	def _name(self, seq: int) -> str:
+		return f"modlog-{SHARD_INDEX}-{seq:06d}.jsonl"
+
+	def _own_files(self) -> List[Tuple[int, str]]:
+		prefix = f"modlog-{SHARD_INDEX}-"
+		files = []
+		for name in os.listdir(self.directory):
+			if name.startswith(prefix) and name.endswith(".jsonl"):
+				try:
+					files.append((int(name[len(prefix):-6]), name))
+				except ValueError:
+					pass
+		return sorted(files)
+
+	def _write(self, batch: List[dict]):
+		# Lines that reached the file leave `batch` and wait in _unindexed until
+		# their index rows commit, so a failure at either step is retried on the
+		# next flush without losing or duplicating a record. Unbuffered writes
+		# keep "written" honest.
+		done = 0
+		rotated = False
+		name = self._name(self._seq)
+		f = open(os.path.join(self.directory, name), "ab", buffering=0)
+		try:
+			for entry in batch:
+				line = (json.dumps(entry, ensure_ascii=False) + "\n").encode()
+				offset = f.tell()
+				if offset and offset + len(line) > self.max_bytes:
+					f.close()
+					self._seq += 1
+					name = self._name(self._seq)
+					f = open(os.path.join(self.directory, name), "ab", buffering=0)
+					offset = 0
+					rotated = True
+				f.write(line)
+				self._unindexed.append((entry["chat"], entry["target"], entry["actor"], entry["ts"], name, offset))
+				done += 1
+		finally:
+			f.close()
+			del batch[:done]
+		with self._index:
+			self._index.executemany("INSERT INTO entries (chat_id, target, actor, ts, file, offset) VALUES (?, ?, ?, ?, ?, ?)", self._unindexed)
+		self._unindexed.clear()
+		if rotated:
+			self._prune()
+
+	def _prune(self):
+		own = self._own_files()
+		for _, name in own[:max(0, len(own) - self.keep)]:
+			os.remove(os.path.join(self.directory, name))
+			with self._index:
+				self._index.execute("DELETE FROM entries WHERE file = ?", (name,))
+
+	def _read(self, chat_id: int, user_id: Optional[int], limit: int) -> List[dict]:
+		conn = sqlite3.connect(os.path.join(self.directory, "index.db"))
+		try:
+			if user_id is None:
+				rows = conn.execute("SELECT file, offset FROM entries WHERE chat_id = ? ORDER BY ts DESC, rowid DESC LIMIT ?", (chat_id, limit)).fetchall()
+			else:
+				rows = conn.execute(
+					"SELECT file, offset FROM entries WHERE chat_id = ? AND (target = ? OR actor = ?) ORDER BY ts DESC, rowid DESC LIMIT ?",
+					(chat_id, user_id, user_id, limit),
+				).fetchall()
+		finally:
+			conn.close()
+		entries = []
+		handles = {}
+		try:
+			for name, offset in rows:
+				f = handles.get(name)
+				if f is None:
+					try:
+						f = handles[name] = open(os.path.join(self.directory, name), "rb")
+					except OSError:
+						continue  # rotated away meanwhile
+				f.seek(offset)
+				entries.append(json.loads(f.readline()))
+		finally:
+			for f in handles.values():
+				f.close()
+		return entries
+
+journal = AuditJournal(AUDIT_DIR, AUDIT_MAX_BYTES, AUDIT_KEEP)
+
+# --- Tracing ---
+current_span: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+
+class Span:
+	__slots__ = ("trace_id", "span_id", "parent_id", "name", "kind", "start", "end", "attrs", "error")
+
+	def __init__(self, name: str, trace_id: str, span_id: str, parent_id: Optional[str], kind: str, attrs: dict):
+		self.trace_id = trace_id
+		self.span_id = span_id
+		self.parent_id = parent_id
+		self.name = name
+		self.kind = kind  # "internal", or "client" for Bot API requests
+		self.start = time.time_ns()
+		self.end = 0
+		self.attrs = attrs
+		self.error: Optional[str] = None
+
+	def to_dict(self) -> dict:
+		return {
+			"trace_id": self.trace_id,
+			"span_id": self.span_id,
+			"parent_id": self.parent_id,
+			"name": self.name,
+			"kind": self.kind,
+			"start_ns": self.start,
+			"duration_ms": round((self.end - self.start) / 1e6, 3),
+			"attrs": self.attrs,
+			"error": self.error,
+		}
+
+	def to_otlp(self) -> dict:
+		span = {
+			"traceId": self.trace_id,
+			"spanId": self.span_id,
+			"name": self.name,
+			"kind": 3 if self.kind == "client" else 1,
+			"startTimeUnixNano": str(self.start),
+			"endTimeUnixNano": str(self.end),
+			"attributes": [otlp_attribute(k, v) for k, v in self.attrs.items()],
+			"status": {"code": 2, "message": self.error} if self.error else {"code": 1},
+		}
+		if self.parent_id:
+			span["parentSpanId"] = self.parent_id
+		return span
+
+def otlp_attribute(key: str, value) -> dict:
+	if isinstance(value, bool):
+		return {"key": key, "value": {"boolValue": value}}
+	if isinstance(value, int):
+		return {"key": key, "value": {"intValue": str(value)}}
+	if isinstance(value, float):
+		return {"key": key, "value": {"doubleValue": value}}
+	return {"key": key, "value": {"stringValue": str(value)}}
+
+def update_kind(update: Update) -> str:
+	for kind in ("message", "edited_message", "callback_query", "chat_member", "my_chat_member"):
+		if getattr(update, kind) is not None:
+			return kind
+	return "other"
+
+class Tracer:
+	# Spans for a sampled share of updates: one per update, one per handler
+	# run under it, one per Bot API request under those. Outbox sends keep
+	# the span that queued them and open theirs at submit, so queue wait shows
+	# up as the gap before the request. The current span lives in a ContextVar;
+	# an unsampled update never sets it, so every hook below is one lookup.
+	# Finished spans are buffered and exported once a second in the background.
+
+	def __init__(self, sample: float):
+		self.sample = sample
+		self.enabled = sample > 0
+		self.exported = 0
+		self.dropped = 0
+		self._ids = random.Random()
+		self._buffer: List[Span] = []
+		self._client: Optional[httpx.AsyncClient] = None
+		self._flush_lock = asyncio.Lock()
+		self._task: Optional[asyncio.Task] = None
+
+	def start_trace(self, update: object) -> Optional[Span]:
+		# the root span of an update, or None when it is not sampled
+		if not isinstance(update, Update) or self._ids.random() >= self.sample:
+			return None
+		chat = update.effective_chat
+		user = update.effective_user
+		attrs = {"update_id": update.update_id, "update.kind": update_kind(update)}
+		if chat:
+			attrs["chat_id"] = chat.id
+		if user:
+			attrs["user_id"] = user.id
+		return Span("update", f"{self._ids.getrandbits(128):032x}", f"{self._ids.getrandbits(64):016x}", None, "internal", attrs)
+
+	def start_span(self, name: str, kind: str = "internal", **attrs) -> Optional[Span]:
+		# a child of the current span, None outside a sampled update
+		parent = current_span.get()
+		if parent is None:
+			return None
+		return Span(name, parent.trace_id, f"{self._ids.getrandbits(64):016x}", parent.span_id, kind, attrs)
+
+	def finish(self, span: Span, error: Optional[BaseException] = None):
+		span.end = time.time_ns()
+		if error is not None:
+			span.error = f"{type(error).__name__}: {error}"
+		if len(self._buffer) >= TRACE_BUFFER_MAX:
+			self.dropped += 1
+			return
+		self._buffer.append(span)
+
+	def bind(self, factory: Callable[[], Awaitable]) -> Callable[[], Awaitable]:
+		# for the outbox: run `factory` later under a span opened now
+		span = self.start_span("outbox")
+		if span is None:
+			return factory
+
+		async def bound():
+			token = current_span.set(span)
+			try:
+				result = await factory()
+			except RetryAfter:
+				# the outbox sends it again later under the same span
+				span.attrs["flood_waits"] = span.attrs.get("flood_waits", 0) + 1
+				raise
+			except Exception as e:
+				self.finish(span, e)
+				raise
+			finally:
+				current_span.reset(token)
+			self.finish(span)
+			return result
+		return bound
+
+	def start(self):
+		if not self.enabled:
+			return
+		if TRACE_OTLP_URL:
+			self._client = httpx.AsyncClient(timeout=5)
+		self._task = asyncio.create_task(self._run())
+
+	async def stop(self):
+		if self._task:
+			self._task.cancel()
+			try:
+				await self._task
+			except asyncio.CancelledError:
+				pass
+			self._task = None
+		await self.flush()
+		if self._client:
+			await self._client.aclose()
+			self._client = None
+
+	async def flush(self):
+		async with self._flush_lock:
+			if not self._buffer:
+				return
+			batch, self._buffer = self._buffer, []
+			try:
+				if TRACE_FILE:
+					await asyncio.to_thread(self._write, batch)
+				if self._client:
+					await self._post(batch)
+				self.exported += len(batch)
+			except Exception as e:
+				self.dropped += len(batch)
+				logger.warning("Не удалось выгрузить трассы (%d спанов): %s", len(batch), e)
+
+	async def _run(self):
+		while True:
+			await asyncio.sleep(TRACE_FLUSH_INTERVAL)
+			await self.flush()
+
+	def _path(self) -> str:
+		if SHARD_COUNT == 1:
+			return TRACE_FILE
+		base, ext = os.path.splitext(TRACE_FILE)
+		return f"{base}-{SHARD_INDEX}{ext}"
+
+	def _write(self, batch: List[Span]):
+		path = self._path()
+		os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+		try:
+			if os.path.getsize(path) > TRACE_MAX_BYTES:
+				os.replace(path, path + ".1")
+		except OSError:
+			pass
+		with open(path, "a", encoding="utf-8") as f:
+			f.write("".join(json.dumps(span.to_dict(), ensure_ascii=False) + "\n" for span in batch))
+
+	async def _post(self, batch: List[Span]):
+		body = {"resourceSpans": [{
+			"resource": {"attributes": [otlp_attribute("service.name", "vanilla-reaper-bot"), otlp_attribute("shard", SHARD_INDEX)]},
+			"scopeSpans": [{"scope": {"name": __name__}, "spans": [span.to_otlp() for span in batch]}],
+		}]}
+		response = await self._client.post(TRACE_OTLP_URL, json=body)
+		response.raise_for_status()
+
+tracer = Tracer(TRACE_SAMPLE)
+
+class TraceLogFilter(logging.Filter):
+	# log records get trace_id/span_id, and a " trace=… span=…" suffix in the text
+	def filter(self, record: logging.LogRecord) -> bool:
+		span = current_span.get()
+		record.trace_id = span.trace_id if span else ""
+		record.span_id = span.span_id if span else ""
+		record.trace = f" trace={span.trace_id} span={span.span_id}" if span else ""
+		return True
+
+if tracer.enabled:
+	for _handler in logging.getLogger().handlers:
+		_handler.addFilter(TraceLogFilter())
+		_handler.setFormatter(logging.Formatter(LOG_FORMAT + "%(trace)s"))
+
+# --- Outbound queue ---
+# priority classes, lower is sent first
+PRIO_MODERATION = 0
+PRIO_NORMAL = 1
+PRIO_CHATTER = 2
+PRIORITIES = (PRIO_MODERATION, PRIO_NORMAL, PRIO_CHATTER)
+
+class TokenBucket:
+	__slots__ = ("rate", "capacity", "tokens", "stamp")
+
+	def __init__(self, rate: float, capacity: float):
+		self.rate = rate
+		self.capacity = capacity
+		self.tokens = capacity
+		self.stamp = time.monotonic()
+
+	def delay(self, now: float) -> float:
+		# seconds until one token is available, 0 if it is already there
+		self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+		self.stamp = now
+		return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+	def take(self):
+		self.tokens -= 1
+
+class _ChatOutbox:
+	__slots__ = ("queues", "bucket", "parked_until", "inflight")
+
+	def __init__(self, chat_id: int):
+		self.queues: List[Deque] = [deque() for _ in PRIORITIES]
+		if chat_id > 0:
+			self.bucket = TokenBucket(OUTBOX_PRIVATE_RATE, OUTBOX_CHAT_BURST)
+		else:
+			self.bucket = TokenBucket(OUTBOX_GROUP_PER_MINUTE / 60, OUTBOX_CHAT_BURST)
+		self.parked_until = 0.0
+		self.inflight = 0  # sends handed to _deliver and not finished yet
+
+	def empty(self) -> bool:
+		return not any(self.queues)
+
+def retry_after_seconds(e: RetryAfter) -> float:
+	value = e.retry_after
+	return value.total_seconds() if isinstance(value, timedelta) else float(value)
+
+class Outbox:
+	# Every outbound message goes through here. A single dispatcher takes the
+	# highest priority class first and round-robins chats within a class, so a
+	# busy chat cannot starve the rest. Sends are paced by a global token bucket
+	# and a per-chat one; a chat that hits its limit or a RetryAfter is parked
+	# until it may send again.
+
+	def __init__(self, global_rate: float = OUTBOX_GLOBAL_RATE):
+		self._chats: Dict[int, _ChatOutbox] = {}
+		# chats that ran dry, oldest first; dropped once their bucket has refilled
+		self._drained: "OrderedDict[int, float]" = OrderedDict()
+		self._rings: List["OrderedDict[int, None]"] = [OrderedDict() for _ in PRIORITIES]
+		self._parked: List[Tuple[float, int]] = []
+		self._global = TokenBucket(global_rate, global_rate)
+		self._depth = [0 for _ in PRIORITIES]
+		self._inflight = 0
+		self._slots = asyncio.Semaphore(OUTBOX_CONCURRENCY)
+		self._wakeup = asyncio.Event()
+		self._idle = asyncio.Event()
+		self._idle.set()
+		self._task: Optional[asyncio.Task] = None
+
+	def depth(self) -> int:
+		return sum(self._depth)
+
+	def depth_by_priority(self) -> List[int]:
+		return list(self._depth)
+
+	def submit(self, chat_id: int, factory: Callable[[], Awaitable], priority: int = PRIO_NORMAL) -> asyncio.Future:
+		# returns a future resolving to the API result, or None if it was dropped or failed
+		fut = asyncio.get_running_loop().create_future()
+		if priority == PRIO_CHATTER and self._depth[PRIO_CHATTER] >= OUTBOX_MAX_CHATTER:
+			logger.warning("Outbox full, dropping chatter for %s", chat_id)
+			fut.set_result(None)
+			return fut
+		if tracer.enabled:
+			factory = tracer.bind(factory)
+		chat = self._chats.get(chat_id)
+		if chat is None:
+			chat = self._chats[chat_id] = _ChatOutbox(chat_id)
+		chat.queues[priority].append((factory, fut, 0))
+		self._depth[priority] += 1
+		if chat.parked_until <= time.monotonic():
+			self._rings[priority][chat_id] = None
+		self._idle.clear()
+		self._wakeup.set()
+		return fut
+
+	def start(self):
+		self._task = asyncio.create_task(self._run())
+
+	async def join(self):
+		# wait until nothing is queued or in flight
+		await self._idle.wait()
+
+	async def stop(self, timeout: float = 5.0):
+		# give queued messages a chance to go out, then cancel the dispatcher
+		try:
+			await asyncio.wait_for(self.join(), timeout)
+		except asyncio.TimeoutError:
+			logger.warning("Outbox stopped with %d messages still queued", self.depth())
+		if self._task:
+			self._task.cancel()
+			try:
+				await self._task
+			except asyncio.CancelledError:
+				pass
+			self._task = None
+
+	def _park(self, chat_id: int, until: float):
+		chat = self._chats[chat_id]
+		chat.parked_until = max(chat.parked_until, until)
+		for ring in self._rings:
+			ring.pop(chat_id, None)
+		heapq.heappush(self._parked, (chat.parked_until, chat_id))
+
+	def _unpark(self, now: float):
+		while self._parked and self._parked[0][0] <= now:
+			until, chat_id = heapq.heappop(self._parked)
+			chat = self._chats.get(chat_id)
+			if chat is None or chat.parked_until != until:
+				continue
+			chat.parked_until = 0.0
+			for prio in PRIORITIES:
+				if chat.queues[prio]:
+					self._rings[prio][chat_id] = None
+
+	def _sweep(self, now: float):
+		# forget drained chats only after their bucket refilled, so pacing holds across bursts
+		while self._drained:
+			chat_id, since = next(iter(self._drained.items()))
+			chat = self._chats.get(chat_id)
+			if chat is not None and since + chat.bucket.capacity / chat.bucket.rate > now:
+				break
+			del self._drained[chat_id]
+			if chat is not None and chat.empty() and not chat.inflight and chat.parked_until <= now:
+				del self._chats[chat_id]
+
+	def _next(self, now: float):
+		# pick the next (chat_id, priority) allowed to send, parking chats over their limit
+		for prio in PRIORITIES:
+			ring = self._rings[prio]
+			while ring:
+				chat_id = next(iter(ring))
+				chat = self._chats[chat_id]
+				wait = chat.bucket.delay(now)
+				if wait > 0:
+					self._park(chat_id, now + wait)
+					continue
+				del ring[chat_id]
+				return chat_id, prio
+		return None
+
+	async def _run(self):
+		while True:
+			try:
+				now = time.monotonic()
+				self._unpark(now)
+				self._sweep(now)
+				wait = self._global.delay(now)
+				picked = self._next(now) if wait <= 0 else None
+				if picked is None:
+					if not self.depth() and not self._inflight:
+						self._idle.set()
+					if wait <= 0:
+						wait = self._parked[0][0] - now if self._parked else None
+					self._wakeup.clear()
+					try:
+						await asyncio.wait_for(self._wakeup.wait(), wait)
+					except asyncio.TimeoutError:
+						pass
+					continue
+				chat_id, prio = picked
+				chat = self._chats[chat_id]
+				item = chat.queues[prio].popleft()
+				self._depth[prio] -= 1
+				if chat.queues[prio]:
+					self._rings[prio][chat_id] = None  # back of the ring
+				chat.bucket.take()
+				self._global.take()
+				await self._slots.acquire()
+				self._inflight += 1
+				chat.inflight += 1
+				asyncio.create_task(self._deliver(chat_id, prio, item))
+			except asyncio.CancelledError:
+				raise
+			except Exception:
+				logger.exception("Ошибка в очереди отправки")
+				await asyncio.sleep(1)
+
+	async def _deliver(self, chat_id: int, prio: int, item):
+		factory, fut, attempts = item
+		requeued = False
+		try:
+			result = await factory()
+		except RetryAfter as e:
+			if attempts < 3:
+				# requeue at the front and hold the chat back for as long as Telegram asks
+				logger.warning("Flood wait %.0fs for %s", retry_after_seconds(e), chat_id)
+				self._chats[chat_id].queues[prio].appendleft((factory, fut, attempts + 1))
+				self._depth[prio] += 1
+				self._park(chat_id, time.monotonic() + retry_after_seconds(e))
+				self._wakeup.set()
+				requeued = True
+			else:
+				logger.error("Giving up on message to %s after repeated flood waits", chat_id)
+				fut.set_result(None)
+		except Exception as e:
+			logger.warning("Failed to send to %s: %s", chat_id, e)
+			fut.set_result(None)
+		else:
+			fut.set_result(result)
+		finally:
+			self._inflight -= 1
+			self._slots.release()
+			if not requeued and not fut.done():
+				fut.set_result(None)
+			chat = self._chats.get(chat_id)
+			if chat is not None:
+				chat.inflight -= 1
+			if chat is not None and chat.empty():
+				self._drained[chat_id] = time.monotonic()
+				self._drained.move_to_end(chat_id)
+			self._wakeup.set()
+
+outbox = Outbox()
+
+def reply(message, text: str, priority: int = PRIO_NORMAL, **kwargs) -> asyncio.Future:
+	return outbox.submit(message.chat_id, lambda: message.reply_text(text, **kwargs), priority)
+
+def send(bot, chat_id: int, text: str, priority: int = PRIO_NORMAL, **kwargs) -> asyncio.Future:
+	return outbox.submit(chat_id, lambda: bot.send_message(chat_id, text, **kwargs), priority)
+
+# --- Chat state ---
+class ChatState:
+	# Everything kept in memory about one chat, in one record. Fields stay None
+	# until first written, and read paths treat None as empty, so a chat that
+	# only ever talks costs this record and its activity window.
+	__slots__ = (
+		"admins", "warns", "warn_policy", "mutes", "banned", "activity", "victim",
+		"last_message", "joins", "roulette_weights", "phrase_pack", "silence", "seen",
+	)
+
+	def __init__(self, now: float):
+		self.admins: Optional[Set[int]] = None
+		self.warns: Optional[Dict[int, "array[float]"]] = None  # user_id -> warn timestamps, oldest first
+		self.warn_policy: Optional["WarnPolicy"] = None  # set with /warnpolicy
+		self.mutes: Optional[Dict[int, float]] = None  # user_id -> mute end timestamp
+		self.banned: Optional[Set[int]] = None
+		self.activity: Optional["ActivityWindow"] = None  # users active within ACTIVITY_WINDOW
+		self.victim: Optional[int] = None  # victim of the day
+		self.last_message: Optional[float] = None  # wall time, for the silence detector
+		self.joins: Optional[Deque[Tuple[float, int]]] = None  # (join timestamp, user_id), oldest first
+		self.roulette_weights: Optional[Tuple[float, ...]] = None  # set with /roulette weights
+		self.phrase_pack: Optional[str] = None  # set with /phrases
+		self.silence: Optional[int] = None  # seconds of silence before an aggro-phrase, 0 = off
+		self.seen = now  # monotonic time of the last update in the chat
+
+	def nbytes(self) -> int:
+		# rough footprint of the record and everything it holds
+		size = sys.getsizeof(self)
+		for name in self.__slots__:
+			value = getattr(self, name)
+			if value is not None and name != "seen":
+				size += approx_size(value)
+		return size
+
+def approx_size(value) -> int:
+	if isinstance(value, ActivityWindow):
+		return value.nbytes()
+	size = sys.getsizeof(value)
+	if isinstance(value, dict):
+		for item in value.values():
+			size += 28 + approx_size(item)  # int key + value
+	elif isinstance(value, (set, tuple)):
+		size += 28 * len(value)
+	elif isinstance(value, deque):
+		size += (sys.getsizeof((0.0, 0)) + 52) * len(value)  # (float, int) tuples
+	elif isinstance(value, WarnPolicy):
+		size += sys.getsizeof(value.thresholds) + sys.getsizeof(value.actions) + 120 * len(value.actions)
+	return size
+
+class ChatStates:
+	# One ChatState per chat, loaded from SQLite on first use. The map is in
+	# update order: touch() moves a chat to the end, so idle chats collect at
+	# the front and eviction pops them from there without a scan. Dropping a
+	# chat loses nothing durable (its rows are flushed first) and it is
+	# reloaded on its next update; activity, joins and the silence timer
+	# start over. Loading alone never arms the silence timer: background reads
+	# (unmutes, admin checks) must not make the bot talk in a quiet chat, only
+	# a message in on_message does.
+
+	def __init__(self, idle_ttl: int):
+		self.idle_ttl = idle_ttl
+		self._chats: "OrderedDict[int, ChatState]" = OrderedDict()
+		self._task: Optional[asyncio.Task] = None
+		self.evicted = 0
+
+	def __len__(self) -> int:
+		return len(self._chats)
+
+	def values(self):
+		return self._chats.values()
+
+	def peek(self, chat_id: int) -> Optional[ChatState]:
+		# without loading: None for chats not in memory
+		return self._chats.get(chat_id)
+
+	def get(self, chat_id: int) -> ChatState:
+		state = self._chats.get(chat_id)
+		if state is None:
+			state = self._chats[chat_id] = ChatState(time.monotonic())
+			self._load(chat_id, state)
+		return state
+
+	def touch(self, chat_id: int):
+		# called for every incoming update; chats not loaded yet are left alone
+		state = self._chats.get(chat_id)
+		if state is not None:
+			state.seen = time.monotonic()
+			self._chats.move_to_end(chat_id)
+
+	def _load(self, chat_id: int, state: ChatState):
+		# read-through: the first touch of a chat pulls its rows from SQLite
+		try:
+			rows = storage.query("SELECT user_id FROM admins WHERE chat_id = ?", (chat_id,))
+			if rows:
+				state.admins = {u for (u,) in rows}
+			warn_ledger.load(chat_id, state, storage.query("SELECT user_id, stamps FROM warn_stamps WHERE chat_id = ?", (chat_id,)))
+			rows = storage.query("SELECT user_id, until FROM mutes WHERE chat_id = ?", (chat_id,))
+			if rows:
+				state.mutes = dict(rows)
+			rows = storage.query("SELECT user_id FROM banned WHERE chat_id = ?", (chat_id,))
+			if rows:
+				state.banned = {u for (u,) in rows}
+			rows = storage.query("SELECT user_id FROM victims WHERE chat_id = ?", (chat_id,))
+			if rows:
+				state.victim = rows[0][0]
+			rows = storage.query("SELECT seconds FROM silence WHERE chat_id = ?", (chat_id,))
+			if rows:
+				state.silence = rows[0][0]
+			rows = storage.query("SELECT pack FROM phrases WHERE chat_id = ?", (chat_id,))
+			if rows:
+				state.phrase_pack = rows[0][0]
+			rows = storage.query("SELECT weights FROM roulette WHERE chat_id = ?", (chat_id,))
+			if rows:
+				state.roulette_weights = parse_roulette_weights(rows[0][0])
+			rows = storage.query("SELECT policy FROM warn_policy WHERE chat_id = ?", (chat_id,))
+			if rows:
+				state.warn_policy = WarnPolicy.parse(rows[0][0])
+		except Exception:
+			logger.exception("Не удалось загрузить состояние чата %s", chat_id)
+
+	def evict_idle(self, now: float, keep: Set[int]) -> int:
+		# drop chats idle since before now - idle_ttl, except those in `keep`
+		deadline = now - self.idle_ttl
+		kept = []
+		evicted = 0
+		while self._chats:
+			chat_id, state = next(iter(self._chats.items()))
+			if state.seen >= deadline:
+				break
+			self._chats.popitem(last=False)
+			if chat_id in keep:
+				kept.append((chat_id, state))
+				continue
+			forget_chat(chat_id)
+			evicted += 1
+		# still waiting for a flush: back to the front, next round retries them
+		for chat_id, state in reversed(kept):
+			self._chats[chat_id] = state
+			self._chats.move_to_end(chat_id, last=False)
+		self.evicted += evicted
+		return evicted
+
+	def memory(self) -> Tuple[int, int]:
+		# (chats in memory, approximate bytes they hold)
+		return len(self._chats), sum(state.nbytes() for state in self._chats.values())
+
+	def start(self):
+		if self.idle_ttl > 0:
+			self._task = asyncio.create_task(self._run())
+
+	async def stop(self):
+		if self._task:
+			self._task.cancel()
+			try:
+				await self._task
+			except asyncio.CancelledError:
+				pass
+			self._task = None
+
+	async def _run(self):
+		while True:
+			await asyncio.sleep(CHAT_EVICT_INTERVAL)
+			try:
+				# evicted chats reload from SQLite, so their writes must land first
+				await storage.flush()
+				evicted = self.evict_idle(time.monotonic(), storage.pending_chats())
+				if evicted:
+					logger.info("Evicted %d idle chats, %d left in memory", evicted, len(self._chats))
+			except Exception:
+				logger.exception("Ошибка при выгрузке неактивных чатов")
+
+chat_states = ChatStates(CHAT_IDLE_TTL)
+
+def chat_state(chat_id: int) -> ChatState:
+	return chat_states.get(chat_id)
+
+def forget_chat(chat_id: int):
+	# per-chat caches that rebuild themselves on demand
+	bot_rights.pop(chat_id, None)
+	flood_guard.forget(chat_id)
+	phrase_book.forget(chat_id)
+	user_index.forget(chat_id)
+	chat_admins.forget(chat_id)
+
+def shard_of(chat_id: int, count: int) -> int:
+	# plain modulo: stable across processes, unlike hash() of str keys
+	return chat_id % count
+
+def owns_chat(chat_id: int) -> bool:
+	return SHARD_COUNT == 1 or shard_of(chat_id, SHARD_COUNT) == SHARD_INDEX
 
 def is_owner(user_id: int) -> bool:
 	return user_id == OWNER_ID
 
 def is_admin(user_id: int, chat_id: int) -> bool:
-	ensure_chat_structs(chat_id)
-	return user_id in admins.get(chat_id, set()) or is_owner(user_id)
+	admins = chat_state(chat_id).admins
+	return (admins is not None and user_id in admins) or chat_admins.contains(chat_id, user_id) or is_owner(user_id)
 
-async def try_restrict(chat_id: int, user_id: int, until: Optional[datetime], bot):
+async def load_bot_identity(bot):
+	global BOT_ID, BOT_USERNAME, BOT_MENTION_RE
+	# Application.initialize() has already called getMe, reuse its result
+	try:
+		me = bot.bot
+	except RuntimeError:
+		me = await bot.get_me()
+	BOT_ID = me.id
+	BOT_USERNAME = me.username
+	if me.username:
+		BOT_MENTION_RE = re.compile("@" + re.escape(me.username) + r"(?![A-Za-z0-9_])", re.IGNORECASE)
+
+async def get_bot_member(chat_id: int, bot) -> Optional[ChatMember]:
+	cached = bot_rights.get(chat_id)
+	if cached and time.monotonic() - cached[0] < BOT_RIGHTS_TTL:
+		return cached[1]
+	if BOT_ID is None:
+		await load_bot_identity(bot)
 	try:
-		# check bot privileges
-		bot_me = await bot.get_me()
+		member = await bot.get_chat_member(chat_id, BOT_ID)
+	except Exception as e:
+		logger.warning("Failed to get bot member in %s: %s", chat_id, e)
+		return None
+	bot_rights[chat_id] = (time.monotonic(), member)
+	return member
+
+class ChatAdmins:
+	# Telegram's admin list per chat, so real chat admins can moderate without
+	# /addadmin. One get_chat_administrators call fills a chat; chat_member
+	# updates then add and remove admins as they happen, and the list is
+	# re-read after CHAT_ADMINS_TTL in case an update was missed. is_admin
+	# only ever reads the sets; syncing happens before commands run.
+
+	def __init__(self, ttl: int):
+		self.ttl = ttl
+		self._members: Dict[int, Set[int]] = {}
+		self._expires: Dict[int, float] = {}
+		self._inflight: Dict[int, asyncio.Task] = {}
+
+	def __len__(self) -> int:
+		return len(self._members)
+
+	def contains(self, chat_id: int, user_id: int) -> bool:
+		members = self._members.get(chat_id)
+		return members is not None and user_id in members
+
+	def get(self, chat_id: int) -> Set[int]:
+		return self._members.get(chat_id, set())
+
+	async def ensure(self, chat_id: int, bot):
+		if time.monotonic() < self._expires.get(chat_id, 0.0):
+			return
+		task = self._inflight.get(chat_id)
+		if task is None:
+			task = self._inflight[chat_id] = asyncio.create_task(self._sync(chat_id, bot))
+			task.add_done_callback(lambda _: self._inflight.pop(chat_id, None))
+		await asyncio.shield(task)
+
+	def update(self, chat_id: int, member: ChatMember):
+		# a chat_member update; chats that were never synced are left alone
+		members = self._members.get(chat_id)
+		if members is None or member.user.is_bot:
+			return
+		if member.status in (ChatMember.ADMINISTRATOR, ChatMember.OWNER):
+			members.add(member.user.id)
+		else:
+			members.discard(member.user.id)
+
+	def forget(self, chat_id: int):
+		self._members.pop(chat_id, None)
+		self._expires.pop(chat_id, None)
+
+	async def _sync(self, chat_id: int, bot):
 		try:
-			bot_member = await bot.get_chat_member(chat_id, bot_me.id)
-			can_restrict = getattr(bot_member, "can_restrict_members", False) or bot_member.status == ChatMember.CREATOR
-		except Exception:
-			can_restrict = False
-		if not can_restrict:
+			members = await bot.get_chat_administrators(chat_id)
+		except Exception as e:
+			logger.warning("Failed to get admins of %s: %s", chat_id, e)
+			self._expires[chat_id] = time.monotonic() + min(self.ttl, CHAT_ADMINS_RETRY)
+			return
+		now = time.monotonic()
+		self._members[chat_id] = {m.user.id for m in members if not m.user.is_bot}
+		self._expires[chat_id] = now + self.ttl
+		# the list includes the bot when it is an admin: refresh its rights for free
+		for m in members:
+			if m.user.id == BOT_ID:
+				bot_rights[chat_id] = (now, m)
+		logger.debug("Synced %d admins of %s", len(self._members[chat_id]), chat_id)
+
+chat_admins = ChatAdmins(CHAT_ADMINS_TTL)
+
+async def sync_chat_admins(update: Update, context: ContextTypes.DEFAULT_TYPE):
+	# group -1: runs before the command handlers, which then check is_admin in memory
+	chat = update.effective_chat
+	if chat is not None and chat.type in (Chat.GROUP, Chat.SUPERGROUP):
+		await chat_admins.ensure(chat.id, context.bot)
+
+def member_can_restrict(member: Optional[ChatMember]) -> bool:
+	if member is None:
+		return False
+	return member.status == ChatMember.OWNER or getattr(member, "can_restrict_members", False)
+
+async def bot_can_restrict(chat_id: int, bot) -> bool:
+	return member_can_restrict(await get_bot_member(chat_id, bot))
+
+async def try_restrict(chat_id: int, user_id: int, until: Optional[datetime], bot):
+	try:
+		if not await bot_can_restrict(chat_id, bot):
 			logger.warning("Bot lacks restrict rights in chat %s", chat_id)
 			return False
 		perms = ChatPermissions(can_send_messages=False)
@@ -206,19 +1774,17 @@ async def try_restrict(chat_id: int, user_id: int, until: Optional[datetime], bo
 
 async def try_unrestrict(chat_id: int, user_id: int, bot):
 	try:
-		# check bot privileges
-		bot_me = await bot.get_me()
-		try:
-			bot_member = await bot.get_chat_member(chat_id, bot_me.id)
-			can_restrict = getattr(bot_member, "can_restrict_members", False) or bot_member.status == ChatMember.CREATOR
-		except Exception:
-			can_restrict = False
-		if not can_restrict:
+		if not await bot_can_restrict(chat_id, bot):
 			logger.warning("Bot lacks restrict rights in chat %s for unrestrict", chat_id)
 			return False
 		perms = ChatPermissions(
 			can_send_messages=True,
-			can_send_media_messages=True,
+			can_send_audios=True,
+			can_send_documents=True,
+			can_send_photos=True,
+			can_send_videos=True,
+			can_send_video_notes=True,
+			can_send_voice_notes=True,
 			can_send_polls=True,
 			can_send_other_messages=True,
 			can_add_web_page_previews=True,
@@ -226,296 +1792,1040 @@ async def try_unrestrict(chat_id: int, user_id: int, bot):
 		await bot.restrict_chat_member(chat_id, user_id, permissions=perms)
 		logger.info("Unrestricted %s in %s", user_id, chat_id)
 		return True
-	except Exception as e:
-		logger.warning("Failed to unrestrict %s in %s: %s", user_id, chat_id, e)
-		return False
+	except Exception as e:
+		logger.warning("Failed to unrestrict %s in %s: %s", user_id, chat_id, e)
+		return False
+
+# --- Mute expiry scheduler ---
+class UnmuteScheduler:
+	# One task drives every mute expiry from a min-heap of (until_ts, chat_id, user_id).
+	# ChatState.mutes is the source of truth: a heap entry whose deadline no longer
+	# matches mutes[user_id] (unmuted or re-muted) is simply skipped when popped.
+	# Deadlines persist through the `mutes` table, so they survive a redeploy.
+
+	def __init__(self):
+		self._heap: List[Tuple[float, int, int]] = []
+		self._wakeup = asyncio.Event()
+		self._task: Optional[asyncio.Task] = None
+		self._batch: Optional[asyncio.Future] = None
+
+	def __len__(self) -> int:
+		return len(self._heap)
+
+	def schedule(self, chat_id: int, user_id: int, until_ts: float):
+		state = chat_state(chat_id)
+		if state.mutes is None:
+			state.mutes = {}
+		state.mutes[user_id] = until_ts
+		storage.put("mutes", chat_id, user_id, until_ts)
+		heapq.heappush(self._heap, (until_ts, chat_id, user_id))
+		self._wakeup.set()
+
+	def cancel(self, chat_id: int, user_id: int):
+		mutes = chat_state(chat_id).mutes
+		if mutes and mutes.pop(user_id, None) is not None:
+			storage.delete("mutes", chat_id, user_id)
+
+	def load(self):
+		try:
+			rows = storage.query("SELECT chat_id, user_id, until FROM mutes")
+		except Exception:
+			logger.exception("Не удалось загрузить активные муты")
+			return
+		# only the deadlines are loaded here; chat state itself stays lazy
+		self._heap = [(until_ts, chat_id, user_id) for chat_id, user_id, until_ts in rows if owns_chat(chat_id)]
+		heapq.heapify(self._heap)
+		logger.info("Loaded %d pending unmutes", len(self._heap))
+
+	def start(self, application: Application):
+		self.load()
+		self._task = asyncio.create_task(self._run(application.bot))
+
+	async def stop(self, timeout: float = SHUTDOWN_TIMEOUT):
+		if self._task:
+			self._task.cancel()
+			try:
+				await self._task
+			except asyncio.CancelledError:
+				pass
+			self._task = None
+		# these mutes are already gone from storage: let their unrestricts land
+		if self._batch is not None and not self._batch.done():
+			try:
+				await asyncio.wait_for(self._batch, timeout)
+			except asyncio.TimeoutError:
+				logger.warning("Unmutes still in flight at shutdown were cancelled")
+		self._batch = None
+
+	def _pop_due(self, now_ts: float) -> List[Tuple[int, int]]:
+		due = []
+		while self._heap and self._heap[0][0] <= now_ts:
+			until_ts, chat_id, user_id = heapq.heappop(self._heap)
+			mutes = chat_state(chat_id).mutes
+			if not mutes or mutes.get(user_id) != until_ts:
+				continue  # stale: unmuted or re-muted meanwhile
+			del mutes[user_id]
+			storage.delete("mutes", chat_id, user_id)
+			due.append((chat_id, user_id))
+		return due
+
+	async def _run(self, bot):
+		while True:
+			try:
+				due = self._pop_due(datetime.utcnow().timestamp())
+				if due:
+					self._batch = asyncio.gather(*(try_unrestrict(c, u, bot) for c, u in due), return_exceptions=True)
+					results = await asyncio.shield(self._batch)
+					for (chat_id, user_id), res in zip(due, results):
+						if isinstance(res, Exception):
+							logger.error("Scheduled unmute failed for %s in %s: %s", user_id, chat_id, res)
+						elif res:
+							journal.record(chat_id, "unmute", None, user_id, reason="expired")
+				self._wakeup.clear()
+				timeout = None
+				if self._heap:
+					timeout = max(0.0, self._heap[0][0] + UNMUTE_BATCH_WINDOW - datetime.utcnow().timestamp())
+				try:
+					await asyncio.wait_for(self._wakeup.wait(), timeout)
+				except asyncio.TimeoutError:
+					pass
+			except asyncio.CancelledError:
+				raise
+			except Exception:
+				logger.exception("Ошибка в планировщике размутов")
+				await asyncio.sleep(1)
+
+unmute_scheduler = UnmuteScheduler()
+
+# --- Anti-flood ---
+class FloodGuard:
+	# One token bucket per (chat, sender): FLOOD_MESSAGES tokens, refilled
+	# over FLOOD_SECONDS. Senders sit in a per-chat OrderedDict in order of
+	# their last message, so idle ones are evicted from the front. A bucket
+	# that has been idle for FLOOD_SECONDS is full again, which makes dropping
+	# it lossless; FLOOD_CAP bounds the map when a whole chat is busy.
+
+	def __init__(self, messages: int, seconds: float, cap: int):
+		self.capacity = messages
+		self.rate = messages / seconds
+		self.idle = seconds
+		self.cap = cap
+		self._chats: Dict[int, "OrderedDict[int, TokenBucket]"] = {}
+
+	def __len__(self) -> int:
+		return sum(len(senders) for senders in self._chats.values())
+
+	def hit(self, chat_id: int, user_id: int, now: float) -> bool:
+		# True when this message takes the sender over the limit
+		senders = self._chats.get(chat_id)
+		if senders is None:
+			senders = self._chats[chat_id] = OrderedDict()
+		bucket = senders.pop(user_id, None)
+		if senders:
+			# one idle sender per message is enough to keep up with arrivals
+			oldest = next(iter(senders))
+			if now - senders[oldest].stamp >= self.idle or len(senders) >= self.cap:
+				del senders[oldest]
+		if bucket is None:
+			bucket = TokenBucket(self.rate, self.capacity)
+		senders[user_id] = bucket
+		bucket.delay(now)
+		bucket.take()
+		# only the message that first overdraws the bucket reports, so a
+		# burst that is still in flight triggers one mute, not one per message
+		return -1 <= bucket.tokens < 0
+
+	def rearm(self, chat_id: int, user_id: int):
+		# called once the report was handled (mute done, failed or skipped):
+		# a sender still over the limit reports again on their next message
+		senders = self._chats.get(chat_id)
+		bucket = senders.get(user_id) if senders else None
+		if bucket is not None and bucket.tokens < 0:
+			bucket.tokens = 0.0
+
+	def forget(self, chat_id: int):
+		self._chats.pop(chat_id, None)
+
+flood_guard = FloodGuard(FLOOD_MESSAGES, FLOOD_SECONDS, FLOOD_CAP)
+
+async def punish_flood(chat_id: int, user, bot):
+	until = datetime.utcnow() + timedelta(seconds=FLOOD_MUTE)
+	try:
+		restricted = await try_restrict(chat_id, user.id, until, bot)
+	finally:
+		flood_guard.rearm(chat_id, user.id)
+	if not restricted:
+		return
+	unmute_scheduler.schedule(chat_id, user.id, until.timestamp())
+	journal.record(chat_id, "mute", None, user.id, seconds=FLOOD_MUTE, reason="flood")
+	logger.info("Flood mute: %s in %s for %s s", user.id, chat_id, FLOOD_MUTE)
+	send(bot, chat_id, f"{user.mention_html()} замучен на {FLOOD_MUTE} секунд за флуд.", priority=PRIO_MODERATION, parse_mode="HTML")
+
+# --- Warns ---
+WARN_ACTIONS = {"mute": "мут", "kick": "кик", "ban": "бан"}
+DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+MUTE_MAX = 366 * 86400  # Telegram treats longer restrictions as permanent
+
+def parse_duration(text: str) -> int:
+	# "90", "90s", "30m", "1h", "7d" -> seconds
+	text = text.strip().lower()
+	unit = DURATION_UNITS.get(text[-1:])
+	seconds = int(text[:-1]) * unit if unit else int(text)
+	if seconds <= 0:
+		raise ValueError("длительность должна быть больше нуля")
+	return seconds
+
+def format_duration(seconds: int) -> str:
+	for unit, size in (("д", 86400), ("ч", 3600), ("мин", 60)):
+		if seconds >= size and seconds % size == 0:
+			return f"{seconds // size} {unit}"
+	return f"{seconds} с"
+
+class WarnPolicy:
+	# "3=mute:1h 5=ban": each warn applies the action of the highest threshold
+	# not above the live count, found by bisect over the sorted thresholds
+	__slots__ = ("thresholds", "actions")
+
+	def __init__(self, rules: Dict[int, Tuple[str, int]]):
+		self.thresholds = sorted(rules)
+		self.actions = [rules[t] for t in self.thresholds]
+
+	@classmethod
+	def parse(cls, text: str) -> "WarnPolicy":
+		rules = {}
+		for item in text.replace(",", " ").split():
+			count, _, action = item.partition("=")
+			kind, _, duration = action.partition(":")
+			if not count.isdigit() or int(count) < 1:
+				raise ValueError(f"порог {count or item} должен быть положительным числом")
+			if kind not in WARN_ACTIONS:
+				raise ValueError(f"неизвестное действие {kind or item}")
+			rules[int(count)] = (kind, parse_duration(duration or "1h") if kind == "mute" else 0)
+		return cls(rules)
+
+	def __str__(self) -> str:
+		return " ".join(f"{t}={kind}:{seconds}" if kind == "mute" else f"{t}={kind}" for t, (kind, seconds) in zip(self.thresholds, self.actions))
+
+	def action_for(self, count: int) -> Optional[Tuple[str, int]]:
+		i = bisect.bisect_right(self.thresholds, count) - 1
+		return self.actions[i] if i >= 0 else None
+
+	def next_after(self, count: int) -> Optional[Tuple[int, Tuple[str, int]]]:
+		i = bisect.bisect_right(self.thresholds, count)
+		return (self.thresholds[i], self.actions[i]) if i < len(self.thresholds) else None
+
+def describe_warn_action(action: Tuple[str, int]) -> str:
+	kind, seconds = action
+	if kind == "mute":
+		return f"мут на {format_duration(seconds)}"
+	return WARN_ACTIONS[kind]
+
+def format_warn_policy(policy: WarnPolicy) -> str:
+	if not policy.thresholds:
+		return "без наказаний"
+	return ", ".join(f"{t} — {describe_warn_action(a)}" for t, a in zip(policy.thresholds, policy.actions))
+
+DEFAULT_WARN_POLICY = WarnPolicy.parse(WARN_POLICY)
+
+class WarnLedger:
+	# ChatState.warns[user] is an array of warn timestamps, oldest first; a warn
+	# counts for `ttl` seconds. Every warned user has one entry in a min-heap
+	# keyed by the expiry of their oldest warn. sweep() pops only what is due
+	# and trims those users, so expired warns go away without scanning chats.
+	# Counting does not wait for a sweep: bisect skips the expired prefix.
+
+	def __init__(self, ttl: int):
+		self.ttl = ttl
+		self._deadlines: List[Tuple[float, int, int]] = []
+
+	def load(self, chat_id: int, state: ChatState, rows: List[Tuple[int, str]]):
+		if not rows:
+			return
+		state.warns = {user_id: array("d", (float(t) for t in stamps.split(",") if t)) for user_id, stamps in rows}
+		for user_id in state.warns:
+			self._track(chat_id, state, user_id)
+
+	def _track(self, chat_id: int, state: ChatState, user_id: int):
+		stamps = state.warns.get(user_id)
+		if self.ttl and stamps:
+			heapq.heappush(self._deadlines, (stamps[0] + self.ttl, chat_id, user_id))
+
+	def _save(self, chat_id: int, state: ChatState, user_id: int):
+		stamps = state.warns.get(user_id)
+		if stamps:
+			storage.put("warn_stamps", chat_id, user_id, ",".join(f"{t:.0f}" for t in stamps))
+		else:
+			state.warns.pop(user_id, None)
+			storage.delete("warn_stamps", chat_id, user_id)
+
+	def sweep(self, now: float) -> int:
+		# drop expired warns of users whose oldest warn is due; returns users touched
+		touched = 0
+		while self._deadlines and self._deadlines[0][0] <= now:
+			_, chat_id, user_id = heapq.heappop(self._deadlines)
+			# evicted chats are trimmed when they load again
+			state = chat_states.peek(chat_id)
+			stamps = state.warns.get(user_id) if state and state.warns else None
+			cut = bisect.bisect_right(stamps, now - self.ttl) if stamps else 0
+			if not cut:
+				continue  # stale entry
+			del stamps[:cut]
+			self._save(chat_id, state, user_id)
+			self._track(chat_id, state, user_id)
+			touched += 1
+		return touched
+
+	def add(self, chat_id: int, user_id: int, now: float) -> int:
+		# record a warn, return the live count including it
+		state = chat_state(chat_id)
+		self.sweep(now)
+		if state.warns is None:
+			state.warns = {}
+		stamps = state.warns.setdefault(user_id, array("d"))
+		stamps.append(float(int(now)))
+		if len(stamps) == 1:
+			self._track(chat_id, state, user_id)
+		self._save(chat_id, state, user_id)
+		return self.count(chat_id, user_id, now)
+
+	def count(self, chat_id: int, user_id: int, now: float) -> int:
+		warns = chat_state(chat_id).warns
+		stamps = warns.get(user_id) if warns else None
+		if not stamps:
+			return 0
+		if not self.ttl:
+			return len(stamps)
+		return len(stamps) - bisect.bisect_right(stamps, now - self.ttl)
+
+	def tracked(self) -> int:
+		return len(self._deadlines)
+
+	def policy(self, chat_id: int) -> WarnPolicy:
+		return chat_state(chat_id).warn_policy or DEFAULT_WARN_POLICY
+
+	def set_policy(self, chat_id: int, policy: Optional[WarnPolicy]):
+		chat_state(chat_id).warn_policy = policy
+		if policy is None:
+			storage.delete("warn_policy", chat_id)
+		else:
+			storage.put("warn_policy", chat_id, str(policy))
+
+warn_ledger = WarnLedger(WARN_TTL)
+
+async def enforce_warn_action(chat_id: int, user_id: int, action: Tuple[str, int], bot):
+	# raises when the Bot API call fails
+	kind, seconds = action
+	if kind == "mute":
+		until = datetime.utcnow() + timedelta(seconds=seconds)
+		if not await try_restrict(chat_id, user_id, until, bot):
+			raise RuntimeError(f"cannot restrict {user_id} in {chat_id}")
+		unmute_scheduler.schedule(chat_id, user_id, until.timestamp())
+	elif kind == "kick":
+		await bot.ban_chat_member(chat_id, user_id)
+		await bot.unban_chat_member(chat_id, user_id)
+	else:
+		await bot.ban_chat_member(chat_id, user_id)
+		mark_banned(chat_id, user_id)
+
+def record_warn_action(chat_id: int, actor: Optional[int], user_id: int, action: Tuple[str, int], count: int, **detail):
+	kind, seconds = action
+	if kind == "mute":
+		detail["seconds"] = seconds
+	journal.record(chat_id, kind, actor, user_id, reason=f"{count} warns", **detail)
+
+# --- Bulk moderation ---
+BULK_LABELS = {"ban": "Бан", "kick": "Кик", "mute": "Мут", "warn": "Варн"}
+
+def user_link(user_id: int) -> str:
+	return f"<a href=\"tg://user?id={user_id}\">{user_id}</a>"
+
+def record_join(chat_id: int, user_id: int):
+	state = chat_state(chat_id)
+	if state.joins is None:
+		state.joins = deque(maxlen=RECENT_JOINS_CAP)
+	state.joins.append((time.time(), user_id))
+
+def recent_joiners(chat_id: int, seconds: int) -> List[int]:
+	since = time.time() - seconds
+	result = []
+	for ts, user_id in reversed(chat_state(chat_id).joins or ()):
+		if ts < since:
+			break
+		result.append(user_id)
+	return result
+
+def parse_bulk_targets(msg, args: List[str]) -> Tuple[List[int], Optional[str]]:
+	# targets: the replied-to user, numeric IDs and "joined N" (joined in the last N minutes)
+	ids = []
+	if msg.reply_to_message and msg.reply_to_message.from_user:
+		ids.append(msg.reply_to_message.from_user.id)
+	i = 0
+	while i < len(args):
+		arg = args[i]
+		if arg.lower() == "joined":
+			try:
+				minutes = int(args[i + 1])
+			except (IndexError, ValueError):
+				return [], "После joined укажи число минут."
+			ids.extend(recent_joiners(msg.chat_id, minutes * 60))
+			i += 2
+			continue
+		try:
+			ids.append(int(arg))
+		except ValueError:
+			return [], f"Не понял аргумент: {arg}"
+		i += 1
+	targets = []
+	seen = set()
+	for user_id in ids:
+		if user_id in seen or is_owner(user_id) or user_id == BOT_ID:
+			continue
+		seen.add(user_id)
+		targets.append(user_id)
+	return targets[:BULK_MAX_TARGETS], None
+
+def looks_like_targets(args: List[str]) -> bool:
+	# numeric IDs and "joined N" only; anything else after a reply is a reason
+	i = 0
+	while i < len(args):
+		if args[i].lower() == "joined":
+			i += 1
+		if i >= len(args) or not args[i].lstrip("-").isdigit():
+			return False
+		i += 1
+	return True
+
+def with_reason(text: str, reason: str) -> str:
+	return f"{text} Причина: {html.escape(reason)}" if reason else text
+
+async def run_bounded(items: List, worker: Callable[..., Awaitable], limit: int = BULK_CONCURRENCY) -> List:
+	# like gather, but at most `limit` calls in flight; exceptions are returned, not raised
+	slots = asyncio.Semaphore(limit)
+
+	async def one(item):
+		async with slots:
+			try:
+				return await worker(item)
+			except Exception as e:
+				return e
+	return await asyncio.gather(*(one(item) for item in items))
+
+def mark_banned(chat_id: int, user_id: int):
+	state = chat_state(chat_id)
+	if state.banned is None:
+		state.banned = set()
+	state.banned.add(user_id)
+	storage.put("banned", chat_id, user_id)
+
+async def bulk_moderate(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str, args: List[str], seconds: int = 0):
+	chat = update.effective_chat
+	msg = update.message
+	bot = context.bot
+	targets, error = parse_bulk_targets(msg, args)
+	if error:
+		return reply(msg, error, priority=PRIO_MODERATION)
+	if not targets:
+		return reply(msg, "Некого обрабатывать.", priority=PRIO_MODERATION)
+	# one privilege check for the whole batch
+	if action != "warn" and not await bot_can_restrict(chat.id, bot):
+		return reply(msg, "У меня нет прав ограничивать пользователей. Сделайте бота админом с правом 'Ban users'.", priority=PRIO_MODERATION)
+	until = datetime.utcnow() + timedelta(seconds=seconds)
+	policy = warn_ledger.policy(chat.id)
+	counts: Dict[int, int] = {}
+	escalated: Dict[int, Tuple[str, int]] = {}
+	unpunished: Dict[int, Tuple[str, int]] = {}  # warned, but the escalation call failed
+
+	async def apply(user_id: int):
+		if action == "ban":
+			await bot.ban_chat_member(chat.id, user_id)
+			mark_banned(chat.id, user_id)
+		elif action == "kick":
+			await bot.ban_chat_member(chat.id, user_id)
+			await bot.unban_chat_member(chat.id, user_id)
+		elif action == "mute":
+			await bot.restrict_chat_member(chat.id, user_id, permissions=ChatPermissions(can_send_messages=False), until_date=until)
+			unmute_scheduler.schedule(chat.id, user_id, until.timestamp())
+		elif action == "warn":
+			count = counts[user_id] = warn_ledger.add(chat.id, user_id, time.time())
+			step = policy.action_for(count)
+			if step:
+				# the warn is stored already; a failed escalation is reported on its own
+				try:
+					await enforce_warn_action(chat.id, user_id, step, bot)
+				except Exception as e:
+					logger.warning("Не удалось наказать %s в %s за %d варнов: %s", user_id, chat.id, count, e)
+					unpunished[user_id] = step
+				else:
+					escalated[user_id] = step
+
+	results = await run_bounded(targets, apply)
+	failed = [user_id for user_id, res in zip(targets, results) if isinstance(res, Exception)]
+	actor = update.effective_user.id
+	detail = {"seconds": seconds} if action == "mute" else {}
+	for user_id, res in zip(targets, results):
+		if isinstance(res, Exception):
+			continue
+		if action == "warn":
+			detail = {"count": counts[user_id]}
+		journal.record(chat.id, action, actor, user_id, bulk=True, **detail)
+		if user_id in escalated:
+			record_warn_action(chat.id, actor, user_id, escalated[user_id], counts[user_id], bulk=True)
+	logger.info("Bulk %s in %s: %d ok, %d failed", action, chat.id, len(targets) - len(failed), len(failed))
+	text = f"{BULK_LABELS[action]}: {len(targets) - len(failed)} из {len(targets)}."
+	if action == "mute":
+		text += f" На {seconds} секунд."
+	if escalated:
+		text += "\nНаказаны за предупреждения: " + ", ".join(f"{user_link(u)} ({describe_warn_action(a)})" for u, a in list(escalated.items())[:20])
+	if unpunished:
+		text += "\nНе удалось наказать (проверьте права бота): " + ", ".join(f"{user_link(u)} ({describe_warn_action(a)})" for u, a in list(unpunished.items())[:20])
+	if failed:
+		text += "\nНе удалось: " + ", ".join(user_link(u) for u in failed[:20])
+		if len(failed) > 20:
+			text += f" и ещё {len(failed) - 20}"
+	reply(msg, text, parse_mode="HTML", priority=PRIO_MODERATION)
+
+# --- Roulette ---
+ROULETTE_OUTCOMES = ("nothing", "short_mute", "long_mute", "roast", "honor", "victim")
+ROULETTE_MUTES = {"short_mute": 30, "long_mute": 300}
+
+def parse_roulette_weights(text: str, base: Optional[Tuple[float, ...]] = None) -> Tuple[float, ...]:
+	# "short_mute=3 long_mute=0" on top of `base` (all ones by default)
+	weights = list(base or (1.0,) * len(ROULETTE_OUTCOMES))
+	for item in text.replace(",", " ").split():
+		name, _, value = item.partition("=")
+		if name not in ROULETTE_OUTCOMES:
+			raise ValueError(f"неизвестный исход {name}")
+		weight = float(value)
+		if not 0 <= weight < float("inf"):
+			raise ValueError(f"вес {name} должен быть неотрицательным числом")
+		weights[ROULETTE_OUTCOMES.index(name)] = weight
+	if not any(weights):
+		raise ValueError("хотя бы один вес должен быть больше нуля")
+	return tuple(weights)
+
+def format_roulette_weights(weights: Tuple[float, ...]) -> str:
+	return " ".join(f"{name}={weight:g}" for name, weight in zip(ROULETTE_OUTCOMES, weights))
+
+class AliasTable:
+	# Vose's alias method: O(n) to build, O(1) per draw
+	__slots__ = ("prob", "alias")
+
+	def __init__(self, weights: Tuple[float, ...]):
+		n = len(weights)
+		total = sum(weights)
+		scaled = [w * n / total for w in weights]
+		self.prob = [1.0] * n
+		self.alias = list(range(n))
+		small = [i for i, p in enumerate(scaled) if p < 1]
+		large = [i for i, p in enumerate(scaled) if p >= 1]
+		while small and large:
+			s, l = small.pop(), large.pop()
+			self.prob[s] = scaled[s]
+			self.alias[s] = l
+			scaled[l] -= 1 - scaled[s]
+			(small if scaled[l] < 1 else large).append(l)
+		# leftovers are 1 up to rounding
+		for i in small + large:
+			self.prob[i] = 1.0
+
+	def draw(self) -> int:
+		i = random.randrange(len(self.prob))
+		return i if random.random() < self.prob[i] else self.alias[i]
+
+DEFAULT_ROULETTE_WEIGHTS = parse_roulette_weights(ROULETTE_WEIGHTS)
+
+class Roulette:
+	# One engine for /roulette and the inline button. Alias tables are cached
+	# by weight vector, so chats with the same weights share one. Cooldowns
+	# live in an OrderedDict in spin order; expired entries are trimmed from
+	# the front on every spin, so it only holds users inside their cooldown.
+
+	def __init__(self, cooldown: float):
+		self.cooldown = cooldown
+		self._tables: Dict[Tuple[float, ...], AliasTable] = {}
+		self._last_spin: "OrderedDict[Tuple[int, int], float]" = OrderedDict()
+
+	def weights(self, chat_id: int) -> Tuple[float, ...]:
+		return chat_state(chat_id).roulette_weights or DEFAULT_ROULETTE_WEIGHTS
+
+	def set_weights(self, chat_id: int, weights: Optional[Tuple[float, ...]]):
+		chat_state(chat_id).roulette_weights = weights
+		if weights is None:
+			storage.delete("roulette", chat_id)
+		else:
+			storage.put("roulette", chat_id, format_roulette_weights(weights))
+
+	def spin(self, chat_id: int, user_id: int, now: float) -> Tuple[Optional[str], float]:
+		# (outcome, 0) or (None, seconds until this user may spin again)
+		while self._last_spin:
+			key, ts = next(iter(self._last_spin.items()))
+			if now - ts < self.cooldown:
+				break
+			del self._last_spin[key]
+		last = self._last_spin.get((chat_id, user_id))
+		if last is not None:
+			return None, self.cooldown - (now - last)
+		self._last_spin[(chat_id, user_id)] = now
+		weights = self.weights(chat_id)
+		table = self._tables.get(weights)
+		if table is None:
+			table = self._tables[weights] = AliasTable(weights)
+		return ROULETTE_OUTCOMES[table.draw()], 0.0
+
+	async def apply(self, outcome: str, chat_id: int, target, bot) -> str:
+		# performs the outcome and returns the HTML text to announce it
+		if outcome in ROULETTE_MUTES:
+			seconds = ROULETTE_MUTES[outcome]
+			until = datetime.utcnow() + timedelta(seconds=seconds)
+			if not await try_restrict(chat_id, target.id, until, bot):
+				return "У меня нет прав мутить пользователя. Сделайте бота админом."
+			unmute_scheduler.schedule(chat_id, target.id, until.timestamp())
+			journal.record(chat_id, "mute", None, target.id, seconds=seconds, reason="roulette")
+			if outcome == "short_mute":
+				return f"Колесо выбрало мут на {seconds} секунд для {target.mention_html()}."
+			return f"О, длинный мут: {seconds} секунд для {target.mention_html()}."
+		if outcome == "roast":
+			return f"Рулетка выдала ростер: {html.escape(phrase_book.draw(chat_id, 'roasts'))}"
+		if outcome == "honor":
+			return f"Честь дана {target.mention_html()} — минутой молчания."
+		if outcome == "victim":
+			chat_state(chat_id).victim = target.id
+			storage.put("victims", chat_id, target.id)
+			return f"Жертва дня: {target.mention_html()}."
+		return "Колесо крутится... Ничего не получилось. Удача не для тебя."
+
+roulette = Roulette(ROULETTE_COOLDOWN)
+
+# --- Error reports ---
+class ErrorGroup:
+	__slots__ = ("kind", "frame", "handler", "chat_id", "count", "pending", "first_seen", "last_seen", "sample")
+
+	def __init__(self, key: Tuple[str, str, str, Optional[int]], sample: str, now: float):
+		self.kind, self.frame, self.handler, self.chat_id = key
+		self.count = 1
+		self.pending = 1  # occurrences the owner has not been told about yet
+		self.first_seen = self.last_seen = now
+		self.sample = sample
+
+def error_fingerprint(error: BaseException, update: object) -> Tuple[str, str, str, Optional[int]]:
+	# (exception type, innermost frame, handler, chat); the handler is the
+	# outermost frame of this module that is not a callback wrapper
+	frames = traceback.extract_tb(error.__traceback__)
+	if frames:
+		top = frames[-1]
+		frame = f"{os.path.basename(top.filename)}:{top.lineno} {top.name}"
+	else:
+		frame = "-"
+	handler = next((f.name for f in frames if f.filename == __file__ and f.name != "wrapper"), "-")
+	chat = update.effective_chat if isinstance(update, Update) else None
+	return type(error).__name__, frame, handler, chat.id if chat else None
+
+class ErrorLog:
+	# Unhandled exceptions grouped by fingerprint. The first occurrence of a
+	# group may be reported to the owner right away; repeats, and new groups
+	# that found the alert budget spent, only bump counters and are summed up
+	# in the periodic digest. Past `cap` groups the one quiet for longest goes.
+
+	def __init__(self, cap: int):
+		self.cap = cap
+		self.total = 0
+		self._groups: Dict[Tuple[str, str, str, Optional[int]], ErrorGroup] = {}
+		self._alerts = TokenBucket(1 / ERROR_ALERT_INTERVAL, ERROR_ALERT_BURST)
+		self._task: Optional[asyncio.Task] = None
+
+	def __len__(self) -> int:
+		return len(self._groups)
+
+	def record(self, error: BaseException, update: object) -> ErrorGroup:
+		key = error_fingerprint(error, update)
+		now = time.time()
+		self.total += 1
+		group = self._groups.get(key)
+		if group is not None:
+			group.count += 1
+			group.pending += 1
+			group.last_seen = now
+			group.sample = str(error)
+			return group
+		if len(self._groups) >= self.cap:
+			del self._groups[min(self._groups, key=lambda k: self._groups[k].last_seen)]
+		group = self._groups[key] = ErrorGroup(key, str(error), now)
+		return group
+
+	def claim_alert(self, group: ErrorGroup) -> bool:
+		# True when an immediate alert for this new group fits the budget
+		if self._alerts.delay(time.monotonic()) > 0:
+			return False
+		self._alerts.take()
+		group.pending = 0
+		return True
+
+	def groups(self) -> List[ErrorGroup]:
+		return sorted(self._groups.values(), key=lambda g: g.last_seen, reverse=True)
+
+	def clear(self):
+		# `total` keeps counting: it backs a Prometheus counter
+		self._groups.clear()
+
+	def digest(self, limit: int = 15) -> Optional[str]:
+		# occurrences since the last digest or alert, None when there were none
+		fresh = sorted((g for g in self._groups.values() if g.pending), key=lambda g: g.pending, reverse=True)
+		if not fresh:
+			return None
+		lines = [f"Сводка ошибок{shard_label()} (UTC): всего {sum(g.pending for g in fresh)}, групп {len(fresh)}"]
+		lines += [format_error_group(g, g.pending) for g in fresh[:limit]]
+		if len(fresh) > limit:
+			lines.append(f"…и ещё групп: {len(fresh) - limit}. Все: /errors")
+		for group in fresh:
+			group.pending = 0
+		return "\n".join(lines)
+
+	def start(self, bot):
+		if ERROR_DIGEST_INTERVAL > 0:
+			self._task = asyncio.create_task(self._run(bot))
+
+	async def stop(self):
+		if self._task:
+			self._task.cancel()
+			try:
+				await self._task
+			except asyncio.CancelledError:
+				pass
+			self._task = None
+
+	async def _run(self, bot):
+		while True:
+			await asyncio.sleep(ERROR_DIGEST_INTERVAL)
+			try:
+				text = self.digest()
+				if text:
+					send(bot, OWNER_ID, text)
+			except Exception:
+				logger.exception("Не удалось отправить сводку ошибок")
+
+error_log = ErrorLog(ERROR_GROUPS_CAP)
+
+def shard_label() -> str:
+	return f" (воркер {SHARD_INDEX})" if SHARD_COUNT > 1 else ""
+
+def format_error_group(group: ErrorGroup, count: int) -> str:
+	first = datetime.fromtimestamp(group.first_seen, timezone.utc).strftime("%m-%d %H:%M")
+	last = datetime.fromtimestamp(group.last_seen, timezone.utc).strftime("%m-%d %H:%M")
+	chat = f", чат {group.chat_id}" if group.chat_id is not None else ""
+	return f"• {count}× {group.kind} в {group.handler}{chat} ({group.frame}), с {first} по {last}: {group.sample[:100]}"
+
+def format_error_alert(group: ErrorGroup) -> str:
+	chat = f"Чат: {group.chat_id}\n" if group.chat_id is not None else ""
+	repeats = f"Повторы придут в сводке раз в {format_duration(ERROR_DIGEST_INTERVAL)}." if ERROR_DIGEST_INTERVAL > 0 else "Повторы: /errors"
+	return f"Новая ошибка{shard_label()}: {group.kind} в {group.handler}\n{chat}{group.frame}\n{group.sample[:500]}\n{repeats}"
 
 # --- Command Handlers ---
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-	await update.message.reply_text("VanillaReaperBot at your service. Use /help for commands.")
+	reply(update.message, "VanillaReaperBot at your service. Use /help for commands.")
 
 async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 	text = (
 		"Доступные команды:\n"
 		"/roast (reply) — пошутить\n"
 		"/vanilla — ванильная фраза\n"
-		"/duel (reply или id1 id2) — дуэль\n"
-		"/roulette — рулетка\n"
+		"/duel (reply или id1 id2 / @user1 @user2) — дуэль\n"
+		"/roulette — рулетка, /roulette weights — веса исходов\n"
 		"/profile (reply) — профиль пользователя\n"
 		"/warn /mute /kick /ban — модерация (для админов)\n"
+		"  с причиной: /ban спам (reply); массово: /ban id1 id2 …, /ban joined 10 (вошедшие за 10 минут), /mute 10m id1 id2 …\n"
+		"/warns — предупреждения, /warnpolicy — наказания за варны\n"
+		"/silence — порог тишины в чате (для админов)\n"
+		"/phrases — набор фраз для чата (для админов)\n"
+		"/modlog [пользователь] [сколько] — журнал модерации (для админов)\n"
+		"/errors — ошибки бота (для владельца)\n"
 	)
 	keyboard = [
 		[InlineKeyboardButton("Роast", callback_data="roast"), InlineKeyboardButton("Vanilla", callback_data="vanilla")],
 		[InlineKeyboardButton("Рулетка", callback_data="roulette"), InlineKeyboardButton("Профиль", callback_data="profile")],
 		[InlineKeyboardButton("Инфо о боте", callback_data="botinfo")],
 	]
-	await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+	reply(update.message, text, reply_markup=InlineKeyboardMarkup(keyboard))
 
 async def addadmin(update: Update, context: ContextTypes.DEFAULT_TYPE):
 	user = update.effective_user
 	chat = update.effective_chat
 	if not is_owner(user.id):
-		return await update.message.reply_text("Только владелец может выдавать админов.")
+		return reply(update.message, "Только владелец может выдавать админов.", priority=PRIO_MODERATION)
 	if not context.args and not update.message.reply_to_message:
-		return await update.message.reply_text("Укажи пользователя через reply или @username.")
+		return reply(update.message, "Укажи пользователя через reply или @username.", priority=PRIO_MODERATION)
 	if update.message.reply_to_message:
 		target = update.message.reply_to_message.from_user
 	else:
-		try:
-			username = context.args[0]
-			member = await context.bot.get_chat_member(chat.id, username)
-			target = member.user
-		except Exception:
-			return await update.message.reply_text("Не удалось найти пользователя.")
-	ensure_chat_structs(chat.id)
-	admins[chat.id].add(target.id)
-	await update.message.reply_text(f"{target.mention_html()} теперь админ.", parse_mode="HTML")
+		target = (await user_index.resolve(chat.id, context.args[:1], context.bot))[0]
+		if target is None:
+			return reply(update.message, "Не удалось найти пользователя.", priority=PRIO_MODERATION)
+	state = chat_state(chat.id)
+	if state.admins is None:
+		state.admins = set()
+	state.admins.add(target.id)
+	storage.put("admins", chat.id, target.id)
+	journal.record(chat.id, "addadmin", user.id, target.id)
+	reply(update.message, f"{target.mention_html()} теперь админ.", parse_mode="HTML", priority=PRIO_MODERATION)
 
 async def removeadmin(update: Update, context: ContextTypes.DEFAULT_TYPE):
 	user = update.effective_user
 	chat = update.effective_chat
 	if not is_owner(user.id):
-		return await update.message.reply_text("Только владелец может снимать админов.")
+		return reply(update.message, "Только владелец может снимать админов.", priority=PRIO_MODERATION)
 	if update.message.reply_to_message:
 		target = update.message.reply_to_message.from_user
 	elif context.args:
-		try:
-			username = context.args[0]
-			member = await context.bot.get_chat_member(chat.id, username)
-			target = member.user
-		except Exception:
-			return await update.message.reply_text("Не удалось найти пользователя.")
+		target = (await user_index.resolve(chat.id, context.args[:1], context.bot))[0]
+		if target is None:
+			return reply(update.message, "Не удалось найти пользователя.", priority=PRIO_MODERATION)
 	else:
-		return await update.message.reply_text("Укажи пользователя через reply или @username.")
-	ensure_chat_structs(chat.id)
-	admins[chat.id].discard(target.id)
-	await update.message.reply_text(f"{target.mention_html()} больше не админ.", parse_mode="HTML")
+		return reply(update.message, "Укажи пользователя через reply или @username.", priority=PRIO_MODERATION)
+	admins = chat_state(chat.id).admins
+	if admins:
+		admins.discard(target.id)
+	storage.delete("admins", chat.id, target.id)
+	journal.record(chat.id, "removeadmin", user.id, target.id)
+	reply(update.message, f"{target.mention_html()} больше не админ.", parse_mode="HTML", priority=PRIO_MODERATION)
 
 async def setowner(update: Update, context: ContextTypes.DEFAULT_TYPE):
 	global OWNER_ID
 	user = update.effective_user
 	if not is_owner(user.id):
-		return await update.message.reply_text("Только владелец может передать владение.")
+		return reply(update.message, "Только владелец может передать владение.", priority=PRIO_MODERATION)
 	if update.message.reply_to_message:
 		target = update.message.reply_to_message.from_user
 	elif context.args:
-		try:
-			username = context.args[0]
-			member = await context.bot.get_chat_member(update.effective_chat.id, username)
-			target = member.user
-		except Exception:
-			return await update.message.reply_text("Не удалось найти пользователя.")
+		target = (await user_index.resolve(update.effective_chat.id, context.args[:1], context.bot))[0]
+		if target is None:
+			return reply(update.message, "Не удалось найти пользователя.", priority=PRIO_MODERATION)
 	else:
-		return await update.message.reply_text("Укажи пользователя через reply или @username.")
+		return reply(update.message, "Укажи пользователя через reply или @username.", priority=PRIO_MODERATION)
 	OWNER_ID = target.id
-	await update.message.reply_text(f"Владельцем теперь {target.mention_html()}", parse_mode="HTML")
-
-async def schedule_unmute(application: Application, chat_id: int, user_id: int, seconds: int):
-	await asyncio.sleep(seconds)
-	ensure_chat_structs(chat_id)
-	if user_id in mutes.get(chat_id, {}) and mutes[chat_id][user_id] <= datetime.utcnow().timestamp():
-		mutes[chat_id].pop(user_id, None)
-		try:
-			await try_unrestrict(chat_id, user_id, application.bot)
-		except Exception:
-			logger.exception("Scheduled unmute failed for %s in %s", user_id, chat_id)
-
+	storage.set_setting("owner_id", str(OWNER_ID))
+	shard_broadcast("owner", OWNER_ID)
+	journal.record(update.effective_chat.id, "setowner", user.id, target.id)
+	reply(update.message, f"Владельцем теперь {target.mention_html()}", parse_mode="HTML", priority=PRIO_MODERATION)
 
 async def admins_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
 	chat = update.effective_chat
-	ensure_chat_structs(chat.id)
 	owner_text = f"Владелец: <a href=\"tg://user?id={OWNER_ID}\">{OWNER_ID}</a>"
 	admin_texts = []
-	for a in admins.get(chat.id, set()):
+	for a in chat_state(chat.id).admins or ():
 		admin_texts.append(f"<a href=\"tg://user?id={a}\">{a}</a>")
 	text = owner_text + "\nАдмины: " + (", ".join(admin_texts) if admin_texts else "нет")
-	await update.message.reply_text(text, parse_mode="HTML")
+	chat_admin_ids = chat_admins.get(chat.id)
+	if chat_admin_ids:
+		text += "\nАдмины чата в Telegram: " + ", ".join(user_link(a) for a in sorted(chat_admin_ids))
+	reply(update.message, text, parse_mode="HTML", priority=PRIO_MODERATION)
 
 async def warn_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 	chat = update.effective_chat
 	user = update.effective_user
-	ensure_chat_structs(chat.id)
 	if not is_admin(user.id, chat.id):
-		return await update.message.reply_text("Только админы могут выдавать варны.")
+		return reply(update.message, "Только админы могут выдавать варны.", priority=PRIO_MODERATION)
+	if context.args and (looks_like_targets(context.args) or not update.message.reply_to_message):
+		return await bulk_moderate(update, context, "warn", context.args)
 	if not update.message.reply_to_message:
-		return await update.message.reply_text("Используй /warn в reply на сообщение пользователя.")
+		return reply(update.message, "Используй /warn в reply на сообщение пользователя или /warn id1 id2 ...", priority=PRIO_MODERATION)
 	target = update.message.reply_to_message.from_user
 	if is_owner(target.id):
-		return await update.message.reply_text("Нельзя предупреждать владельца.")
-	warns[chat.id].setdefault(target.id, 0)
-	warns[chat.id][target.id] += 1
-	count = warns[chat.id][target.id]
-	await update.message.reply_text(f"{target.mention_html()} получил предупреждение {count}/3.", parse_mode="HTML")
-	if count >= 3:
-		banned.setdefault(chat.id, set()).add(target.id)
-		try:
-			await context.bot.ban_chat_member(chat.id, target.id)
-		except Exception:
-			logger.exception("Не удалось забанить при 3 варнах.")
-		await update.message.reply_text(f"{target.mention_html()} забанен после 3 предупреждений.", parse_mode="HTML")
+		return reply(update.message, "Нельзя предупреждать владельца.", priority=PRIO_MODERATION)
+	reason = " ".join(context.args)
+	count = warn_ledger.add(chat.id, target.id, time.time())
+	journal.record(chat.id, "warn", user.id, target.id, count=count, **({"reason": reason} if reason else {}))
+	policy = warn_ledger.policy(chat.id)
+	text = f"{target.mention_html()} получил предупреждение ({count})."
+	upcoming = policy.next_after(count)
+	if upcoming:
+		text += f" На {upcoming[0]}: {describe_warn_action(upcoming[1])}."
+	reply(update.message, with_reason(text, reason), parse_mode="HTML", priority=PRIO_MODERATION)
+	action = policy.action_for(count)
+	if action is None:
+		return
+	try:
+		await enforce_warn_action(chat.id, target.id, action, context.bot)
+	except Exception:
+		logger.exception("Не удалось наказать за %d варнов.", count)
+		return reply(update.message, f"Не удалось применить {describe_warn_action(action)}: проверьте права бота.", priority=PRIO_MODERATION)
+	record_warn_action(chat.id, user.id, target.id, action, count)
+	reply(update.message, f"{target.mention_html()}: {describe_warn_action(action)} за {count} предупр.", parse_mode="HTML", priority=PRIO_MODERATION)
 
 async def warns_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 	chat = update.effective_chat
-	ensure_chat_structs(chat.id)
 	if update.message.reply_to_message:
 		target = update.message.reply_to_message.from_user
 	elif context.args:
-		try:
-			uid = int(context.args[0])
-			target = await context.bot.get_chat_member(chat.id, uid)
-			target = target.user
-		except Exception:
-			return await update.message.reply_text("Не удалось найти пользователя.")
+		target = (await user_index.resolve(chat.id, context.args[:1], context.bot))[0]
+		if target is None:
+			return reply(update.message, "Не удалось найти пользователя.", priority=PRIO_MODERATION)
 	else:
 		target = update.effective_user
-	count = warns[chat.id].get(target.id, 0)
-	await update.message.reply_text(f"У {target.mention_html()} предупреждений: {count}", parse_mode="HTML")
+	count = warn_ledger.count(chat.id, target.id, time.time())
+	text = f"У {target.mention_html()} предупреждений: {count}"
+	if WARN_TTL:
+		text += f" (за последние {format_duration(WARN_TTL)})"
+	reply(update.message, text, parse_mode="HTML", priority=PRIO_MODERATION)
+
+async def warnpolicy_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+	chat = update.effective_chat
+	args = context.args
+	if not args:
+		ttl = f"Варн сгорает через {format_duration(WARN_TTL)}." if WARN_TTL else "Варны не сгорают."
+		return reply(update.message, f"Наказания за варны: {format_warn_policy(warn_ledger.policy(chat.id))}. {ttl}\nИзменить (для админов): /warnpolicy 3=mute:1h 5=ban, /warnpolicy off или /warnpolicy default", priority=PRIO_MODERATION)
+	if not is_admin(update.effective_user.id, chat.id):
+		return reply(update.message, "Только админы могут менять наказания за варны.", priority=PRIO_MODERATION)
+	arg = args[0].lower()
+	if arg == "default":
+		warn_ledger.set_policy(chat.id, None)
+	elif arg == "off":
+		warn_ledger.set_policy(chat.id, WarnPolicy({}))
+	else:
+		try:
+			warn_ledger.set_policy(chat.id, WarnPolicy.parse(" ".join(args)))
+		except ValueError as e:
+			return reply(update.message, f"Не понял правило: {e}. Пример: /warnpolicy 3=mute:1h 5=ban", priority=PRIO_MODERATION)
+	reply(update.message, f"Наказания за варны: {format_warn_policy(warn_ledger.policy(chat.id))}.", priority=PRIO_MODERATION)
 
 async def mute_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 	chat = update.effective_chat
 	user = update.effective_user
 	if not is_admin(user.id, chat.id):
-		return await update.message.reply_text("Только админы могут мутить.")
+		return reply(update.message, "Только админы могут мутить.", priority=PRIO_MODERATION)
+	# /mute [duration] [targets | reason]; the first argument is a duration only if it parses as one
+	args = list(context.args)
+	seconds = 60
+	if args:
+		try:
+			seconds = parse_duration(args[0])
+		except ValueError:
+			pass
+		else:
+			args.pop(0)
+			if seconds > MUTE_MAX:
+				return reply(update.message, f"Слишком долгий мут: не больше {format_duration(MUTE_MAX)}. Длительность идёт первой: /mute 10m id1 id2", priority=PRIO_MODERATION)
+	if args and (looks_like_targets(args) or not update.message.reply_to_message):
+		return await bulk_moderate(update, context, "mute", args, seconds)
 	if not update.message.reply_to_message:
-		return await update.message.reply_text("Используй /mute в reply на сообщение пользователя.")
-	try:
-		seconds = int(context.args[0]) if context.args else 60
-	except Exception:
-		seconds = 60
+		return reply(update.message, "Используй /mute в reply на сообщение пользователя или /mute <длительность> id1 id2 ...", priority=PRIO_MODERATION)
 	target = update.message.reply_to_message.from_user
 	if is_owner(target.id):
-		return await update.message.reply_text("Нельзя мутить владельца.")
+		return reply(update.message, "Нельзя мутить владельца.", priority=PRIO_MODERATION)
+	reason = " ".join(args)
 	until = datetime.utcnow() + timedelta(seconds=seconds)
 	ok = await try_restrict(chat.id, target.id, until, context.bot)
 	if not ok:
-		return await update.message.reply_text("У меня нет прав ограничивать пользователей. Сделайте бота админом с правом 'Ban users' / 'Restrict members'.")
-	mutes.setdefault(chat.id, {})[target.id] = until.timestamp()
-
-	# schedule unmute via asyncio task
-	async def unmute_later(chat_id: int, user_id: int, delay: int, bot):
-		await asyncio.sleep(delay)
-		ensure_chat_structs(chat_id)
-		if user_id in mutes.get(chat_id, {}) and mutes[chat_id][user_id] <= datetime.utcnow().timestamp():
-			mutes[chat_id].pop(user_id, None)
-			await try_unrestrict(chat_id, user_id, bot)
-
-	asyncio.create_task(unmute_later(chat.id, target.id, seconds, context.bot))
-	await update.message.reply_text(f"{target.mention_html()} замучен на {seconds} секунд.", parse_mode="HTML")
+		return reply(update.message, "У меня нет прав ограничивать пользователей. Сделайте бота админом с правом 'Ban users' / 'Restrict members'.", priority=PRIO_MODERATION)
+	unmute_scheduler.schedule(chat.id, target.id, until.timestamp())
+	journal.record(chat.id, "mute", user.id, target.id, seconds=seconds, **({"reason": reason} if reason else {}))
+	reply(update.message, with_reason(f"{target.mention_html()} замучен на {seconds} секунд.", reason), parse_mode="HTML", priority=PRIO_MODERATION)
 
 async def unmute_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 	chat = update.effective_chat
 	user = update.effective_user
 	if not is_admin(user.id, chat.id):
-		return await update.message.reply_text("Только админы могут снимать мюты.")
+		return reply(update.message, "Только админы могут снимать мюты.", priority=PRIO_MODERATION)
 	if not update.message.reply_to_message and not context.args:
-		return await update.message.reply_text("Укажи пользователя через reply или ID.")
+		return reply(update.message, "Укажи пользователя через reply или ID.", priority=PRIO_MODERATION)
 	if update.message.reply_to_message:
 		target = update.message.reply_to_message.from_user
 	else:
-		try:
-			uid = int(context.args[0])
-			target = await context.bot.get_chat_member(chat.id, uid)
-			target = target.user
-		except Exception:
-			return await update.message.reply_text("Не удалось найти пользователя.")
-	mutes.get(chat.id, {}).pop(target.id, None)
-	await try_unrestrict(chat.id, target.id, context.bot)
-	await update.message.reply_text(f"{target.mention_html()} размучен.", parse_mode="HTML")
+		target = (await user_index.resolve(chat.id, context.args[:1], context.bot))[0]
+		if target is None:
+			return reply(update.message, "Не удалось найти пользователя.", priority=PRIO_MODERATION)
+	unmute_scheduler.cancel(chat.id, target.id)
+	if await try_unrestrict(chat.id, target.id, context.bot):
+		journal.record(chat.id, "unmute", user.id, target.id)
+	reply(update.message, f"{target.mention_html()} размучен.", parse_mode="HTML", priority=PRIO_MODERATION)
 
 async def kick_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 	chat = update.effective_chat
 	user = update.effective_user
 	if not is_admin(user.id, chat.id):
-		return await update.message.reply_text("Только админы могут кикать.")
+		return reply(update.message, "Только админы могут кикать.", priority=PRIO_MODERATION)
+	if context.args and (looks_like_targets(context.args) or not update.message.reply_to_message):
+		return await bulk_moderate(update, context, "kick", context.args)
 	if not update.message.reply_to_message:
-		return await update.message.reply_text("Используй /kick в reply на сообщение.")
+		return reply(update.message, "Используй /kick в reply на сообщение или /kick id1 id2 ...", priority=PRIO_MODERATION)
 	target = update.message.reply_to_message.from_user
 	if is_owner(target.id):
-		return await update.message.reply_text("Нельзя кикнуть владельца.")
-	# check bot privileges
-	bot_me = await context.bot.get_me()
-	try:
-		bot_member = await context.bot.get_chat_member(chat.id, bot_me.id)
-		can_restrict = getattr(bot_member, "can_restrict_members", False) or bot_member.status == ChatMember.CREATOR
-	except Exception:
-		can_restrict = False
-	if not can_restrict:
-		return await update.message.reply_text("У меня нет прав кикать/банить пользователей. Сделайте бота админом с правом 'Ban users'.")
+		return reply(update.message, "Нельзя кикнуть владельца.", priority=PRIO_MODERATION)
+	# check bot privileges (cached per chat)
+	if not await bot_can_restrict(chat.id, context.bot):
+		return reply(update.message, "У меня нет прав кикать/банить пользователей. Сделайте бота админом с правом 'Ban users'.", priority=PRIO_MODERATION)
 	try:
 		await context.bot.ban_chat_member(chat.id, target.id)
 		await context.bot.unban_chat_member(chat.id, target.id)
-		await update.message.reply_text(f"{target.mention_html()} кикнут.", parse_mode="HTML")
+		reason = " ".join(context.args)
+		journal.record(chat.id, "kick", user.id, target.id, **({"reason": reason} if reason else {}))
+		reply(update.message, with_reason(f"{target.mention_html()} кикнут.", reason), parse_mode="HTML", priority=PRIO_MODERATION)
 	except Exception:
 		logger.exception("kick failed")
-		await update.message.reply_text("Не удалось кикнуть пользователя.")
+		reply(update.message, "Не удалось кикнуть пользователя.", priority=PRIO_MODERATION)
 
 async def ban_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 	chat = update.effective_chat
 	user = update.effective_user
 	if not is_admin(user.id, chat.id):
-		return await update.message.reply_text("Только админы могут банить.")
+		return reply(update.message, "Только админы могут банить.", priority=PRIO_MODERATION)
+	if context.args and (looks_like_targets(context.args) or not update.message.reply_to_message):
+		return await bulk_moderate(update, context, "ban", context.args)
 	if not update.message.reply_to_message:
-		return await update.message.reply_text("Используй /ban в reply на сообщение.")
+		return reply(update.message, "Используй /ban в reply на сообщение или /ban id1 id2 ...", priority=PRIO_MODERATION)
 	target = update.message.reply_to_message.from_user
 	if is_owner(target.id):
-		return await update.message.reply_text("Нельзя банить владельца.")
-	# check bot privileges
-	bot_me = await context.bot.get_me()
-	try:
-		bot_member = await context.bot.get_chat_member(chat.id, bot_me.id)
-		can_restrict = getattr(bot_member, "can_restrict_members", False) or bot_member.status == ChatMember.CREATOR
-	except Exception:
-		can_restrict = False
-	if not can_restrict:
-		return await update.message.reply_text("У меня нет прав банить пользователей. Сделайте бота админом с правом 'Ban users'.")
+		return reply(update.message, "Нельзя банить владельца.", priority=PRIO_MODERATION)
+	# check bot privileges (cached per chat)
+	if not await bot_can_restrict(chat.id, context.bot):
+		return reply(update.message, "У меня нет прав банить пользователей. Сделайте бота админом с правом 'Ban users'.", priority=PRIO_MODERATION)
 	try:
 		await context.bot.ban_chat_member(chat.id, target.id)
-		banned.setdefault(chat.id, set()).add(target.id)
-		await update.message.reply_text(f"{target.mention_html()} забанен.", parse_mode="HTML")
+		mark_banned(chat.id, target.id)
+		reason = " ".join(context.args)
+		journal.record(chat.id, "ban", user.id, target.id, **({"reason": reason} if reason else {}))
+		reply(update.message, with_reason(f"{target.mention_html()} забанен.", reason), parse_mode="HTML", priority=PRIO_MODERATION)
 	except Exception:
 		logger.exception("ban failed")
-		await update.message.reply_text("Не удалось забанить пользователя.")
+		reply(update.message, "Не удалось забанить пользователя.", priority=PRIO_MODERATION)
 
 async def unban_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 	chat = update.effective_chat
 	user = update.effective_user
 	if not is_admin(user.id, chat.id):
-		return await update.message.reply_text("Только админы могут разбанить.")
+		return reply(update.message, "Только админы могут разбанить.", priority=PRIO_MODERATION)
 	if not context.args:
-		return await update.message.reply_text("Укажи ID пользователя: /unban <user_id>")
-	# check bot privileges
-	bot_me = await context.bot.get_me()
-	try:
-		bot_member = await context.bot.get_chat_member(chat.id, bot_me.id)
-		can_restrict = getattr(bot_member, "can_restrict_members", False) or bot_member.status == ChatMember.CREATOR
-	except Exception:
-		can_restrict = False
-	if not can_restrict:
-		return await update.message.reply_text("У меня нет прав разбанивать пользователей. Сделайте бота админом с правом 'Ban users'.")
+		return reply(update.message, "Укажи ID пользователя: /unban <user_id>", priority=PRIO_MODERATION)
+	# check bot privileges (cached per chat)
+	if not await bot_can_restrict(chat.id, context.bot):
+		return reply(update.message, "У меня нет прав разбанивать пользователей. Сделайте бота админом с правом 'Ban users'.", priority=PRIO_MODERATION)
 	try:
 		uid = int(context.args[0])
 		await context.bot.unban_chat_member(chat.id, uid)
-		banned.get(chat.id, set()).discard(uid)
-		await update.message.reply_text(f"Пользователь {uid} разбанен.")
+		banned = chat_state(chat.id).banned
+		if banned:
+			banned.discard(uid)
+		storage.delete("banned", chat.id, uid)
+		journal.record(chat.id, "unban", user.id, uid)
+		reply(update.message, f"Пользователь {uid} разбанен.", priority=PRIO_MODERATION)
 	except Exception:
 		logger.exception("unban failed")
-		await update.message.reply_text("Не удалось разбанить пользователя.")
+		reply(update.message, "Не удалось разбанить пользователя.", priority=PRIO_MODERATION)
 
 async def roast_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 	if update.message.reply_to_message:
 		target = update.message.reply_to_message.from_user
 	else:
 		target = update.effective_user
-	text = random.choice(ROASTS)
-	await update.message.reply_text(f"{target.mention_html()} — {text}", parse_mode="HTML")
+	# pack phrases are plain text, the message is HTML for the mention
+	text = html.escape(phrase_book.draw(update.effective_chat.id, "roasts"))
+	reply(update.message, f"{target.mention_html()} — {text}", parse_mode="HTML")
 
 
-async def botinfo_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-	chat = update.effective_chat
-	bot_me = await context.bot.get_me()
-	info_lines = [f"Бот: @{bot_me.username} (id={bot_me.id})"]
-	try:
-		member = await context.bot.get_chat_member(chat.id, bot_me.id)
+async def botinfo_text(chat_id: int, bot) -> str:
+	if BOT_ID is None:
+		await load_bot_identity(bot)
+	info_lines = [f"Бот: @{BOT_USERNAME} (id={BOT_ID})"]
+	member = await get_bot_member(chat_id, bot)
+	if member is not None:
 		info_lines.append(f"Статус бота в чате: {member.status}")
 		flags = []
 		if getattr(member, 'can_restrict_members', False):
@@ -526,77 +2836,66 @@ async def botinfo_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 			flags.append('can_promote_members')
 		if flags:
 			info_lines.append('Права: ' + ', '.join(flags))
-	except Exception:
+	else:
 		info_lines.append('Не удалось получить статус бота в этом чате.')
-	await update.message.reply_text('\n'.join(info_lines))
+	info_lines.append(f"Очередь отправки: {outbox.depth()}")
+	state = chat_states.peek(chat_id)
+	if state is not None:
+		info_lines.append(f"Память на этот чат: ~{state.nbytes()} Б, чатов в памяти: {len(chat_states)}")
+	return '\n'.join(info_lines)
+
+async def botinfo_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+	text = await botinfo_text(update.effective_chat.id, context.bot)
+	reply(update.message, text)
 
 async def vanilla_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-	text = random.choice(VANILLA)
-	await update.message.reply_text(text)
+	text = phrase_book.draw(update.effective_chat.id, "vanilla")
+	reply(update.message, text)
 
 async def duel_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 	chat = update.effective_chat
 	if len(context.args) >= 2:
-		# try parse two IDs
-		try:
-			a = int(context.args[0])
-			b = int(context.args[1])
-		except Exception:
-			return await update.message.reply_text("Укажи два ID через пробел или используй reply+command.")
-		a_user = await context.bot.get_chat_member(chat.id, a)
-		b_user = await context.bot.get_chat_member(chat.id, b)
-		names = (a_user.user, b_user.user)
+		names = await user_index.resolve(chat.id, context.args[:2], context.bot)
+		if None in names:
+			return reply(update.message, "Не нашёл участников. Укажи два ID или @username через пробел или используй reply+command.")
 	elif update.message.reply_to_message:
 		names = (update.effective_user, update.message.reply_to_message.from_user)
 	else:
-		return await update.message.reply_text("Используй /duel в reply или укажи два ID.")
+		return reply(update.message, "Используй /duel в reply или укажи два ID.")
 	winner = random.choice(names)
-	await update.message.reply_text(f"Дуэль! Победитель: {winner.mention_html()}", parse_mode="HTML")
+	reply(update.message, f"Дуэль! Победитель: {winner.mention_html()}", parse_mode="HTML")
 
 async def roulette_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 	chat = update.effective_chat
 	user = update.effective_user
-	ensure_chat_structs(chat.id)
+	if context.args and context.args[0].lower() == "weights":
+		return roulette_weights_cmd(update, context.args[1:])
 	# target from reply or user
 	target = update.message.reply_to_message.from_user if update.message.reply_to_message else user
-	roll = random.choice(["nothing", "short_mute", "long_mute", "roast", "honor", "victim"])
-	if roll == "nothing":
-		await update.message.reply_text("Колесо крутится... Ничего не получилось. Удача не для тебя.")
-	elif roll == "short_mute":
-		seconds = 30
-		until = datetime.utcnow() + timedelta(seconds=seconds)
-		await try_restrict(chat.id, target.id, until, context.bot)
-		mutes.setdefault(chat.id, {})[target.id] = until.timestamp()
-		# schedule unmute via asyncio
-		async def _u():
-			await asyncio.sleep(seconds)
-			await try_unrestrict(chat.id, target.id, context.bot)
-
-		asyncio.create_task(_u())
-		await update.message.reply_text(f"Колесо выбрало мут на {seconds} секунд для {target.mention_html()}.", parse_mode="HTML")
-	elif roll == "long_mute":
-		seconds = 300
-		until = datetime.utcnow() + timedelta(seconds=seconds)
-		await try_restrict(chat.id, target.id, until, context.bot)
-		mutes.setdefault(chat.id, {})[target.id] = until.timestamp()
-		# schedule unmute via asyncio
-		async def _u2():
-			await asyncio.sleep(seconds)
-			await try_unrestrict(chat.id, target.id, context.bot)
-
-		asyncio.create_task(_u2())
-		await update.message.reply_text(f"О, длинный мут: {seconds} секунд для {target.mention_html()}.", parse_mode="HTML")
-	elif roll == "roast":
-		await update.message.reply_text(f"Рулетка выдала ростер: {random.choice(ROASTS)}")
-	elif roll == "honor":
-		await update.message.reply_text(f"Честь дана {target.mention_html()} — минутой молчания.", parse_mode="HTML")
-	elif roll == "victim":
-		# set victim of day
-		victim_of_day[chat.id] = target.id
-		await update.message.reply_text(f"Жертва дня: {target.mention_html()}.", parse_mode="HTML")
+	outcome, wait = roulette.spin(chat.id, user.id, time.monotonic())
+	if outcome is None:
+		return reply(update.message, f"Колесо ещё крутится. Попробуй через {int(wait) + 1} сек.")
+	text = await roulette.apply(outcome, chat.id, target, context.bot)
+	reply(update.message, text, parse_mode="HTML")
+
+def roulette_weights_cmd(update: Update, args: List[str]):
+	chat = update.effective_chat
+	if not args:
+		return reply(update.message, f"Веса рулетки: {format_roulette_weights(roulette.weights(chat.id))}.\nИзменить (для админов): /roulette weights short_mute=2 long_mute=0 или /roulette weights default")
+	if not is_admin(update.effective_user.id, chat.id):
+		return reply(update.message, "Только админы могут менять веса рулетки.", priority=PRIO_MODERATION)
+	if args[0].lower() == "default":
+		roulette.set_weights(chat.id, None)
+		return reply(update.message, f"Веса рулетки сброшены: {format_roulette_weights(DEFAULT_ROULETTE_WEIGHTS)}.", priority=PRIO_MODERATION)
+	try:
+		weights = parse_roulette_weights(" ".join(args), roulette.weights(chat.id))
+	except ValueError as e:
+		return reply(update.message, f"Не понял веса: {e}.", priority=PRIO_MODERATION)
+	roulette.set_weights(chat.id, weights)
+	reply(update.message, f"Веса рулетки: {format_roulette_weights(weights)}.", priority=PRIO_MODERATION)
 
 async def search_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
-	await update.message.reply_text("Провожу саркастический обыск... Нашёл только тонкие оправдания и плохой вкус.")
+	reply(update.message, "Провожу саркастический обыск... Нашёл только тонкие оправдания и плохой вкус.")
 
 async def profile_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 	chat = update.effective_chat
@@ -604,10 +2903,10 @@ async def profile_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 		target = update.message.reply_to_message.from_user
 	else:
 		target = update.effective_user
-	ensure_chat_structs(chat.id)
-	w = warns.get(chat.id, {}).get(target.id, 0)
-	mute_until = mutes.get(chat.id, {}).get(target.id)
-	victim = victim_of_day.get(chat.id)
+	state = chat_state(chat.id)
+	w = warn_ledger.count(chat.id, target.id, time.time())
+	mute_until = state.mutes.get(target.id) if state.mutes else None
+	victim = state.victim
 	text = f"Профиль {target.mention_html()}:\nПредупреждения: {w}\n"
 	if mute_until:
 		remaining = int(mute_until - datetime.utcnow().timestamp())
@@ -615,7 +2914,7 @@ async def profile_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 	else:
 		text += "Мут: нет\n"
 	text += f"Жертва дня: {('Да' if victim == target.id else 'Нет')}"
-	await update.message.reply_text(text, parse_mode="HTML")
+	reply(update.message, text, parse_mode="HTML")
 
 
 async def commands_button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -623,62 +2922,37 @@ async def commands_button_handler(update: Update, context: ContextTypes.DEFAULT_
 	query = update.callback_query
 	if not query:
 		return
-	await query.answer()
 	data = query.data
 	chat = query.message.chat
 	bot = context.bot
 	user = query.from_user
+	if data == 'roulette':
+		outcome, wait = roulette.spin(chat.id, user.id, time.monotonic())
+		if outcome is None:
+			return await query.answer(f"Колесо ещё крутится. Попробуй через {int(wait) + 1} сек.")
+	await query.answer()
 
 	if data == 'roast':
 		if query.message.reply_to_message:
 			target = query.message.reply_to_message.from_user
 		else:
 			target = user
-		await bot.send_message(chat.id, f"{target.mention_html()} — {random.choice(ROASTS)}", parse_mode="HTML")
+		send(bot, chat.id, f"{target.mention_html()} — {html.escape(phrase_book.draw(chat.id, 'roasts'))}", parse_mode="HTML")
 	elif data == 'vanilla':
-		await bot.send_message(chat.id, random.choice(VANILLA))
+		send(bot, chat.id, phrase_book.draw(chat.id, "vanilla"))
 	elif data == 'roulette':
 		if query.message.reply_to_message:
 			target = query.message.reply_to_message.from_user
 		else:
 			target = user
-		roll = random.choice(["nothing", "short_mute", "long_mute", "roast", "honor", "victim"]) 
-		if roll == "nothing":
-			await bot.send_message(chat.id, "Колесо крутится... Ничего не получилось. Удача не для тебя.")
-		elif roll == "short_mute":
-			seconds = 30
-			until = datetime.utcnow() + timedelta(seconds=seconds)
-			ok = await try_restrict(chat.id, target.id, until, bot)
-			if not ok:
-				await bot.send_message(chat.id, "У меня нет прав мутить пользователя. Сделайте бота админом.")
-			else:
-				mutes.setdefault(chat.id, {})[target.id] = until.timestamp()
-				asyncio.create_task(schedule_unmute(context.application, chat.id, target.id, seconds))
-				await bot.send_message(chat.id, f"Колесо выбрало мут на {seconds} секунд для {target.mention_html()}.", parse_mode="HTML")
-		elif roll == "long_mute":
-			seconds = 300
-			until = datetime.utcnow() + timedelta(seconds=seconds)
-			ok = await try_restrict(chat.id, target.id, until, bot)
-			if not ok:
-				await bot.send_message(chat.id, "У меня нет прав мутить пользователя. Сделайте бота админом.")
-			else:
-				mutes.setdefault(chat.id, {})[target.id] = until.timestamp()
-				asyncio.create_task(schedule_unmute(context.application, chat.id, target.id, seconds))
-				await bot.send_message(chat.id, f"О, длинный мут: {seconds} секунд для {target.mention_html()}.", parse_mode="HTML")
-		elif roll == "roast":
-			await bot.send_message(chat.id, f"Рулетка выдала ростер: {random.choice(ROASTS)}")
-		elif roll == "honor":
-			await bot.send_message(chat.id, f"Честь дана {target.mention_html()} — минутой молчания.", parse_mode="HTML")
-		elif roll == "victim":
-			victim_of_day[chat.id] = target.id
-			await bot.send_message(chat.id, f"Жертва дня: {target.mention_html()}.", parse_mode="HTML")
+		send(bot, chat.id, await roulette.apply(outcome, chat.id, target, bot), parse_mode="HTML")
 	elif data == 'duel':
-		await bot.send_message(chat.id, 'Используйте /duel в reply на сообщение или укажите 2 ID: /duel <id1> <id2>')
+		send(bot, chat.id, 'Используйте /duel в reply на сообщение или укажите 2 ID: /duel <id1> <id2>')
 	elif data == 'profile':
-		await bot.send_message(chat.id, 'Используйте /profile в reply на сообщение пользователя, чтобы увидеть профиль.')
+		send(bot, chat.id, 'Используйте /profile в reply на сообщение пользователя, чтобы увидеть профиль.')
 	elif data == 'botinfo':
 		try:
-			await botinfo_cmd(query.message, context)
+			send(bot, chat.id, await botinfo_text(chat.id, bot))
 		except Exception:
 			logger.exception('botinfo via callback failed')
 
@@ -687,122 +2961,1068 @@ async def sacrifice_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 	chat = update.effective_chat
 	user = update.effective_user
 	if not is_admin(user.id, chat.id):
-		return await update.message.reply_text("Только админы могут выбирать жертву дня.")
-	ensure_chat_structs(chat.id)
-	pool = list(recent_activity.get(chat.id, set()))
-	if not pool:
-		return await update.message.reply_text("Нет активных пользователей для выбора.")
-	victim = random.choice(pool)
-	victim_of_day[chat.id] = victim
-	await update.message.reply_text(f"Жертва дня: <a href=\"tg://user?id={victim}\">{victim}</a>", parse_mode="HTML")
+		return reply(update.message, "Только админы могут выбирать жертву дня.")
+	state = chat_state(chat.id)
+	victim = state.activity.sample(time.monotonic()) if state.activity else None
+	if victim is None:
+		return reply(update.message, "Нет активных пользователей для выбора.")
+	state.victim = victim
+	storage.put("victims", chat.id, victim)
+	reply(update.message, f"Жертва дня: <a href=\"tg://user?id={victim}\">{victim}</a>", parse_mode="HTML")
+
+async def silence_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+	chat = update.effective_chat
+	user = update.effective_user
+	if not is_admin(user.id, chat.id):
+		return reply(update.message, "Только админы могут настраивать тишину.", priority=PRIO_MODERATION)
+	if not context.args:
+		seconds = silence_detector.threshold(chat.id)
+		state = f"{seconds} секунд" if seconds > 0 else "выключено"
+		return reply(update.message, f"Напоминание о тишине: {state}.\nИспользуй /silence <секунды|off|default>.", priority=PRIO_MODERATION)
+	arg = context.args[0].lower()
+	if arg == "off":
+		silence_detector.set_threshold(chat.id, 0)
+		return reply(update.message, "Больше не буду будить этот чат.", priority=PRIO_MODERATION)
+	if arg == "default":
+		silence_detector.set_threshold(chat.id, None)
+		return reply(update.message, f"Порог тишины сброшен: {SILENCE_THRESHOLD} секунд.", priority=PRIO_MODERATION)
+	try:
+		seconds = int(arg)
+	except ValueError:
+		seconds = 0
+	if seconds < 60:
+		return reply(update.message, "Укажи число секунд (не меньше 60), off или default.", priority=PRIO_MODERATION)
+	silence_detector.set_threshold(chat.id, seconds)
+	reply(update.message, f"Буду будить чат после {seconds} секунд тишины.", priority=PRIO_MODERATION)
+
+MODLOG_LABELS = {
+	"warn": "варн", "mute": "мут", "unmute": "размут", "kick": "кик", "ban": "бан", "unban": "разбан",
+	"addadmin": "новый админ", "removeadmin": "снят админ", "setowner": "новый владелец",
+}
+
+def format_modlog_entry(entry: dict) -> str:
+	when = datetime.fromtimestamp(entry["ts"], timezone.utc).strftime("%d.%m %H:%M")
+	text = f"{when} {MODLOG_LABELS.get(entry['action'], entry['action'])}"
+	if entry.get("target") is not None:
+		text += f" {user_link(entry['target'])}"
+	if entry.get("seconds"):
+		text += f" на {entry['seconds']} с"
+	if entry.get("count"):
+		text += f" (№{entry['count']})"
+	if entry.get("actor") is not None:
+		text += f" — {user_link(entry['actor'])}"
+		if entry.get("reason"):
+			text += f": {html.escape(entry['reason'])}"
+	elif entry.get("reason"):
+		text += f" — {html.escape(entry['reason'])}"
+	return text
+
+async def modlog_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+	chat = update.effective_chat
+	user = update.effective_user
+	if not is_admin(user.id, chat.id):
+		return reply(update.message, "Только админы могут смотреть журнал модерации.", priority=PRIO_MODERATION)
+	# /modlog [user] [count]; the user may also come from a reply
+	args = list(context.args)
+	limit = 10
+	if args and args[-1].isdigit() and (len(args) > 1 or update.message.reply_to_message):
+		limit = min(50, max(1, int(args.pop())))
+	target = None
+	if update.message.reply_to_message:
+		target = update.message.reply_to_message.from_user
+	elif args:
+		target = (await user_index.resolve(chat.id, args[:1], context.bot))[0]
+		if target is None:
+			return reply(update.message, "Не удалось найти пользователя.", priority=PRIO_MODERATION)
+	entries = await journal.query(chat.id, target.id if target else None, limit)
+	if not entries:
+		return reply(update.message, "В журнале пусто.", priority=PRIO_MODERATION)
+	title = f"Журнал модерации для {target.mention_html()}" if target else "Журнал модерации"
+	lines = [title + " (UTC):"] + [format_modlog_entry(e) for e in entries]
+	reply(update.message, "\n".join(lines), parse_mode="HTML", priority=PRIO_MODERATION)
+
+async def errors_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+	if not is_owner(update.effective_user.id):
+		return reply(update.message, "Только владелец может смотреть ошибки бота.")
+	if context.args and context.args[0].lower() == "clear":
+		error_log.clear()
+		return reply(update.message, "Список ошибок очищен.")
+	groups = error_log.groups()
+	if not groups:
+		return reply(update.message, "Ошибок не было.")
+	lines = [f"Ошибки{shard_label()} (UTC, свежие сверху): всего {sum(g.count for g in groups)}, групп {len(groups)}"]
+	lines += [format_error_group(g, g.count) for g in groups[:20]]
+	if len(groups) > 20:
+		lines.append(f"…и ещё групп: {len(groups) - 20}")
+	reply(update.message, "\n".join(lines))
+
+async def phrases_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+	chat = update.effective_chat
+	user = update.effective_user
+	if not is_admin(user.id, chat.id):
+		return reply(update.message, "Только админы могут менять набор фраз.", priority=PRIO_MODERATION)
+	state = chat_state(chat.id)
+	if not context.args:
+		current = state.phrase_pack or PHRASES_PACK
+		available = ", ".join(phrase_book.packs())
+		return reply(update.message, f"Набор фраз: {current}.\nДоступны: {available}.\nИспользуй /phrases <набор|reset>.", priority=PRIO_MODERATION)
+	name = context.args[0]
+	if name.lower() == "reset":
+		state.phrase_pack = None
+		storage.delete("phrases", chat.id)
+		return reply(update.message, f"Набор фраз сброшен: {PHRASES_PACK}.", priority=PRIO_MODERATION)
+	if not phrase_book.has_pack(name):
+		return reply(update.message, "Нет такого набора. Посмотри список: /phrases", priority=PRIO_MODERATION)
+	state.phrase_pack = name
+	storage.put("phrases", chat.id, name)
+	reply(update.message, f"Теперь говорю фразами из набора {name}.", priority=PRIO_MODERATION)
 
 # --- Message and chat handlers ---
+def addressed_to_bot(msg) -> bool:
+	replied = msg.reply_to_message
+	if replied is not None and replied.from_user is not None and replied.from_user.id == BOT_ID:
+		return True
+	entities = msg.entities or msg.caption_entities
+	if not entities:
+		return False
+	has_mention = False
+	for ent in entities:
+		if ent.type == MessageEntity.MENTION:
+			has_mention = True
+		elif ent.type == MessageEntity.TEXT_MENTION and ent.user is not None and ent.user.id == BOT_ID:
+			return True
+	if not has_mention or BOT_MENTION_RE is None:
+		return False
+	return BOT_MENTION_RE.search(msg.text or msg.caption or "") is not None
+
 async def on_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+	# hot path for every non-command message: no Bot API calls and no
+	# allocations beyond the activity update unless the bot has to answer
 	msg = update.message
 	if not msg:
 		return
+	user = msg.from_user
 	# ignore bots
-	if msg.from_user and msg.from_user.is_bot:
+	if user is None or user.is_bot:
 		return
-	chat_id = update.effective_chat.id
-	ensure_chat_structs(chat_id)
-	uid = msg.from_user.id
+	chat = msg.chat
+	chat_id = chat.id
+	state = chat_state(chat_id)
+	if msg.new_chat_members:
+		for member in msg.new_chat_members:
+			record_join(chat_id, member.id)
+			user_index.see(chat_id, member, time.time())
 	# track activity and last message
-	recent_activity[chat_id].add(uid)
-	last_message_time[chat_id] = datetime.utcnow().timestamp()
-
-	# auto replies: only on mention, reply-to-bot, or in private chat
-	text = (msg.text or msg.caption or "")
-	is_private = update.effective_chat.type == 'private'
-	bot_username = globals().get('BOT_USERNAME')
-	mentioned = False
-	if msg.entities:
-		for ent in msg.entities:
-			if ent.type in ('mention', 'text_mention'):
-				ent_text = text[ent.offset: ent.offset + ent.length]
-				if bot_username and bot_username.lower() in ent_text.lower():
-					mentioned = True
-					break
-	if is_private or mentioned or (msg.reply_to_message and msg.reply_to_message.from_user and msg.reply_to_message.from_user.id == (await context.bot.get_me()).id):
-		await msg.reply_text(random.choice(VANILLA + AGGRO))
+	now = time.monotonic()
+	wall = time.time()
+	if chat.type != 'private':
+		# only groups pick a victim among active users
+		if state.activity is None:
+			state.activity = ActivityWindow()
+		state.activity.touch(user.id, now)
+	silence_detector.touch(chat_id, wall)
+	user_index.see(chat_id, user, wall)
+	replied = msg.reply_to_message
+	if replied is not None and replied.from_user is not None and not replied.from_user.is_bot:
+		user_index.see(chat_id, replied.from_user, wall)
+	if FLOOD_MUTE and chat.type != 'private' and flood_guard.hit(chat_id, user.id, now):
+		if not (state.mutes and user.id in state.mutes) and not is_admin(user.id, chat_id):
+			context.application.create_task(punish_flood(chat_id, user, context.bot), update=update)
+		else:
+			flood_guard.rearm(chat_id, user.id)
+
+	# auto replies: only in private chat, on reply-to-bot or on mention
+	if chat.type != 'private' and not addressed_to_bot(msg):
+		return
+	reply(msg, phrase_book.draw(chat_id, "chatter"), priority=PRIO_CHATTER)
+
+# --- Silence detection ---
+class SilenceDetector:
+	# Min-heap of (deadline, chat_id) with at most one live entry per chat
+	# (`_armed`). on_message only bumps ChatState.last_message; when an entry comes
+	# due and the chat has spoken since, it is re-armed at last message +
+	# threshold. So the loop wakes only when some chat can actually be idle.
+
+	def __init__(self):
+		self._heap: List[Tuple[float, int]] = []
+		self._armed: Dict[int, float] = {}
+		self._wakeup = asyncio.Event()
+		self._task: Optional[asyncio.Task] = None
+
+	def __len__(self) -> int:
+		return len(self._armed)
+
+	def threshold(self, chat_id: int) -> int:
+		state = chat_states.peek(chat_id)
+		if state is None or state.silence is None:
+			return SILENCE_THRESHOLD
+		return state.silence
+
+	def touch(self, chat_id: int, now_ts: float):
+		chat_states.peek(chat_id).last_message = now_ts
+		if chat_id not in self._armed:
+			self._arm(chat_id, now_ts + self.threshold(chat_id))
 
-async def check_silence_job(context: ContextTypes.DEFAULT_TYPE):
-	now_ts = datetime.utcnow().timestamp()
-	for chat_id, last_ts in list(last_message_time.items()):
-		if now_ts - last_ts > 300:
+	def set_threshold(self, chat_id: int, seconds: Optional[int]):
+		state = chat_state(chat_id)
+		state.silence = seconds
+		if seconds is None:
+			storage.delete("silence", chat_id)
+		else:
+			storage.put("silence", chat_id, seconds)
+		self._armed.pop(chat_id, None)
+		if self.threshold(chat_id) > 0:
+			last_ts = state.last_message or time.time()
+			self._arm(chat_id, last_ts + self.threshold(chat_id))
+
+	def _arm(self, chat_id: int, deadline: float):
+		if self.threshold(chat_id) <= 0:
+			return  # opted out
+		self._armed[chat_id] = deadline
+		heapq.heappush(self._heap, (deadline, chat_id))
+		if self._heap[0][1] == chat_id:
+			self._wakeup.set()
+
+	def _pop_due(self, now_ts: float) -> List[int]:
+		due = []
+		while self._heap and self._heap[0][0] <= now_ts:
+			deadline, chat_id = heapq.heappop(self._heap)
+			if self._armed.get(chat_id) != deadline:
+				continue  # superseded by set_threshold
+			del self._armed[chat_id]
+			state = chat_states.peek(chat_id)
+			threshold = self.threshold(chat_id)
+			if state is None or threshold <= 0:
+				continue  # evicted as idle: wake it again once it talks
+			actual = (state.last_message or now_ts) + threshold
+			if actual > now_ts:
+				self._arm(chat_id, actual)
+			else:
+				due.append(chat_id)
+		return due
+
+	def start(self, bot):
+		self._task = asyncio.create_task(self.run(bot))
+
+	async def stop(self):
+		if self._task:
+			self._task.cancel()
+			try:
+				await self._task
+			except asyncio.CancelledError:
+				pass
+			self._task = None
+
+	async def run(self, bot):
+		# background loop to send aggro-phrases to silent chats
+		while True:
 			try:
-				await context.bot.send_message(chat_id, random.choice(AGGRO))
-				last_message_time[chat_id] = now_ts
+				now_ts = time.time()
+				for chat_id in self._pop_due(now_ts):
+					self.touch(chat_id, now_ts)
+					send(bot, chat_id, phrase_book.draw(chat_id, "aggro"), priority=PRIO_CHATTER)
+				self._wakeup.clear()
+				timeout = None
+				if self._heap:
+					timeout = max(0.0, self._heap[0][0] - time.time())
+				try:
+					await asyncio.wait_for(self._wakeup.wait(), timeout)
+				except asyncio.TimeoutError:
+					pass
+			except asyncio.CancelledError:
+				raise
 			except Exception:
-				logger.exception("Не удалось отправить агро-фразу в %s", chat_id)
+				logger.exception("Ошибка в детекторе тишины")
+				await asyncio.sleep(1)
 
+silence_detector = SilenceDetector()
 
-async def silence_daemon(app: Application):
-	# background loop to send aggro-phrases to silent chats
-	while True:
-		try:
-			now_ts = datetime.utcnow().timestamp()
-			for chat_id, last_ts in list(last_message_time.items()):
-				if now_ts - last_ts > 300:
-					try:
-						await app.bot.send_message(chat_id, random.choice(AGGRO))
-						last_message_time[chat_id] = now_ts
-					except Exception:
-						logger.exception("Не удалось отправить агро-фразу в %s", chat_id)
-		except Exception:
-			logger.exception("Ошибка в silence_daemon")
-		await asyncio.sleep(60)
 
+async def on_my_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+	# keep the bot rights cache in sync when the bot is promoted, demoted or removed
+	result = update.my_chat_member
+	chat_id = update.effective_chat.id
+	if result.new_chat_member.status in (ChatMember.LEFT, ChatMember.BANNED):
+		forget_chat(chat_id)
+	else:
+		bot_rights[chat_id] = (time.monotonic(), result.new_chat_member)
 
 async def welcome_goodbye(update: Update, context: ContextTypes.DEFAULT_TYPE):
 	# ChatMemberHandler handler: greet new members and say goodbye to left
 	result = update.chat_member
 	status = result.new_chat_member.status
+	chat_admins.update(update.effective_chat.id, result.new_chat_member)
+	was_in_chat = result.old_chat_member.status not in (ChatMember.LEFT, ChatMember.BANNED)
 	chat_id = update.effective_chat.id
 	user = result.new_chat_member.user
-	if status == ChatMember.MEMBER:
-		await context.bot.send_message(chat_id, random.choice(GREETINGS))
-	elif status == ChatMember.LEFT:
-		await context.bot.send_message(chat_id, random.choice(FAREWELLS))
+	# restricted <-> member transitions (mutes) are not joins or leaves
+	if status == ChatMember.MEMBER and not was_in_chat:
+		record_join(chat_id, user.id)
+		user_index.see(chat_id, user, time.time())
+		send(context.bot, chat_id, phrase_book.draw(chat_id, "greetings"), priority=PRIO_CHATTER)
+	elif status == ChatMember.LEFT and was_in_chat:
+		user_index.forget(chat_id, user.id)
+		send(context.bot, chat_id, phrase_book.draw(chat_id, "farewells"), priority=PRIO_CHATTER)
+
+# --- Embedded HTTP server ---
+HTTP_REASONS = {
+	200: "OK",
+	400: "Bad Request",
+	403: "Forbidden",
+	404: "Not Found",
+	405: "Method Not Allowed",
+	413: "Payload Too Large",
+	429: "Too Many Requests",
+	431: "Request Header Fields Too Large",
+	503: "Service Unavailable",
+}
+HTTP_MAX_BODY = 1024 * 1024
+HTTP_IDLE_TIMEOUT = 75
+
+# handler(headers, body) -> (status, content_type, payload)
+HTTPHandler = Callable[[Dict[str, str], bytes], Awaitable[Tuple[int, str, bytes]]]
+
+class MiniHTTPServer:
+	# Just enough HTTP/1.1 (keep-alive, Content-Length bodies) for the webhook
+	# and metrics endpoints, so they need nothing beyond the standard library.
+
+	def __init__(self):
+		self.routes: Dict[Tuple[str, str], HTTPHandler] = {}
+		self._server: Optional[asyncio.AbstractServer] = None
+		self._writers: Set[asyncio.StreamWriter] = set()
+
+	def route(self, method: str, path: str, handler: HTTPHandler):
+		self.routes[(method, path)] = handler
+
+	async def start(self, host: str, port: int):
+		self._server = await asyncio.start_server(self._serve, host, port)
+		logger.info("HTTP server listening on %s:%s", host, port)
+
+	async def stop(self):
+		if self._server is None:
+			return
+		self._server.close()
+		for writer in list(self._writers):
+			writer.close()
+		await self._server.wait_closed()
+		self._server = None
+
+	async def _respond(self, writer: asyncio.StreamWriter, status: int, content_type: str, payload: bytes, keep_alive: bool):
+		head = (
+			f"HTTP/1.1 {status} {HTTP_REASONS.get(status, 'Error')}\r\n"
+			f"Content-Type: {content_type}\r\n"
+			f"Content-Length: {len(payload)}\r\n"
+			f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+		)
+		writer.write(head.encode("latin-1") + payload)
+		await writer.drain()
+
+	async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+		self._writers.add(writer)
+		try:
+			while True:
+				try:
+					head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), HTTP_IDLE_TIMEOUT)
+				except asyncio.LimitOverrunError:
+					await self._respond(writer, 431, "text/plain", b"", False)
+					break
+				except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+					break
+				lines = head.decode("latin-1").split("\r\n")
+				try:
+					method, target, version = lines[0].split(" ", 2)
+				except ValueError:
+					await self._respond(writer, 400, "text/plain", b"", False)
+					break
+				headers = {}
+				for line in lines[1:]:
+					if ":" in line:
+						key, value = line.split(":", 1)
+						headers[key.strip().lower()] = value.strip()
+				try:
+					length = int(headers.get("content-length") or 0)
+				except ValueError:
+					length = -1
+				if length < 0 or length > HTTP_MAX_BODY:
+					await self._respond(writer, 413, "text/plain", b"", False)
+					break
+				body = await reader.readexactly(length) if length else b""
+				keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+				handler = self.routes.get((method, target.split("?", 1)[0]))
+				if handler is None:
+					status, content_type, payload = 404, "text/plain", b""
+				else:
+					try:
+						status, content_type, payload = await handler(headers, body)
+					except Exception:
+						logger.exception("HTTP handler failed for %s %s", method, target)
+						status, content_type, payload = 503, "text/plain", b""
+				await self._respond(writer, status, content_type, payload, keep_alive)
+				if not keep_alive:
+					break
+		except (asyncio.IncompleteReadError, ConnectionError):
+			pass
+		finally:
+			self._writers.discard(writer)
+			writer.close()
+
+# --- Webhook intake ---
+def webhook_handler(application: Application) -> HTTPHandler:
+	async def handle(headers: Dict[str, str], body: bytes) -> Tuple[int, str, bytes]:
+		if WEBHOOK_SECRET and not hmac.compare_digest(headers.get("x-telegram-bot-api-secret-token", ""), WEBHOOK_SECRET):
+			return 403, "text/plain", b"bad secret"
+		# backpressure: refuse instead of buffering without bound, Telegram redelivers later
+		if update_processor.backlog(application) >= WEBHOOK_MAX_PENDING:
+			return 503, "text/plain", b"busy"
+		try:
+			update = Update.de_json(json.loads(body), application.bot)
+		except Exception:
+			return 400, "text/plain", b"bad update"
+		await application.update_queue.put(update)
+		return 200, "text/plain", b"ok"
+	return handle
+
+async def run_webhook(application: Application):
+	# mirrors Application.run_polling: initialize, post_init, start ... stop, post_stop, shutdown
+	stop_event = asyncio.Event()
+	loop = asyncio.get_running_loop()
+	for sig in (signal.SIGINT, signal.SIGTERM):
+		loop.add_signal_handler(sig, stop_event.set)
+	server = MiniHTTPServer()
+	server.route("POST", WEBHOOK_PATH, webhook_handler(application))
+	await application.initialize()
+	try:
+		if application.post_init:
+			await application.post_init(application)
+		if WEBHOOK_URL:
+			await application.bot.set_webhook(
+				url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+				secret_token=WEBHOOK_SECRET or None,
+				allowed_updates=Update.ALL_TYPES,
+				max_connections=WEBHOOK_MAX_CONNECTIONS,
+			)
+		else:
+			logger.warning("WEBHOOK_URL is not set, not registering the webhook with Telegram")
+		if not WEBHOOK_SECRET:
+			logger.warning("WEBHOOK_SECRET is not set, webhook requests are not authenticated")
+		await application.start()
+		await server.start(WEBHOOK_LISTEN, WEBHOOK_PORT)
+		await stop_event.wait()
+		logger.info("Stopping webhook intake...")
+		await server.stop()
+		await application.stop()
+		if application.post_stop:
+			await application.post_stop(application)
+	finally:
+		await application.shutdown()
+		if application.post_shutdown:
+			await application.post_shutdown(application)
+
+# --- Metrics ---
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+	__slots__ = ("buckets", "counts", "total", "count")
+
+	def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+		self.buckets = buckets
+		self.counts = [0] * (len(buckets) + 1)
+		self.total = 0.0
+		self.count = 0
+
+	def observe(self, value: float):
+		self.counts[bisect.bisect_left(self.buckets, value)] += 1
+		self.total += value
+		self.count += 1
+
+	def render(self, name: str, labels: str) -> List[str]:
+		sep = "," if labels else ""
+		lines = []
+		cumulative = 0
+		for bound, n in zip(self.buckets, self.counts):
+			cumulative += n
+			lines.append(f'{name}_bucket{{{labels}{sep}le="{bound}"}} {cumulative}')
+		lines.append(f'{name}_bucket{{{labels}{sep}le="+Inf"}} {self.count}')
+		plain = f"{{{labels}}}" if labels else ""
+		lines.append(f"{name}_sum{plain} {self.total}")
+		lines.append(f"{name}_count{plain} {self.count}")
+		return lines
+
+class Metrics:
+	def __init__(self):
+		self.handler_latency: Dict[str, Histogram] = {}
+		self.handler_errors: Dict[str, int] = {}
+		self.api_calls: Dict[Tuple[str, str], int] = {}  # (method, outcome) -> count
+		# regular (non-getUpdates) calls holding or waiting for a pool connection
+		self.api_in_flight = 0
+		self.api_in_flight_peak = 0
+		self.loop_lag = Histogram()
+		self.loop_lag_last = 0.0
+		self._lag_task: Optional[asyncio.Task] = None
+		self._server: Optional[MiniHTTPServer] = None
+
+	def observe_handler(self, name: str, seconds: float, failed: bool):
+		hist = self.handler_latency.get(name)
+		if hist is None:
+			hist = self.handler_latency[name] = Histogram()
+		hist.observe(seconds)
+		if failed:
+			self.handler_errors[name] = self.handler_errors.get(name, 0) + 1
+
+	def count_api_call(self, method: str, outcome: str):
+		key = (method, outcome)
+		self.api_calls[key] = self.api_calls.get(key, 0) + 1
+
+	def state_sizes(self) -> Dict[str, Tuple[int, int]]:
+		# ChatState field or cache name -> (chats holding it, entries)
+		fields = [name for name in ChatState.__slots__ if name != "seen"]
+		counts = {name: [0, 0] for name in fields}
+		for state in chat_states.values():
+			for name in fields:
+				value = getattr(state, name)
+				if value is not None:
+					entry = counts[name]
+					entry[0] += 1
+					entry[1] += len(value) if isinstance(value, (dict, set, deque, ActivityWindow)) else 1
+		sizes = {name: (chats, entries) for name, (chats, entries) in counts.items()}
+		for name, container in (("flood_guard", flood_guard._chats), ("user_index", user_index._users), ("chat_admins", chat_admins._members)):
+			sizes[name] = (len(container), sum(len(v) for v in container.values()))
+		sizes["bot_rights"] = (len(bot_rights), len(bot_rights))
+		return sizes
+
+	def render(self) -> str:
+		lines = ["# TYPE reaper_handler_latency_seconds histogram"]
+		for name, hist in sorted(self.handler_latency.items()):
+			lines.extend(hist.render("reaper_handler_latency_seconds", f'handler="{name}"'))
+		lines.append("# TYPE reaper_handler_errors_total counter")
+		for name, n in sorted(self.handler_errors.items()):
+			lines.append(f'reaper_handler_errors_total{{handler="{name}"}} {n}')
+		lines.append("# TYPE reaper_errors_total counter")
+		lines.append(f"reaper_errors_total {error_log.total}")
+		lines.append("# TYPE reaper_error_groups gauge")
+		lines.append(f"reaper_error_groups {len(error_log)}")
+		lines.append("# TYPE reaper_trace_spans_exported_total counter")
+		lines.append(f"reaper_trace_spans_exported_total {tracer.exported}")
+		lines.append("# TYPE reaper_trace_spans_dropped_total counter")
+		lines.append(f"reaper_trace_spans_dropped_total {tracer.dropped}")
+		lines.append("# TYPE reaper_bot_api_calls_total counter")
+		for (method, outcome), n in sorted(self.api_calls.items()):
+			lines.append(f'reaper_bot_api_calls_total{{method="{method}",outcome="{outcome}"}} {n}')
+		lines.append("# TYPE reaper_bot_api_in_flight gauge")
+		lines.append(f"reaper_bot_api_in_flight {self.api_in_flight}")
+		lines.append("# TYPE reaper_bot_api_in_flight_peak gauge")
+		lines.append(f"reaper_bot_api_in_flight_peak {self.api_in_flight_peak}")
+		lines.append("# TYPE reaper_bot_api_pool_size gauge")
+		lines.append(f"reaper_bot_api_pool_size {HTTP_POOL_SIZE}")
+		lines.append("# TYPE reaper_unmute_pending gauge")
+		lines.append(f"reaper_unmute_pending {len(unmute_scheduler)}")
+		lines.append("# TYPE reaper_active_mutes gauge")
+		lines.append(f"reaper_active_mutes {sum(len(state.mutes) for state in chat_states.values() if state.mutes)}")
+		lines.append("# TYPE reaper_silence_armed gauge")
+		lines.append(f"reaper_silence_armed {len(silence_detector)}")
+		lines.append("# TYPE reaper_outbox_depth gauge")
+		for prio, depth in zip(("moderation", "normal", "chatter"), outbox.depth_by_priority()):
+			lines.append(f'reaper_outbox_depth{{priority="{prio}"}} {depth}')
+		lines.append("# TYPE reaper_storage_pending gauge")
+		lines.append(f"reaper_storage_pending {storage.pending()}")
+		lines.append("# TYPE reaper_journal_pending gauge")
+		lines.append(f"reaper_journal_pending {journal.pending()}")
+		lines.append("# TYPE reaper_warn_deadlines gauge")
+		lines.append(f"reaper_warn_deadlines {warn_ledger.tracked()}")
+		chats, nbytes = chat_states.memory()
+		lines.append("# TYPE reaper_chat_states gauge")
+		lines.append(f"reaper_chat_states {chats}")
+		lines.append("# TYPE reaper_chat_state_bytes gauge")
+		lines.append(f"reaper_chat_state_bytes {nbytes}")
+		lines.append("# TYPE reaper_chats_evicted_total counter")
+		lines.append(f"reaper_chats_evicted_total {chat_states.evicted}")
+		lines.append("# TYPE reaper_state_chats gauge")
+		lines.append("# TYPE reaper_state_entries gauge")
+		for name, (chats, entries) in self.state_sizes().items():
+			lines.append(f'reaper_state_chats{{dict="{name}"}} {chats}')
+			lines.append(f'reaper_state_entries{{dict="{name}"}} {entries}')
+		lines.append("# TYPE reaper_update_queue_wait_seconds histogram")
+		lines.extend(update_processor.queue_wait.render("reaper_update_queue_wait_seconds", ""))
+		running, waiting = update_processor.queued()
+		lines.append("# TYPE reaper_update_chats_busy gauge")
+		lines.append(f"reaper_update_chats_busy {running}")
+		lines.append("# TYPE reaper_update_waiting gauge")
+		lines.append(f"reaper_update_waiting {waiting}")
+		lines.append("# TYPE reaper_event_loop_lag_seconds gauge")
+		lines.append(f"reaper_event_loop_lag_seconds {self.loop_lag_last}")
+		lines.append("# TYPE reaper_event_loop_lag_observed_seconds histogram")
+		lines.extend(self.loop_lag.render("reaper_event_loop_lag_observed_seconds", ""))
+		return "\n".join(lines) + "\n"
+
+	async def _measure_lag(self, interval: float = 0.5):
+		while True:
+			t0 = time.monotonic()
+			await asyncio.sleep(interval)
+			self.loop_lag_last = max(0.0, time.monotonic() - t0 - interval)
+			self.loop_lag.observe(self.loop_lag_last)
+
+	async def _serve_metrics(self, headers: Dict[str, str], body: bytes) -> Tuple[int, str, bytes]:
+		return 200, "text/plain; version=0.0.4", self.render().encode()
+
+	async def start(self):
+		self._lag_task = asyncio.create_task(self._measure_lag())
+		self._server = MiniHTTPServer()
+		self._server.route("GET", "/metrics", self._serve_metrics)
+		await self._server.start(METRICS_LISTEN, METRICS_PORT)
+
+	async def stop(self):
+		if self._lag_task:
+			self._lag_task.cancel()
+			self._lag_task = None
+		if self._server:
+			await self._server.stop()
+			self._server = None
+
+metrics = Metrics()
+
+class MeteredRequest(BaseRequest):
+	# wraps the real request object and counts Bot API calls by method and
+	# outcome; with `pooled` it also tracks calls in flight against the pool
+	def __init__(self, inner: BaseRequest, pooled: bool = False):
+		self._inner = inner
+		self._pooled = pooled
+
+	@property
+	def read_timeout(self) -> Optional[float]:
+		return self._inner.read_timeout
+
+	async def initialize(self):
+		await self._inner.initialize()
+
+	async def shutdown(self):
+		await self._inner.shutdown()
+
+	async def do_request(self, url: str, method: str, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE, write_timeout=BaseRequest.DEFAULT_NONE, connect_timeout=BaseRequest.DEFAULT_NONE, pool_timeout=BaseRequest.DEFAULT_NONE) -> Tuple[int, bytes]:
+		api_method = url.rsplit("/", 1)[-1]
+		if self._pooled:
+			metrics.api_in_flight += 1
+			metrics.api_in_flight_peak = max(metrics.api_in_flight_peak, metrics.api_in_flight)
+		try:
+			status, payload = await self._inner.do_request(url, method, request_data, read_timeout, write_timeout, connect_timeout, pool_timeout)
+		except TimedOut as e:
+			# HTTPXRequest reports an exhausted connection pool as a TimedOut
+			metrics.count_api_call(api_method, "pool_timeout" if "pool" in str(e).lower() else "error")
+			raise
+		except Exception:
+			metrics.count_api_call(api_method, "error")
+			raise
+		finally:
+			if self._pooled:
+				metrics.api_in_flight -= 1
+		metrics.count_api_call(api_method, "ok" if status == 200 else "429" if status == 429 else "error")
+		return status, payload
+
+class TracedRequest(BaseRequest):
+	# opens a client span for every Bot API request made inside a sampled update
+	def __init__(self, inner: BaseRequest):
+		self._inner = inner
+
+	@property
+	def read_timeout(self) -> Optional[float]:
+		return self._inner.read_timeout
+
+	async def initialize(self):
+		await self._inner.initialize()
+
+	async def shutdown(self):
+		await self._inner.shutdown()
+
+	async def do_request(self, url: str, method: str, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE, write_timeout=BaseRequest.DEFAULT_NONE, connect_timeout=BaseRequest.DEFAULT_NONE, pool_timeout=BaseRequest.DEFAULT_NONE) -> Tuple[int, bytes]:
+		span = tracer.start_span(url.rsplit("/", 1)[-1], "client")
+		if span is None:
+			return await self._inner.do_request(url, method, request_data, read_timeout, write_timeout, connect_timeout, pool_timeout)
+		chat_id = request_data.parameters.get("chat_id") if request_data else None
+		if chat_id is not None:
+			span.attrs["chat_id"] = chat_id
+		error = None
+		try:
+			status, payload = await self._inner.do_request(url, method, request_data, read_timeout, write_timeout, connect_timeout, pool_timeout)
+			span.attrs["http.status_code"] = status
+			return status, payload
+		except Exception as e:
+			error = e
+			raise
+		finally:
+			tracer.finish(span, error)
+
+def instrument_handlers(application: Application):
+	# wrap every registered callback with a latency timer and/or a trace span,
+	# handler bodies stay untouched
+	for handlers in application.handlers.values():
+		for handler in handlers:
+			if METRICS_PORT:
+				handler.callback = timed_callback(handler.callback)
+			if tracer.enabled:
+				handler.callback = traced_callback(handler.callback)
+
+def traced_callback(callback):
+	name = getattr(callback, "__name__", repr(callback))
+
+	@functools.wraps(callback)
+	async def wrapper(update, context):
+		span = tracer.start_span(name)
+		if span is None:
+			return await callback(update, context)
+		token = current_span.set(span)
+		error = None
+		try:
+			return await callback(update, context)
+		except Exception as e:
+			error = e
+			raise
+		finally:
+			current_span.reset(token)
+			tracer.finish(span, error)
+	return wrapper
+
+def timed_callback(callback):
+	name = getattr(callback, "__name__", repr(callback))
+
+	@functools.wraps(callback)
+	async def wrapper(update, context):
+		t0 = time.perf_counter()
+		failed = False
+		try:
+			return await callback(update, context)
+		except Exception:
+			failed = True
+			raise
+		finally:
+			metrics.observe_handler(name, time.perf_counter() - t0, failed)
+	return wrapper
+
+# --- Update dispatch ---
+class ChatOrderedProcessor(BaseUpdateProcessor):
+	# PTB hands every update to do_process_update as soon as it is fetched.
+	# Updates of one chat (or of one user outside chats) form a FIFO: the
+	# first one runs, later ones wait on a future that the finishing update
+	# resolves. Only updates whose turn has come take one of the `limit`
+	# global slots, so a slow chat holds at most one slot. A chat with
+	# nothing left waiting is removed from the map right away.
+	# PTB takes updates off update_queue as soon as they arrive, so intake
+	# backpressure looks at backlog(): queued plus waiting plus running.
+
+	def __init__(self, limit: int, max_pending: int = 100000):
+		super().__init__(max_pending)
+		self._slots = asyncio.Semaphore(limit)
+		self._chats: Dict[int, Deque[asyncio.Future]] = {}
+		self._pending = 0
+		self._room = asyncio.Event()
+		self.queue_wait = Histogram()
+
+	def queued(self) -> Tuple[int, int]:
+		# (chats with an update running, updates waiting behind them)
+		return len(self._chats), sum(len(waiters) for waiters in self._chats.values())
+
+	def backlog(self, application: Application) -> int:
+		# updates taken in but not finished yet
+		return application.update_queue.qsize() + self._pending
+
+	async def wait_for_room(self, application: Application, limit: int):
+		while self.backlog(application) >= limit:
+			self._room.clear()
+			await self._room.wait()
+
+	async def initialize(self):
+		pass
+
+	async def shutdown(self):
+		pass
+
+	async def do_process_update(self, update: object, coroutine: Awaitable):
+		self._pending += 1
+		try:
+			await self._process_in_turn(update, coroutine)
+		finally:
+			self._pending -= 1
+			self._room.set()
+
+	async def _process_in_turn(self, update: object, coroutine: Awaitable):
+		loop = asyncio.get_running_loop()
+		enqueued = loop.time()
+		key = None
+		if isinstance(update, Update):
+			chat = update.effective_chat
+			user = update.effective_user
+			key = chat.id if chat else (user.id if user else None)
+			if chat:
+				chat_states.touch(chat.id)
+		if key is not None:
+			waiters = self._chats.get(key)
+			if waiters is None:
+				self._chats[key] = deque()
+			else:
+				turn = loop.create_future()
+				waiters.append(turn)
+				try:
+					await turn
+				except asyncio.CancelledError:
+					if turn.done() and not turn.cancelled():
+						self._next(key)
+					else:
+						waiters.remove(turn)
+					coroutine.close()
+					raise
+		try:
+			async with self._slots:
+				waited = loop.time() - enqueued
+				self.queue_wait.observe(waited)
+				span = tracer.start_trace(update) if tracer.enabled else None
+				if span is None:
+					await coroutine
+				else:
+					span.attrs["queue_wait_ms"] = round(waited * 1000, 3)
+					token = current_span.set(span)
+					try:
+						await coroutine
+					finally:
+						current_span.reset(token)
+						tracer.finish(span)
+		finally:
+			if key is not None:
+				self._next(key)
+
+	def _next(self, key: int):
+		waiters = self._chats[key]
+		if waiters:
+			waiters.popleft().set_result(None)
+		else:
+			del self._chats[key]
+
+update_processor = ChatOrderedProcessor(max(1, UPDATE_CONCURRENCY))
+
+# --- Sharded workers ---
+class ShardRouter:
+	# The receiver process: a bare Application whose only handler forwards
+	# each update to the worker owning its chat. Workers read their queue in
+	# order, so per-chat ordering is kept; global rate limits are split
+	# evenly between them. Shutdown sends every worker a None sentinel after
+	# intake has stopped, then waits for them to drain and exit.
+
+	def __init__(self, token: str, count: int):
+		ctx = multiprocessing.get_context("spawn")
+		self.queues = [ctx.Queue(SHARD_QUEUE_SIZE) for _ in range(count)]
+		self.procs = [
+			ctx.Process(target=run_worker, args=(index, count, self.queues, token), name=f"shard-{index}")
+			for index in range(count)
+		]
+
+	def start(self):
+		for proc in self.procs:
+			proc.start()
+		logger.info("Started %d shard workers", len(self.procs))
+
+	async def forward(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+		chat = update.effective_chat
+		user = update.effective_user
+		key = chat.id if chat else (user.id if user else 0)
+		index = shard_of(key, len(self.queues))
+		await self._put(index, ("update", update.to_dict()))
+
+	async def _put(self, index: int, item):
+		try:
+			self.queues[index].put_nowait(item)
+		except queue.Full:
+			if not self.procs[index].is_alive():
+				logger.error("Shard %d is not running, dropping update", index)
+				return
+			# backpressure: intake waits for the worker instead of buffering
+			await asyncio.get_running_loop().run_in_executor(None, self.queues[index].put, item)
+
+	async def stop(self, timeout: float = SHARD_STOP_TIMEOUT):
+		loop = asyncio.get_running_loop()
+		for index, proc in enumerate(self.procs):
+			if proc.is_alive():
+				await self._put(index, None)
+		deadline = loop.time() + timeout
+		for proc in self.procs:
+			await loop.run_in_executor(None, proc.join, max(0.0, deadline - loop.time()))
+			if proc.is_alive():
+				logger.warning("%s did not stop in time, terminating", proc.name)
+				proc.terminate()
+		logger.info("Shard workers stopped")
+
+def shard_broadcast(kind: str, payload):
+	# settings that are global to the bot, pushed to the other workers
+	for index, inbox in enumerate(SHARD_QUEUES):
+		if index != SHARD_INDEX:
+			inbox.put((kind, payload))
+
+def run_worker(index: int, count: int, queues: List, token: str):
+	global SHARD_INDEX, SHARD_COUNT, SHARD_QUEUES, METRICS_PORT, outbox
+	# the receiver owns the signals and stops workers through their queue
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	signal.signal(signal.SIGTERM, signal.SIG_IGN)
+	SHARD_INDEX, SHARD_COUNT, SHARD_QUEUES = index, count, queues
+	if METRICS_PORT:
+		METRICS_PORT += index
+	outbox = Outbox(OUTBOX_GLOBAL_RATE / count)
+	asyncio.run(serve_shard(build_application(token), queues[index]))
+
+async def serve_shard(application: Application, inbox):
+	global OWNER_ID
+	loop = asyncio.get_running_loop()
+	await application.initialize()
+	try:
+		if application.post_init:
+			await application.post_init(application)
+		await application.start()
+		logger.info("Shard %d/%d ready", SHARD_INDEX, SHARD_COUNT)
+		running = True
+		while running:
+			# leave updates in the inbox while this worker is full, so the receiver slows down
+			await update_processor.wait_for_room(application, SHARD_QUEUE_SIZE)
+			room = SHARD_QUEUE_SIZE - update_processor.backlog(application)
+			items = [await loop.run_in_executor(None, inbox.get)]
+			try:
+				while len(items) < min(100, room):
+					items.append(inbox.get_nowait())
+			except queue.Empty:
+				pass
+			for item in items:
+				if item is None:
+					running = False
+					break
+				kind, payload = item
+				if kind == "owner":
+					OWNER_ID = payload
+				else:
+					await application.update_queue.put(Update.de_json(payload, application.bot))
+		# stop() lets the updates already queued finish first
+		await application.stop()
+		if application.post_stop:
+			await application.post_stop(application)
+	finally:
+		await application.shutdown()
+
+def build_receiver(token: str, workers: int) -> Application:
+	router = ShardRouter(token, workers)
+
+	async def start_router(application: Application):
+		router.start()
+
+	async def stop_router(application: Application):
+		await router.stop()
+
+	app = application_builder(token).post_init(start_router).post_stop(stop_router).build()
+	app.add_handler(TypeHandler(Update, router.forward))
+	return app
 
 # --- Startup and main ---
-def main():
-	if DOTENV_LOADED:
-		logger.info("Loaded .env via python-dotenv")
-	else:
-		logger.info("python-dotenv not installed or .env not found; skipping .env load")
-	token = os.getenv("BOT_TOKEN")
-	if not token:
-		logger.error("BOT_TOKEN env var is not set")
-		return
+BOT_COMMANDS = [
+	BotCommand("start", "Запуск бота"),
+	BotCommand("help", "Список команд"),
+	BotCommand("roast", "Пошутить (reply)") ,
+	BotCommand("vanilla", "Ванильная философия"),
+	BotCommand("duel", "Дуэль (reply, 2 ID или @username)"),
+	BotCommand("roulette", "Рулетка"),
+	BotCommand("profile", "Профиль (reply)") ,
+	BotCommand("search", "Саркастический обыск"),
+]
+
+async def register_commands(bot) -> bool:
+	# set_my_commands only when the list differs from what was last registered;
+	# returns True when it was skipped
+	if SHARD_INDEX != 0:
+		return True  # one shard registers them for the whole bot
+	digest = hashlib.sha256(json.dumps([c.to_dict() for c in BOT_COMMANDS], sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+	if storage.get_setting("commands_hash") == digest:
+		return True
+	await bot.set_my_commands(BOT_COMMANDS)
+	storage.set_setting("commands_hash", digest)
+	return False
+
+class StartupPhases:
+	# wall time per phase for the startup/shutdown log line
+	def __init__(self):
+		self._t0 = self._last = time.perf_counter()
+		self._parts: List[str] = []
+
+	def mark(self, name: str):
+		now = time.perf_counter()
+		self._parts.append(f"{name} {(now - self._last) * 1000:.0f} ms")
+		self._last = now
+
+	def log(self, what: str):
+		logger.info("%s: %s; total %.0f ms", what, ", ".join(self._parts), (time.perf_counter() - self._t0) * 1000)
+
+def application_builder(token: str, request: Optional[BaseRequest] = None, get_updates_request: Optional[BaseRequest] = None):
+	# Application.builder() pointed at BOT_API_URL with the configured HTTP pool;
+	# custom request objects let benchmarks run the real handlers against a stub Bot API
+	if request is None:
+		request = HTTPXRequest(connection_pool_size=HTTP_POOL_SIZE, pool_timeout=HTTP_POOL_TIMEOUT)
+	if get_updates_request is None:
+		get_updates_request = HTTPXRequest(connection_pool_size=1)
+	if METRICS_PORT:
+		request = MeteredRequest(request, pooled=True)
+		get_updates_request = MeteredRequest(get_updates_request)
+	if tracer.enabled:
+		request = TracedRequest(request)
+	builder = Application.builder().token(token).request(request).get_updates_request(get_updates_request)
+	if BOT_API_URL:
+		builder = builder.base_url(BOT_API_URL)
+	return builder
+
+def build_application(token: str, request: Optional[BaseRequest] = None, get_updates_request: Optional[BaseRequest] = None) -> Application:
 	async def start_backgrounds(application: Application):
-			# start background daemons after app initialization
-			asyncio.create_task(silence_daemon(application))
-			# register visible commands for users
-			try:
-				commands = [
-					BotCommand("start", "Запуск бота"),
-					BotCommand("help", "Список команд"),
-					BotCommand("roast", "Пошутить (reply)") ,
-					BotCommand("vanilla", "Ванильная философия"),
-					BotCommand("duel", "Дуэль (reply или 2 ID)"),
-					BotCommand("roulette", "Рулетка"),
-					BotCommand("profile", "Профиль (reply)") ,
-					BotCommand("search", "Саркастический обыск"),
-				]
-				await application.bot.set_my_commands(commands)
-			except Exception:
-				logger.exception("Не удалось установить команды бота")
-			# cache bot username for mention detection
-			try:
-				me = await application.bot.get_me()
-				globals()['BOT_USERNAME'] = me.username
-			except Exception:
-				globals()['BOT_USERNAME'] = None
+		global OWNER_ID
+		# start background daemons after app initialization
+		phases = StartupPhases()
+		storage.start()
+		journal.start()
+		outbox.start()
+		owner = storage.get_setting("owner_id")
+		if owner:
+			OWNER_ID = int(owner)
+		phases.mark("storage")
+		silence_detector.start(application.bot)
+		unmute_scheduler.start(application)
+		chat_states.start()
+		error_log.start(application.bot)
+		tracer.start()
+		phases.mark("schedulers")
+		# independent of each other, so none waits for the rest
+		results = await asyncio.gather(
+			register_commands(application.bot),
+			load_bot_identity(application.bot),
+			metrics.start() if METRICS_PORT else asyncio.sleep(0),
+			return_exceptions=True,
+		)
+		for what, res in zip(("регистрация команд", "данные бота", "сервер метрик"), results):
+			if isinstance(res, Exception):
+				logger.error("Ошибка при запуске (%s): %s", what, res)
+		phases.mark("bot api" if results[0] is not True else "bot api, commands unchanged")
+		phases.log("Startup")
 
-	app = Application.builder().token(token).post_init(start_backgrounds).build()
+	async def stop_backgrounds(application: Application):
+		# intake has stopped and in-flight updates have finished by now
+		deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+		phases = StartupPhases()
+		await chat_states.stop()
+		await error_log.stop()
+		await silence_detector.stop()
+		await unmute_scheduler.stop(timeout=max(0.0, deadline - time.monotonic()))
+		phases.mark("schedulers")
+		await outbox.stop(timeout=max(0.0, deadline - time.monotonic()))
+		phases.mark("outbox")
+		if METRICS_PORT:
+			await metrics.stop()
+		await journal.stop()
+		await tracer.stop()
+		await storage.stop()
+		phases.mark("storage")
+		phases.log("Shutdown")
+
+	builder = application_builder(token, request, get_updates_request).post_init(start_backgrounds).post_stop(stop_backgrounds)
+	app = builder.concurrent_updates(update_processor).build()
 
 	# command handlers
+	app.add_handler(MessageHandler(filters.COMMAND & filters.ChatType.GROUPS, sync_chat_admins), group=-1)
 	app.add_handler(CommandHandler("start", start))
 	app.add_handler(CommandHandler(["help", "commands"], help_cmd))
 	app.add_handler(CommandHandler("addadmin", addadmin))
@@ -811,6 +4031,7 @@ def main():
 	app.add_handler(CommandHandler("admins", admins_list))
 	app.add_handler(CommandHandler("warn", warn_cmd))
 	app.add_handler(CommandHandler("warns", warns_cmd))
+	app.add_handler(CommandHandler("warnpolicy", warnpolicy_cmd))
 	app.add_handler(CommandHandler("mute", mute_cmd))
 	app.add_handler(CommandHandler("unmute", unmute_cmd))
 	app.add_handler(CommandHandler("kick", kick_cmd))
@@ -823,19 +4044,27 @@ def main():
 	app.add_handler(CommandHandler("search", search_cmd))
 	app.add_handler(CommandHandler("profile", profile_cmd))
 	app.add_handler(CommandHandler("sacrifice", sacrifice_cmd))
+	app.add_handler(CommandHandler("silence", silence_cmd))
+	app.add_handler(CommandHandler("phrases", phrases_cmd))
+	app.add_handler(CommandHandler("modlog", modlog_cmd))
+	app.add_handler(CommandHandler("errors", errors_cmd))
 
 	# message handler
 	app.add_handler(MessageHandler(filters.ALL & (~filters.COMMAND), on_message))
 	# callback handler for inline buttons
 	app.add_handler(CallbackQueryHandler(commands_button_handler))
 
-	# global error handler
+	# global error handler: full traceback and an owner alert only for a new kind of error
 	async def global_error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
-		logger.exception("Unhandled exception: %s", context.error)
+		error = context.error
+		group = error_log.record(error, update)
+		if group.count > 1:
+			logger.warning("Unhandled exception in %s again (%d times): %r", group.handler, group.count, error)
+			return
+		logger.error("Unhandled exception in %s: %s", group.handler, error, exc_info=error)
 		try:
-			# notify owner if possible
-			bot = context.application.bot
-			await bot.send_message(OWNER_ID, f"Ошибка в боте: {context.error}")
+			if error_log.claim_alert(group):
+				send(context.application.bot, OWNER_ID, format_error_alert(group))
 		except Exception:
 			logger.exception("Не удалось уведомить владельца об ошибке")
 
@@ -843,11 +4072,34 @@ def main():
 
 	# chat member updates
 	app.add_handler(ChatMemberHandler(welcome_goodbye, ChatMemberHandler.CHAT_MEMBER))
+	app.add_handler(ChatMemberHandler(on_my_chat_member, ChatMemberHandler.MY_CHAT_MEMBER))
+
+	if METRICS_PORT or tracer.enabled:
+		instrument_handlers(app)
 
 	# Note: JobQueue may be unavailable in some installs, use asyncio daemon instead
+	return app
+
+def main():
+	if DOTENV_LOADED:
+		logger.info("Loaded .env via python-dotenv")
+	else:
+		logger.info("python-dotenv not installed or .env not found; skipping .env load")
+	token = os.getenv("BOT_TOKEN")
+	if not token:
+		logger.error("BOT_TOKEN env var is not set")
+		return
+	if WORKERS > 0:
+		app = build_receiver(token, WORKERS)
+	else:
+		app = build_application(token)
 
-	logger.info("Starting VanillaReaperBot...")
-	app.run_polling()
+	logger.info("Starting VanillaReaperBot (%s, %s)...", BOT_MODE, f"{WORKERS} workers" if WORKERS > 0 else "single process")
+	if BOT_MODE == "webhook":
+		asyncio.run(run_webhook(app))
+	else:
+		# chat_member updates are opt-in; joins and member changes need them
+		app.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == "__main__":